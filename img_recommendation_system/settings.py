@@ -48,6 +48,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'recommendation.middleware.RequestLogMiddleware',
+    'recommendation.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'img_recommendation_system.urls'
@@ -118,6 +120,24 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Local media store: generated images (POLLINATIONS_FETCH_MODE = 'store'),
+# catalog originals and thumbnails (manage.py fetch_assets). Files are served
+# with long-lived cache headers; set MEDIA_SENDFILE_HEADER to
+# 'X-Accel-Redirect' (nginx) or 'X-Sendfile' (Apache) to let the web server
+# send them, MEDIA_SENDFILE_PREFIX being the internal location mapped to
+# MEDIA_ROOT.
+MEDIA_URL = '/media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_STORE_MAX_BYTES = 20 * 1024 * 1024
+MEDIA_SENDFILE_HEADER = None
+MEDIA_SENDFILE_PREFIX = '/protected-media/'
+
+# Thumbnail widths generated by manage.py fetch_assets, and the one used for
+# cards in the pages and APIs
+THUMBNAIL_SIZES = [160, 320, 640]
+THUMBNAIL_DEFAULT_SIZE = 320
+THUMBNAIL_FORMAT = 'WEBP'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -126,4 +146,121 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Login URL configuration
 LOGIN_URL = '/admin/login/'
 LOGIN_REDIRECT_URL = '/'
-LOGOUT_REDIRECT_URL = '/'
\ No newline at end of file
+LOGOUT_REDIRECT_URL = '/'
+
+# Pollinations.AI image generation
+POLLINATIONS_BASE_URL = 'https://image.pollinations.ai/prompt'
+POLLINATIONS_TIMEOUT = 30  # seconds per request
+POLLINATIONS_MAX_CONCURRENCY = 8  # in-flight requests per process
+POLLINATIONS_MAX_WORKERS = 10  # threads per generation batch
+POLLINATIONS_BATCH_DEADLINE = 10  # seconds to wait for a batch
+POLLINATIONS_CONNECT_TIMEOUT = 5  # seconds
+# 'stream' reads only the response headers to learn the image URL, 'head'
+# sends a HEAD request instead, 'get' downloads and drops the body, 'store'
+# saves the image once in the local media store (MEDIA_ROOT/generated)
+POLLINATIONS_FETCH_MODE = 'stream'
+# 'stream' reads and drops bodies of at most this size (error pages) so their
+# keep-alive connection is reused; images are never downloaded, their
+# connection is closed instead
+POLLINATIONS_DRAIN_LIMIT = 4 * 1024  # bytes
+# Connection errors and 429/5xx answers are retried with exponential backoff
+POLLINATIONS_RETRIES = 2
+POLLINATIONS_RETRY_BACKOFF = 0.5  # seconds, doubled on every retry
+POLLINATIONS_RETRY_BACKOFF_MAX = 4  # seconds
+# Consecutive failures that open the circuit breaker, and seconds before a
+# probe request is let through again
+POLLINATIONS_BREAKER_THRESHOLD = 5
+POLLINATIONS_BREAKER_RESET = 30
+
+# Background AI generation jobs (manage.py run_generation_worker)
+GENERATION_JOB_MAX_ATTEMPTS = 3
+GENERATION_JOB_STALE_AFTER = 300  # seconds before a running job is reclaimed
+
+# Prompt -> generated image URL cache in front of Pollinations.AI. Use
+# 'recommendation.cache.DjangoPromptCache' with an 'alias' option pointing at a
+# DatabaseCache to share a persistent cache between workers.
+POLLINATIONS_PROMPT_CACHE = {
+    'BACKEND': 'recommendation.cache.MemoryPromptCache',
+    'OPTIONS': {
+        'timeout': 86400,  # seconds
+        'max_entries': 1024,
+    },
+}
+
+# Recommendation scorer: 'matrix' scores in-process with a sparse label
+# matrix, 'sql' runs one aggregate query over the ImageLabel table, 'lsh'
+# re-ranks the MinHash LSH candidates exactly (approximate top-k)
+RECOMMENDATION_SCORER = 'matrix'
+
+# Label matrix file written by manage.py export_label_matrix. When set and
+# present, the 'matrix' scorer memory-maps it instead of reading the catalog
+# in every worker process. Re-run the export after bulk catalog changes.
+LABEL_MATRIX_PATH = None
+
+# Seconds between reads of the catalog change log, which keeps every
+# process' label index and mapped label matrix in sync with the changes made
+# by other processes. None stops following it. Prune the log with
+# manage.py prune_catalog_changes.
+CATALOG_CHANGE_POLL_INTERVAL = 1.0
+
+# Seconds a skipped change log sequence number is looked for again, for
+# transactions that commit out of order. Numbers of rolled back inserts
+# never show up and are forgotten after this.
+CATALOG_CHANGE_GAP_TIMEOUT = 60.0
+
+# MinHash LSH index used by the 'lsh' scorer: LSH_BANDS bands of LSH_ROWS
+# hashes each. More bands find more of the true top-k, more rows make
+# buckets smaller. The LSH_MAX_CANDIDATES candidates sharing the most bands
+# are re-ranked exactly; buckets larger than LSH_MAX_BUCKET (None: no limit)
+# are ignored. manage.py build_lsh_index writes the index to LSH_INDEX_PATH,
+# otherwise it is built in memory on first use.
+LSH_BANDS = 32
+LSH_ROWS = 2
+LSH_SEED = 1
+LSH_MAX_CANDIDATES = 2000
+LSH_MAX_BUCKET = None
+LSH_INDEX_PATH = None
+
+# Neighbours stored per image by manage.py build_similarity
+SIMILAR_IMAGES_PER_IMAGE = 20
+
+# Seconds a user's ranked recommendations stay cached. The cache lives in the
+# default Django cache; configure a shared CACHES backend when running several
+# processes.
+RECOMMENDATION_CACHE_TIMEOUT = 3600
+
+# Sessions written by manage.py precompute_recommendations are served to
+# users whose reference set is unchanged for this many seconds
+PRECOMPUTED_RECOMMENDATIONS_MAX_AGE = 3600
+
+# Write recommendation rows from a background thread in batches shared by
+# many requests. Rows become visible up to the flush interval later.
+RECOMMENDATION_WRITE_BEHIND = False
+RECOMMENDATION_WRITE_BEHIND_INTERVAL = 0.5  # seconds
+
+# Browse page size, and the largest page the JSON API will return
+BROWSE_PAGE_SIZE = 24
+BROWSE_MAX_PAGE_SIZE = 100
+
+# Append the app's requests to this JSONL file, for manage.py replay_requests.
+# None disables the capture. Admin and login requests are never captured, and
+# password and CSRF token fields are dropped.
+REQUEST_LOG_PATH = None
+
+# URL names captured, None for every URL name of the recommendation app
+REQUEST_LOG_URL_NAMES = None
+
+# Request metrics (served at /metrics) and Server-Timing headers, on in
+# development only by default. A SAMPLE_RATE fraction of requests, and staff
+# requests with ?profile=1, are run under cProfile and dumped to PROFILE_DIR
+# (no dumps while it is None).
+PROFILING = {
+    'ENABLED': DEBUG,
+    'SAMPLE_RATE': 0.0,
+    'PROFILE_DIR': None,
+}
+
+# /metrics is served to staff users and to these client addresses (the
+# Prometheus scrapers). Behind a reverse proxy every client has the proxy's
+# address, so list the scrapers only if they bypass it.
+METRICS_ALLOWED_IPS = []
\ No newline at end of file
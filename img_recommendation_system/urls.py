@@ -14,10 +14,16 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+
+from recommendation.views import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('recommendation.urls')),
+    re_path(r'^%s(?P<name>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')), serve_media, name='serve_media'),
 ]
\ No newline at end of file
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Image, Collection, CollectionImage, RecommendationSession, Recommendation
+from .models import Image, Label, Collection, CollectionImage, RecommendationSession, Recommendation, GenerationJob, SimilarImage, ImageAsset, CatalogChange, ChangeCursor
 
 @admin.register(Image)
 class ImageAdmin(admin.ModelAdmin):
@@ -7,23 +7,61 @@ class ImageAdmin(admin.ModelAdmin):
     search_fields = ('title', 'labels')
     list_filter = ('created_at',)
 
+@admin.register(Label)
+class LabelAdmin(admin.ModelAdmin):
+    list_display = ('name',)
+    search_fields = ('name',)
+
 @admin.register(Collection)
 class CollectionAdmin(admin.ModelAdmin):
     list_display = ('name', 'user', 'created_at')
+    list_select_related = ('user',)
     search_fields = ('name', 'user__username')
     list_filter = ('created_at', 'user')
 
 @admin.register(CollectionImage)
 class CollectionImageAdmin(admin.ModelAdmin):
     list_display = ('collection', 'image', 'interaction_type', 'added_at')
+    list_select_related = ('collection__user', 'image')
     list_filter = ('interaction_type', 'added_at')
 
 @admin.register(RecommendationSession)
 class RecommendationSessionAdmin(admin.ModelAdmin):
     list_display = ('user', 'created_at', 'is_active')
+    list_select_related = ('user',)
     list_filter = ('created_at', 'is_active', 'user')
 
 @admin.register(Recommendation)
 class RecommendationAdmin(admin.ModelAdmin):
     list_display = ('session', 'image', 'similarity_score', 'position', 'added_to_collection')
-    list_filter = ('added_to_collection', 'position')
\ No newline at end of file
+    list_select_related = ('session__user', 'image')
+    list_filter = ('added_to_collection', 'position')
+
+@admin.register(GenerationJob)
+class GenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('title', 'session', 'status', 'attempts', 'created_at', 'finished_at')
+    list_select_related = ('session__user',)
+    list_filter = ('status', 'created_at')
+
+@admin.register(SimilarImage)
+class SimilarImageAdmin(admin.ModelAdmin):
+    list_display = ('image', 'neighbour', 'score', 'rank')
+    list_select_related = ('image', 'neighbour')
+    raw_id_fields = ('image', 'neighbour')
+
+@admin.register(ImageAsset)
+class ImageAssetAdmin(admin.ModelAdmin):
+    list_display = ('image', 'status', 'content_hash', 'fetched_at')
+    list_select_related = ('image',)
+    list_filter = ('status',)
+    raw_id_fields = ('image',)
+
+@admin.register(CatalogChange)
+class CatalogChangeAdmin(admin.ModelAdmin):
+    list_display = ('seq', 'image_id', 'op', 'created_at')
+    list_filter = ('op', 'created_at')
+    search_fields = ('image_id',)
+
+@admin.register(ChangeCursor)
+class ChangeCursorAdmin(admin.ModelAdmin):
+    list_display = ('name', 'seq', 'updated_at')
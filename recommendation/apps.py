@@ -3,4 +3,8 @@ from django.apps import AppConfig
 
 class RecommendationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'recommendation'
\ No newline at end of file
+    name = 'recommendation'
+
+    def ready(self):
+        # Register signal handlers
+        from . import signals  # noqa: F401
@@ -0,0 +1,176 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+from .media import ContentAddressedStore, get_media_store
+from .models import Image, ImageAsset
+
+
+def thumbnail_sizes() -> List[int]:
+    return sorted(getattr(settings, 'THUMBNAIL_SIZES', [160, 320, 640]))
+
+
+def pillow_available() -> bool:
+    """Thumbnails need Pillow, which is an optional dependency"""
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def make_thumbnails(root: str, original: str, content_hash: str, sizes: Sequence[int],
+                    image_format: str = 'WEBP', quality: int = 80) -> Dict[str, str]:
+    """
+    Write the thumbnails of one original, runs in a worker process
+
+    Thumbnails are named after the hash of the original, so existing ones
+    are kept and running this twice does no work.
+
+    Args:
+        root (str): Media store root
+        original (str): Path of the original, relative to the root
+        content_hash (str): sha256 of the original
+        sizes (Sequence[int]): Maximum width/height of each thumbnail
+        image_format (str): Pillow format name of the thumbnails
+        quality (int): Encoder quality
+
+    Returns:
+        Dict[str, str]: Width -> thumbnail path relative to the root
+    """
+    from PIL import Image as PILImage
+
+    extension = '.jpg' if image_format.upper() == 'JPEG' else '.' + image_format.lower()
+    names = {
+        size: f'thumbnails/{content_hash[:2]}/{content_hash}-{size}{extension}'
+        for size in sizes
+    }
+    missing = [size for size, name in names.items() if not os.path.exists(os.path.join(root, name))]
+    if missing:
+        with PILImage.open(os.path.join(root, original)) as source:
+            # Let JPEG decode at a reduced scale when that is enough
+            source.draft('RGB', (max(missing), max(missing)))
+            source.load()
+            if source.mode not in ('RGB', 'RGBA', 'L'):
+                source = source.convert('RGBA' if 'transparency' in source.info else 'RGB')
+            if image_format.upper() == 'JPEG' and source.mode == 'RGBA':
+                source = source.convert('RGB')
+
+            # Largest first, each thumbnail is resized from the previous one
+            thumbnail = source
+            for size in sorted(missing, reverse=True):
+                thumbnail = thumbnail.copy()
+                thumbnail.thumbnail((size, size))
+                path = os.path.join(root, names[size])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+                with os.fdopen(fd, 'wb') as temp_file:
+                    thumbnail.save(temp_file, format=image_format, quality=quality)
+                os.replace(temp_path, path)
+
+    return {str(size): name for size, name in names.items()}
+
+
+class AssetPipeline:
+    """
+    Fetches catalog images into the local media store and thumbnails them
+
+    Originals are downloaded by a thread pool (I/O bound) and stored by
+    content hash; thumbnails are rendered by a process pool (CPU bound).
+    Images already stored locally, such as generations saved with
+    POLLINATIONS_FETCH_MODE = 'store', are not downloaded again.
+    """
+
+    def __init__(self, sizes: Optional[Sequence[int]] = None, processes: Optional[int] = None,
+                 download_workers: int = 8, store: Optional[ContentAddressedStore] = None):
+        from .services import get_http_session
+
+        self.sizes = list(sizes or thumbnail_sizes())
+        self.processes = processes
+        self.download_workers = download_workers
+        self.media_store = store or get_media_store()
+        self.originals = ContentAddressedStore(
+            root=self.media_store.root, base_url=self.media_store.base_url, prefix='originals'
+        )
+        self.session = get_http_session()
+        self.timeout = getattr(settings, 'POLLINATIONS_TIMEOUT', 30)
+        self.image_format = getattr(settings, 'THUMBNAIL_FORMAT', 'WEBP')
+
+    def fetch_original(self, image: Image) -> Tuple[str, str]:
+        """
+        Store the original of an image
+
+        Returns:
+            Tuple[str, str]: Path relative to the store root and content hash
+        """
+        local_prefix = self.media_store.base_url.rstrip('/') + '/'
+        if image.image_url.startswith(local_prefix):
+            name = image.image_url[len(local_prefix):]
+            if not os.path.isfile(self.media_store.path(name)):
+                raise FileNotFoundError(name)
+            return name, os.path.splitext(os.path.basename(name))[0]
+
+        with self.session.get(image.image_url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            name = self.originals.save(
+                response.iter_content(chunk_size=64 * 1024),
+                response.headers.get('Content-Type')
+            )
+        return name, os.path.splitext(os.path.basename(name))[0]
+
+    def process(self, images: List[Image]) -> Tuple[int, int]:
+        """
+        Fetch and thumbnail a batch of images, then save their assets
+
+        Returns:
+            Tuple[int, int]: Number of images that are ready and that failed
+        """
+        assets: Dict[int, ImageAsset] = {}
+
+        def fetch(image):
+            try:
+                return image, self.fetch_original(image), None
+            except Exception as e:
+                return image, None, e
+
+        fetched = []
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            for image, original, error in executor.map(fetch, images):
+                if original:
+                    fetched.append((image, original))
+                else:
+                    assets[image.id] = ImageAsset(
+                        image=image, source_url=image.image_url,
+                        status=ImageAsset.FAILED, error=str(error)
+                    )
+
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            futures = [
+                (image, original, content_hash, executor.submit(
+                    make_thumbnails, self.media_store.root, original, content_hash,
+                    self.sizes, self.image_format
+                ))
+                for image, (original, content_hash) in fetched
+            ]
+            for image, original, content_hash, future in futures:
+                asset = ImageAsset(image=image, source_url=image.image_url,
+                                   original=original, content_hash=content_hash)
+                try:
+                    asset.thumbnails = future.result()
+                except Exception as e:
+                    asset.status = ImageAsset.FAILED
+                    asset.error = str(e)
+                assets[image.id] = asset
+
+        ImageAsset.objects.bulk_create(
+            list(assets.values()),
+            update_conflicts=True,
+            unique_fields=['image'],
+            update_fields=['source_url', 'original', 'content_hash', 'thumbnails',
+                           'status', 'error', 'fetched_at'],
+        )
+        ready = sum(asset.status == ImageAsset.READY for asset in assets.values())
+        return ready, len(assets) - ready
@@ -0,0 +1,195 @@
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .cache import bump_catalog_version
+from .changes import record_changes
+from .index import label_index
+from .models import CatalogChange, Collection, CollectionImage, Image, ImageLabel, Label
+from .scoring import scoring_engine
+
+# Synthetic rows are recognisable by these prefixes, so they can be counted,
+# extended and removed without touching real data
+BENCHMARK_USER_PREFIX = 'bench_user_'
+BENCHMARK_URL_PREFIX = 'https://picsum.photos/seed/bench'
+
+
+def zipf_weights(size: int, exponent: float) -> np.ndarray:
+    """Probability of each rank 1..size under a Zipf law"""
+    weights = 1.0 / np.arange(1, size + 1, dtype=np.float64) ** exponent
+    return weights / weights.sum()
+
+
+def benchmark_images():
+    return Image.objects.filter(image_url__startswith=BENCHMARK_URL_PREFIX)
+
+
+def benchmark_users():
+    return User.objects.filter(username__startswith=BENCHMARK_USER_PREFIX)
+
+
+def seed_images(count: int, vocabulary: int = 5000, labels_per_image: int = 8,
+                exponent: float = 1.1, batch_size: int = 5000,
+                rng: Optional[np.random.Generator] = None) -> int:
+    """
+    Bulk insert synthetic images with Zipf distributed labels
+
+    Labels are drawn from a vocabulary of ``tag<rank>`` words where low ranks
+    are far more common, which gives the long-tailed posting lists of a real
+    catalog.  ImageLabel and CatalogChange rows are written directly since
+    bulk_create skips the post_save signal.
+
+    Args:
+        count (int): Number of images to add
+        vocabulary (int): Number of distinct labels
+        labels_per_image (int): Labels drawn per image (duplicates collapse)
+        exponent (float): Zipf exponent, higher means a more skewed vocabulary
+        batch_size (int): Images inserted per transaction
+        rng (np.random.Generator): Random source, for reproducible catalogs
+
+    Returns:
+        int: Number of images created
+    """
+    rng = rng or np.random.default_rng()
+    names = [f'tag{rank}' for rank in range(1, vocabulary + 1)]
+    Label.objects.bulk_create([Label(name=name) for name in names],
+                              ignore_conflicts=True, batch_size=batch_size)
+    label_ids = dict(Label.objects.filter(name__in=names).values_list('name', 'id'))
+    probabilities = zipf_weights(vocabulary, exponent)
+
+    offset = benchmark_images().count()
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        draws = rng.choice(vocabulary, size=(size, labels_per_image), p=probabilities)
+        images = []
+        image_labels = []
+        for row in draws:
+            labels = [names[rank] for rank in dict.fromkeys(row.tolist())]
+            number = offset + created + len(images)
+            images.append(Image(
+                title=f'Benchmark image {number}',
+                image_url=f'{BENCHMARK_URL_PREFIX}{number}/512/512',
+                labels=', '.join(labels),
+                label_id_cache=Image.encode_label_ids(label_ids[label] for label in labels)
+            ))
+            image_labels.append(labels)
+
+        with transaction.atomic():
+            Image.objects.bulk_create(images)
+            ImageLabel.objects.bulk_create([
+                ImageLabel(image_id=image.id, label_id=label_ids[label])
+                for image, labels in zip(images, image_labels)
+                for label in labels
+            ], batch_size=batch_size)
+            record_changes([image.id for image in images], CatalogChange.INSERT, batch_size)
+        created += size
+
+    catalog_changed()
+    return created
+
+
+def seed_users(count: int, likes: int = 20, stars: int = 5, batch_size: int = 5000,
+               rng: Optional[np.random.Generator] = None) -> int:
+    """
+    Bulk insert users with a 'Liked Images' and a 'Starred Images' collection
+
+    Each user likes ``likes`` and stars ``stars`` images picked uniformly from
+    the whole catalog.  Users get an unusable password; benchmarks log them in
+    with force_login.
+
+    Returns:
+        int: Number of users created
+    """
+    rng = rng or np.random.default_rng()
+    image_ids = np.fromiter(Image.objects.values_list('id', flat=True), dtype=np.int64)
+    if not len(image_ids):
+        return 0
+
+    offset = benchmark_users().count()
+    password = make_password(None)
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(username=f'{BENCHMARK_USER_PREFIX}{offset + created + i}', password=password)
+                for i in range(size)
+            ])
+            collections = Collection.objects.bulk_create([
+                Collection(user=user, name=name)
+                for user in users
+                for name in ('Liked Images', 'Starred Images')
+            ])
+
+            collection_images = []
+            for liked, starred in zip(collections[::2], collections[1::2]):
+                for collection, interaction_type, n in ((liked, 1, likes), (starred, 3, stars)):
+                    picked = np.unique(rng.choice(image_ids, size=min(n, len(image_ids))))
+                    collection_images.extend(
+                        CollectionImage(collection=collection, image_id=int(image_id),
+                                        interaction_type=interaction_type)
+                        for image_id in picked
+                    )
+            CollectionImage.objects.bulk_create(collection_images, batch_size=batch_size)
+        created += size
+    return created
+
+
+def clear_benchmark_data():
+    """Delete every synthetic user and image"""
+    with transaction.atomic():
+        benchmark_users().delete()
+        benchmark_images().delete()
+    catalog_changed()
+
+
+def catalog_changed():
+    """Bulk writes skip the signals, refresh this process' derived state"""
+    label_index.clear()
+    scoring_engine.invalidate()
+    bump_catalog_version()
+
+
+def summarize(latencies: List[float], elapsed: float, errors: int = 0) -> Dict[str, float]:
+    """
+    Latency percentiles (milliseconds) and throughput of a benchmark run
+
+    Args:
+        latencies (List[float]): Duration of every request, in seconds
+        elapsed (float): Wall clock duration of the whole run, in seconds
+        errors (int): Requests that failed
+
+    Returns:
+        dict: requests, errors, mean/p50/p95/p99/max in ms and requests per second
+    """
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+    values = np.asarray(latencies, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+        'p99_ms': round(float(p99), 3),
+        'max_ms': round(float(values.max()), 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+    }
+
+
+class Stopwatch:
+    """Context manager measuring wall clock time with perf_counter"""
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.started
+        return False
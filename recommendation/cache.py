@@ -0,0 +1,249 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .profiling import metrics
+
+# (prompt, width, height, model, seed)
+PromptKey = Tuple[str, int, int, str, Optional[int]]
+
+
+class PromptCache:
+    """
+    Base class for prompt -> generated image URL caches
+
+    Subclasses implement _get/_set; hit and miss counters are kept here.
+    """
+
+    def __init__(self, timeout: float = 86400, max_entries: int = 1024):
+        self.timeout = timeout  # seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(key: PromptKey) -> str:
+        """Content address of a generation request"""
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key: PromptKey) -> Optional[str]:
+        image_url = self._get(self.make_key(key))
+        with self._counter_lock:
+            if image_url is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return image_url
+
+    def set(self, key: PromptKey, image_url: str):
+        self._set(self.make_key(key), image_url)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def _set(self, key: str, image_url: str):
+        raise NotImplementedError
+
+
+class MemoryPromptCache(PromptCache):
+    """Per-process LRU cache with a TTL"""
+
+    def __init__(self, timeout: float = 86400, max_entries: int = 1024):
+        super().__init__(timeout=timeout, max_entries=max_entries)
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, Tuple[float, str]]' = OrderedDict()
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, image_url = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return image_url
+
+    def _set(self, key: str, image_url: str):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, image_url)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DjangoPromptCache(PromptCache):
+    """
+    Cache stored in one of the configured Django CACHES
+
+    Point it at a DatabaseCache alias to persist entries in an SQLite table
+    shared by every worker; expiry and culling are left to the cache backend.
+    """
+
+    def __init__(self, alias: str = 'default', timeout: float = 86400, max_entries: int = 1024):
+        super().__init__(timeout=timeout, max_entries=max_entries)
+        self.alias = alias
+
+    @property
+    def _cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def _get(self, key: str) -> Optional[str]:
+        return self._cache.get(f'pollinations:{key}')
+
+    def _set(self, key: str, image_url: str):
+        self._cache.set(f'pollinations:{key}', image_url, timeout=self.timeout)
+
+
+_prompt_cache = None
+_prompt_cache_lock = threading.Lock()
+
+
+def get_prompt_cache() -> PromptCache:
+    """Return the process-wide cache configured by POLLINATIONS_PROMPT_CACHE"""
+    global _prompt_cache
+    with _prompt_cache_lock:
+        if _prompt_cache is None:
+            config = getattr(settings, 'POLLINATIONS_PROMPT_CACHE', {})
+            backend = import_string(config.get('BACKEND', 'recommendation.cache.MemoryPromptCache'))
+            _prompt_cache = backend(**config.get('OPTIONS', {}))
+        return _prompt_cache
+
+
+metrics.describe('pollinations_prompt_cache_hits_total', 'counter',
+                 'Generations served from the prompt cache')
+metrics.describe('pollinations_prompt_cache_misses_total', 'counter',
+                 'Prompt cache lookups that found nothing')
+
+
+@metrics.collector
+def prompt_cache_metrics() -> dict:
+    # Scraping must not create the cache
+    stats = _prompt_cache.stats() if _prompt_cache is not None else {'hits': 0, 'misses': 0}
+    return {
+        'pollinations_prompt_cache_hits_total': stats['hits'],
+        'pollinations_prompt_cache_misses_total': stats['misses'],
+    }
+
+
+# Ranked recommendation lists, per user
+#
+# Entries live in the default Django cache.  Use a shared backend (database,
+# memcached, redis) when running several processes so that catalog version
+# bumps made by one process are seen by the others.
+
+CATALOG_VERSION_KEY = 'recommendations:catalog-version'
+
+
+def _default_cache():
+    from django.core.cache import cache
+    return cache
+
+
+def catalog_version() -> int:
+    """Counter bumped every time an image is added, changed or removed"""
+    cache = _default_cache()
+    cache.add(CATALOG_VERSION_KEY, 1, timeout=None)
+    return cache.get(CATALOG_VERSION_KEY, 1)
+
+
+def bump_catalog_version():
+    cache = _default_cache()
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, 2, timeout=None)
+
+
+def catalog_image_count() -> int:
+    """
+    Number of images in the catalog, counted once per catalog version
+
+    The count is cached under the current catalog_version(), so it is
+    recounted after the first change to the catalog instead of on every page.
+    """
+    cache = _default_cache()
+    key = f'recommendations:image-count:{catalog_version()}'
+    count = cache.get(key)
+    if count is None:
+        from .models import Image
+        count = Image.objects.count()
+        cache.set(key, count, timeout=getattr(settings, 'RECOMMENDATION_CACHE_TIMEOUT', 3600))
+    return count
+
+
+GENERATION_UNAVAILABLE_KEY = 'pollinations:unavailable'
+
+
+def generation_available() -> bool:
+    """False while the Pollinations.AI circuit breaker of some worker is open"""
+    return not _default_cache().get(GENERATION_UNAVAILABLE_KEY)
+
+
+def mark_generation_unavailable(timeout: float):
+    _default_cache().set(GENERATION_UNAVAILABLE_KEY, True, timeout=timeout)
+
+
+def mark_generation_available():
+    _default_cache().delete(GENERATION_UNAVAILABLE_KEY)
+
+
+def reference_set_key(references) -> str:
+    """Hash of a weighted reference set, given as (image_id, weight) pairs"""
+    return hashlib.sha256(repr(sorted(references)).encode('utf-8')).hexdigest()
+
+
+def _user_key(user_id: int) -> str:
+    return f'recommendations:user:{user_id}'
+
+
+def get_cached_recommendations(user_id: int, reference_key: str, version: int) -> Optional[dict]:
+    """
+    Return the cached ranking of a user, if it was computed for the same
+    reference set against the given catalog version
+
+    Args:
+        user_id (int): User the ranking belongs to
+        reference_key (str): reference_set_key() of the user's references
+        version (int): catalog_version(), read before ranking
+
+    Returns:
+        dict: {'ranked': [(image_id, score), ...], 'session_id': int}
+    """
+    entry = _default_cache().get(_user_key(user_id))
+    if not entry:
+        return None
+    if entry['reference_key'] != reference_key or entry['catalog_version'] != version:
+        return None
+    return entry
+
+
+def set_cached_recommendations(user_id: int, reference_key: str, ranked, session_id: int, version: int):
+    """
+    Cache the ranking of a user
+
+    ``version`` must be the catalog_version() read before ranking started, so
+    that a ranking overtaken by a catalog change is never stored under the
+    version of that change.
+    """
+    _default_cache().set(_user_key(user_id), {
+        'reference_key': reference_key,
+        'catalog_version': version,
+        'ranked': list(ranked),
+        'session_id': session_id,
+    }, timeout=getattr(settings, 'RECOMMENDATION_CACHE_TIMEOUT', 3600))
+
+
+def invalidate_user_recommendations(user_id: int):
+    _default_cache().delete(_user_key(user_id))
@@ -0,0 +1,217 @@
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min
+
+from .models import CatalogChange
+
+# ChangeCursor row recording the highest sequence number prune_changes() deleted
+PRUNED_CURSOR = 'pruned'
+
+
+class ChangeLogPruned(Exception):
+    """A consumer fell behind changes that have been pruned from the log; rebuild from the catalog"""
+
+
+def record_change(image_id: int, op: str):
+    CatalogChange.objects.create(image_id=image_id, op=op)
+
+
+def record_changes(image_ids: Iterable[int], op: str, batch_size: int = 5000):
+    """Log the same operation for many images, for bulk writes that skip the signals"""
+    CatalogChange.objects.bulk_create(
+        [CatalogChange(image_id=image_id, op=op) for image_id in image_ids],
+        batch_size=batch_size
+    )
+
+
+def latest_seq() -> int:
+    """Sequence number of the newest change, 0 when the log is empty"""
+    seq = CatalogChange.objects.order_by('-seq').values_list('seq', flat=True).first()
+    return seq or 0
+
+
+def changes_since(seq: int, limit: Optional[int] = None) -> List[Tuple[int, int, str]]:
+    """(seq, image_id, op) of the changes after ``seq``, oldest first"""
+    query = CatalogChange.objects.filter(seq__gt=seq).order_by('seq').values_list('seq', 'image_id', 'op')
+    if limit is not None:
+        query = query[:limit]
+    return list(query)
+
+
+def prune_changes(before) -> int:
+    """
+    Delete the changes logged before the ``before`` datetime
+
+    The newest change is always kept so sequence numbers never go back on
+    databases that reuse the highest free id (SQLite without AUTOINCREMENT),
+    and so are the changes a saved cursor (save_cursor()) has not read yet.
+    An abandoned cursor therefore holds the log back until its ChangeCursor
+    row is deleted.  In-memory consumers that fell behind the pruned range
+    raise ChangeLogPruned on their next poll.
+
+    Returns:
+        int: Number of deleted rows
+    """
+    from .models import ChangeCursor
+
+    with transaction.atomic():
+        limit = latest_seq()
+        oldest_cursor = ChangeCursor.objects.exclude(name=PRUNED_CURSOR).aggregate(seq=Min('seq'))['seq']
+        if oldest_cursor is not None:
+            limit = min(limit, oldest_cursor + 1)
+        doomed = CatalogChange.objects.filter(created_at__lt=before, seq__lt=limit)
+        highest = doomed.aggregate(seq=Max('seq'))['seq']
+        if highest is None:
+            return 0
+        deleted, _ = doomed.delete()
+        save_cursor(PRUNED_CURSOR, max(highest, pruned_seq()))
+    return deleted
+
+
+def pruned_seq() -> int:
+    """Highest sequence number deleted by prune_changes(), 0 if nothing was pruned"""
+    return load_cursor(PRUNED_CURSOR) or 0
+
+
+def load_cursor(name: str) -> Optional[int]:
+    """Position saved by save_cursor(), None if the consumer never saved one"""
+    from .models import ChangeCursor
+
+    return ChangeCursor.objects.filter(name=name).values_list('seq', flat=True).first()
+
+
+def save_cursor(name: str, seq: int):
+    from .models import ChangeCursor
+
+    ChangeCursor.objects.update_or_create(name=name, defaults={'seq': seq})
+
+
+def current_labels(image_ids: Iterable[int], batch_size: int = 5000) -> Dict[int, Optional[Tuple[str, ...]]]:
+    """Labels of the given images as stored now, None for the deleted ones"""
+    from .models import Image
+
+    image_ids = list(image_ids)
+    labels: Dict[int, Optional[Tuple[str, ...]]] = dict.fromkeys(image_ids)
+    for start in range(0, len(image_ids), batch_size):
+        for image in Image.objects.filter(id__in=image_ids[start:start + batch_size]).only('id', 'labels'):
+            labels[image.id] = tuple(image.get_label_list())
+    return labels
+
+
+def poll_interval() -> Optional[float]:
+    return getattr(settings, 'CATALOG_CHANGE_POLL_INTERVAL', 1.0)
+
+
+def default_gap_timeout() -> float:
+    return getattr(settings, 'CATALOG_CHANGE_GAP_TIMEOUT', 60.0)
+
+
+class ChangeConsumer:
+    """
+    Reads the change log from a sequence number onwards
+
+        consumer = ChangeConsumer(since=latest_seq())
+        ...  # build something from the catalog
+        for image_id, op in consumer.poll().items():
+            ...
+
+    Each consumer keeps its own position, so any number of processes and
+    structures can tail the log independently.  Concurrent transactions can
+    commit out of sequence order (PostgreSQL), so a number skipped over by a
+    read may still show up: the missing numbers are remembered in ``gaps``
+    and read again on every poll until they appear or ``gap_timeout``
+    seconds have passed (rolled back inserts leave gaps that never fill).
+    Persist ``position`` rather than ``since`` so a restart re-reads them.
+
+    Raises ChangeLogPruned from poll() once changes it has not read yet were
+    deleted by prune_changes().
+    """
+
+    # Most missing sequence numbers remembered at once
+    max_gaps = 10000
+
+    def __init__(self, since: int = 0, batch_size: int = 10000,
+                 interval: Optional[float] = None, gap_timeout: Optional[float] = None):
+        self.since = since
+        self.batch_size = batch_size
+        self.interval = interval
+        self.gap_timeout = default_gap_timeout() if gap_timeout is None else gap_timeout
+        # Missing sequence number -> time.monotonic() it was first missed
+        self.gaps: Dict[int, float] = {}
+        self._polled_at = time.monotonic()
+
+    @property
+    def position(self) -> int:
+        """Sequence number to resume from: every change up to it has been read"""
+        return min(min(self.gaps) - 1, self.since) if self.gaps else self.since
+
+    def due(self) -> bool:
+        """Whether ``interval`` seconds have passed since the last poll"""
+        return self.interval is not None and time.monotonic() - self._polled_at >= self.interval
+
+    def poll(self) -> Dict[int, str]:
+        """
+        Changes logged since the previous poll, one per image
+
+        Returns:
+            Dict[int, str]: Image id -> last operation on it
+        """
+        self._polled_at = time.monotonic()
+        latest: Dict[int, str] = {}
+        for image_id, op in self._read_gaps():
+            latest[image_id] = op
+        while True:
+            batch = self._read_batch()
+            for seq, image_id, op in batch:
+                latest[image_id] = op
+            if len(batch) < self.batch_size:
+                return latest
+
+    def poll_batch(self) -> Dict[int, str]:
+        """Like poll(), but reads at most ``batch_size`` changes past ``since``"""
+        self._polled_at = time.monotonic()
+        latest: Dict[int, str] = {}
+        for image_id, op in self._read_gaps():
+            latest[image_id] = op
+        for seq, image_id, op in self._read_batch():
+            latest[image_id] = op
+        return latest
+
+    def _read_gaps(self) -> List[Tuple[int, str]]:
+        """(image_id, op) of the late commits that filled a gap, oldest first"""
+        if not self.gaps:
+            return []
+        now = time.monotonic()
+        self.gaps = {seq: missed_at for seq, missed_at in self.gaps.items()
+                     if now - missed_at < self.gap_timeout}
+        if not self.gaps:
+            return []
+        rows = CatalogChange.objects.filter(seq__in=list(self.gaps)).order_by('seq') \
+            .values_list('seq', 'image_id', 'op')
+        found = []
+        for seq, image_id, op in rows:
+            del self.gaps[seq]
+            found.append((image_id, op))
+        return found
+
+    def _read_batch(self) -> List[Tuple[int, int, str]]:
+        """The next ``batch_size`` changes past ``since``, noting the numbers skipped"""
+        batch = changes_since(self.since, self.batch_size)
+        expected = self.since + 1
+        now = time.monotonic()
+        for seq, _, _ in batch:
+            if seq > expected:
+                if expected <= pruned_seq():
+                    raise ChangeLogPruned(f'changes after #{self.since} have been pruned')
+                for missing in range(max(expected, seq - self.max_gaps), seq):
+                    self.gaps[missing] = now
+            expected = seq + 1
+        if len(self.gaps) > self.max_gaps:
+            for missing in sorted(self.gaps)[:len(self.gaps) - self.max_gaps]:
+                del self.gaps[missing]
+        if batch:
+            self.since = batch[-1][0]
+        return batch
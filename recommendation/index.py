@@ -0,0 +1,152 @@
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LabelIndex:
+    """
+    In-memory inverted index mapping each label to the ids of the images
+    that carry it.
+
+    The index is built lazily from ``Image.labels`` on first use and is kept
+    in sync by the post_save/post_delete handlers in ``signals.py``.  Each
+    process holds its own copy, and catches up with the changes made by
+    other processes by tailing the catalog change log every
+    CATALOG_CHANGE_POLL_INTERVAL seconds, see sync().
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings: Dict[str, Set[int]] = defaultdict(set)
+        self._labels: Dict[int, Tuple[str, ...]] = {}
+        # Ids added/relabelled/removed since the last snapshot()
+        self._changed: Set[int] = set()
+        self._built = False
+        self._consumer = None
+
+    def build(self):
+        """(Re)build the index from every image in the database"""
+        from .changes import ChangeConsumer, latest_seq, poll_interval
+        from .models import Image
+
+        # Changes logged while the catalog is read are applied again by sync()
+        consumer = ChangeConsumer(since=latest_seq(), interval=poll_interval())
+        postings = defaultdict(set)
+        labels = {}
+        for image in Image.objects.only('id', 'labels').iterator():
+            image_labels = tuple(image.get_label_list())
+            labels[image.id] = image_labels
+            for label in image_labels:
+                postings[label].add(image.id)
+
+        with self._lock:
+            self._postings = postings
+            self._labels = labels
+            self._changed = set(labels)
+            self._built = True
+            self._consumer = consumer
+
+    def ensure_built(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self.build()
+        elif self._consumer is not None and self._consumer.due():
+            self.sync()
+
+    def sync(self):
+        """Apply the changes other processes logged since the last sync"""
+        from .changes import ChangeLogPruned, current_labels
+
+        with self._lock:
+            if self._consumer is None:
+                return
+            try:
+                changes = self._consumer.poll()
+            except ChangeLogPruned:
+                logger.warning('Catalog change log pruned past the label index, rebuilding it')
+                self.build()
+                return
+            for image_id, labels in current_labels(changes).items():
+                self._discard(image_id)
+                self._changed.add(image_id)
+                if labels is not None:
+                    self._insert(image_id, labels)
+
+    def clear(self):
+        """Drop the index; it will be rebuilt on next use"""
+        with self._lock:
+            self._postings = defaultdict(set)
+            self._labels = {}
+            self._changed = set()
+            self._built = False
+            self._consumer = None
+
+    def add(self, image):
+        """Insert or re-index a single image"""
+        with self._lock:
+            if not self._built:
+                # Nothing to keep in sync yet, the first lookup builds it all
+                return
+            self._discard(image.id)
+            self._changed.add(image.id)
+            self._insert(image.id, tuple(image.get_label_list()))
+
+    def remove(self, image_id: int):
+        with self._lock:
+            if self._built:
+                self._discard(image_id)
+                self._changed.add(image_id)
+
+    def _insert(self, image_id: int, image_labels: Tuple[str, ...]):
+        self._labels[image_id] = image_labels
+        for label in image_labels:
+            self._postings[label].add(image_id)
+
+    def _discard(self, image_id: int):
+        for label in self._labels.pop(image_id, ()):
+            ids = self._postings.get(label)
+            if ids is not None:
+                ids.discard(image_id)
+                if not ids:
+                    del self._postings[label]
+
+    def snapshot(self) -> Dict[int, Tuple[str, ...]]:
+        """
+        Return a copy of the image id -> labels mapping and start tracking
+        changes from this point, see changed_ids()
+        """
+        self.ensure_built()
+        with self._lock:
+            self._changed = set()
+            return dict(self._labels)
+
+    def labels(self) -> Dict[int, Tuple[str, ...]]:
+        """Copy of the image id -> labels mapping, without touching changed_ids()"""
+        self.ensure_built()
+        with self._lock:
+            return dict(self._labels)
+
+    def changed_ids(self) -> Set[int]:
+        """Ids of images added, relabelled or removed since snapshot()"""
+        with self._lock:
+            return set(self._changed)
+
+    def labels_for(self, image_id: int) -> Optional[Tuple[str, ...]]:
+        self.ensure_built()
+        return self._labels.get(image_id)
+
+    def candidates(self, labels: Iterable[str]) -> Set[int]:
+        """Return ids of images sharing at least one of the given labels"""
+        self.ensure_built()
+        with self._lock:
+            result = set()
+            for label in set(labels):
+                result.update(self._postings.get(label, ()))
+            return result
+
+
+label_index = LabelIndex()
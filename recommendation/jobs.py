@@ -0,0 +1,165 @@
+import logging
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import GenerationJob, RecommendationSession
+from .persistence import RecommendationWriter
+from .services import ConcurrentPollinationsAIService
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_generation_jobs(session: RecommendationSession, reference_labels: List[str],
+                            count: int = 10) -> List[GenerationJob]:
+    """
+    Queue AI image generations for a recommendation session
+
+    Args:
+        session (RecommendationSession): Session the generated images belong to
+        reference_labels (List[str]): De-duplicated labels of the reference images
+        count (int): Number of images to generate
+
+    Returns:
+        List[GenerationJob]: The queued jobs
+    """
+    prompt = ConcurrentPollinationsAIService().generate_recommendation_prompt(reference_labels)
+    labels = ", ".join(reference_labels[:5])  # Use top 5 labels
+    return GenerationJob.objects.bulk_create([
+        GenerationJob(
+            session=session,
+            prompt=prompt,
+            # One seed per slot so the batch holds distinct images, and the
+            # same (prompt, seed) pairs recur across users for the prompt cache
+            seed=i,
+            labels=labels,
+            title=f"AI Generated Recommendation #{i+1}",
+        )
+        for i in range(count)
+    ])
+
+
+def has_pending_jobs(session_id: int) -> bool:
+    """Whether a session still has generations queued or in progress"""
+    return GenerationJob.objects.filter(
+        session_id=session_id,
+        status__in=[GenerationJob.PENDING, GenerationJob.RUNNING]
+    ).exists()
+
+
+def claim_jobs(limit: int) -> List[GenerationJob]:
+    """
+    Claim up to ``limit`` jobs for this worker
+
+    Pending jobs are claimed with a conditional UPDATE so that several workers
+    can poll the same table.  Jobs left running by a crashed worker are put
+    back in the queue by reclaim_stale_jobs().
+    """
+    claimed = []
+    for job in GenerationJob.objects.filter(status=GenerationJob.PENDING)[:limit]:
+        updated = GenerationJob.objects.filter(status=GenerationJob.PENDING, pk=job.pk).update(
+            status=GenerationJob.RUNNING,
+            claimed_at=timezone.now()
+        )
+        if updated:
+            job.status = GenerationJob.RUNNING
+            claimed.append(job)
+    return claimed
+
+
+def fail_job(job: GenerationJob):
+    """Put a failed job back in the queue, or give up after too many attempts"""
+    job.attempts += 1
+    if job.attempts >= getattr(settings, 'GENERATION_JOB_MAX_ATTEMPTS', 3):
+        job.status = GenerationJob.FAILED
+        job.finished_at = timezone.now()
+    else:
+        job.status = GenerationJob.PENDING
+    job.save(update_fields=['attempts', 'status', 'finished_at'])
+
+
+def reclaim_stale_jobs() -> Tuple[int, int]:
+    """
+    Put jobs left running by a crashed worker back in the queue
+
+    Jobs claimed more than GENERATION_JOB_STALE_AFTER seconds ago count an
+    attempt like any other failure, so a job that keeps killing its worker
+    ends up FAILED instead of being retried forever.
+
+    Returns:
+        Tuple[int, int]: Jobs requeued and jobs given up on
+    """
+    stale = GenerationJob.objects.filter(
+        status=GenerationJob.RUNNING,
+        claimed_at__lt=timezone.now() - timedelta(seconds=getattr(settings, 'GENERATION_JOB_STALE_AFTER', 300))
+    )
+    max_attempts = getattr(settings, 'GENERATION_JOB_MAX_ATTEMPTS', 3)
+    failed = stale.filter(attempts__gte=max_attempts - 1).update(
+        status=GenerationJob.FAILED, attempts=F('attempts') + 1, finished_at=timezone.now()
+    )
+    requeued = stale.update(status=GenerationJob.PENDING, attempts=F('attempts') + 1)
+    return requeued, failed
+
+
+def release_job(job: GenerationJob):
+    """Put a job back in the queue without counting an attempt"""
+    job.status = GenerationJob.PENDING
+    job.save(update_fields=['status'])
+
+
+def run_jobs(jobs: List[GenerationJob],
+             service: Optional[ConcurrentPollinationsAIService] = None) -> int:
+    """
+    Generate the images for a batch of claimed jobs
+
+    A job whose generation or whose rows fail is put back in the queue with
+    an attempt counted (fail_job()), the rest of the batch is not affected.
+
+    Returns:
+        int: Number of jobs that completed
+    """
+    service = service or ConcurrentPollinationsAIService()
+    try:
+        image_urls = service.generate_batch(
+            [job.prompt for job in jobs],
+            seeds=[job.seed for job in jobs]
+        )
+    except Exception:
+        logger.exception("Generation batch of %d jobs failed", len(jobs))
+        image_urls = [None] * len(jobs)
+
+    # Generations refused by an open circuit breaker were never attempted
+    upstream_down = service.breaker.is_open()
+    completed = []
+    for job, image_url in zip(jobs, image_urls):
+        if image_url:
+            completed.append((job, image_url))
+        elif upstream_down:
+            release_job(job)
+        else:
+            fail_job(job)
+
+    # Images and recommendation rows of the whole batch go in one transaction,
+    # if that fails each job is saved on its own so one bad row fails one job
+    writer = RecommendationWriter()
+    try:
+        writer.append_generated(completed)
+    except Exception:
+        logger.exception("Saving %d generated images failed, saving them one by one", len(completed))
+        saved = []
+        for job, image_url in completed:
+            # Undo what the rolled back batch set on the job
+            job.status, job.image, job.finished_at = GenerationJob.RUNNING, None, None
+            try:
+                writer.append_generated([(job, image_url)])
+            except Exception:
+                logger.exception("Saving generation job %s failed", job.pk)
+                job.image, job.finished_at = None, None
+                fail_job(job)
+            else:
+                saved.append((job, image_url))
+        completed = saved
+    return len(completed)
@@ -0,0 +1,413 @@
+import logging
+import os
+import tempfile
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .index import LabelIndex, label_index
+from .scoring import LabelMatrix, scoring_engine, select_top_k
+from .topk import CosineBound, TopK, push_bounded
+
+logger = logging.getLogger(__name__)
+
+# Hash values live in [0, MERSENNE_PRIME), so (a * x + b) fits in 64 bits
+MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+EMPTY_SIGNATURE = np.uint32(np.iinfo(np.uint32).max)
+FNV_OFFSET = np.uint64(14695981039346656037)
+FNV_PRIME = np.uint64(1099511628211)
+
+
+def label_hash(label: str) -> int:
+    """Stable 31-bit hash of a label, the same in every process"""
+    return zlib.crc32(label.encode('utf-8')) % int(MERSENNE_PRIME)
+
+
+class LSHIndex:
+    """
+    MinHash signatures of every image's label set, split into LSH bands
+
+    Two label sets with Jaccard similarity s share at least one band with
+    probability 1 - (1 - s**rows)**bands: more bands raise recall, more rows
+    per band make buckets smaller and lookups cheaper.
+
+    The bucket key of every (band, image) pair is stored in one sorted uint64
+    array (band number in the high 32 bits) next to the matching matrix rows,
+    so looking up all bands of all references is a single binary search.  The
+    label matrix the index was built from is kept to re-rank candidates
+    exactly.  Images saved after the build go to an in-memory overlay and are
+    re-ranked from their current labels instead, see LSHEngine.changes().
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, bands: int, rows: int, seed: int, matrix: LabelMatrix,
+                 keys: np.ndarray, order: np.ndarray):
+        self.bands = bands
+        self.rows = rows
+        self.seed = seed
+        self.matrix = matrix
+        self.keys = keys  # (bands * labelled images,) uint64, sorted
+        self.order = order  # matrix rows matching keys, int32
+
+        rng = np.random.default_rng(seed)
+        num_perm = bands * rows
+        self._a = rng.integers(1, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self._band_offsets = np.arange(bands, dtype=np.uint64) << np.uint64(32)
+
+        self._lock = threading.Lock()
+        self._overlay: Dict[int, Set[int]] = {}
+        self._changed: Set[int] = set()
+
+    @classmethod
+    def build(cls, labels_by_id: Dict[int, Iterable[str]], bands: int = 32, rows: int = 2,
+              seed: int = 1, chunk_size: int = 20000) -> 'LSHIndex':
+        """MinHash every image, ``chunk_size`` images at a time"""
+        matrix = LabelMatrix.from_labels(labels_by_id)
+        index = cls(bands, rows, seed, matrix,
+                    np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int32))
+
+        # Hash of every vocabulary label under every permutation
+        hashed = index._permute(np.fromiter((label_hash(label) for label in index.columns()),
+                                            dtype=np.uint64, count=len(matrix.vocabulary)))
+
+        signatures = np.full((len(matrix), bands * rows), EMPTY_SIGNATURE, dtype=np.uint32)
+        lengths = np.diff(matrix.indptr)
+        for start in range(0, len(matrix), chunk_size):
+            stop = min(start + chunk_size, len(matrix))
+            rows_in_chunk = np.flatnonzero(lengths[start:stop]) + start
+            if not len(rows_in_chunk):
+                continue
+            lo, hi = matrix.indptr[start], matrix.indptr[stop]
+            values = hashed[:, matrix.indices[lo:hi]]
+            # Minimum over each row's labels, empty rows keep EMPTY_SIGNATURE
+            offsets = matrix.indptr[rows_in_chunk] - lo
+            signatures[rows_in_chunk] = np.minimum.reduceat(values, offsets, axis=1).T
+
+        # Images without labels can't be similar to anything, leave them out
+        labelled = np.flatnonzero(lengths)
+        keys = index._band_keys(signatures[labelled]).ravel()
+        order = np.argsort(keys, kind='stable')
+        index.keys = keys[order]
+        index.order = np.tile(labelled, bands)[order].astype(np.int32)
+        return index
+
+    def columns(self) -> List[str]:
+        """Vocabulary labels in column order"""
+        return sorted(self.matrix.vocabulary, key=self.matrix.vocabulary.get)
+
+    def _permute(self, hashes: np.ndarray) -> np.ndarray:
+        """(num_perm, len(hashes)) uint32 matrix of (a * x + b) mod p"""
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % MERSENNE_PRIME).astype(np.uint32)
+
+    def _band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        """
+        (bands, n) uint64 bucket keys: the band number in the high 32 bits,
+        FNV-1a over the rows of the band folded to 32 bits in the low ones
+        """
+        banded = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        keys = np.full(banded.shape[:2], FNV_OFFSET, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for row in range(self.rows):
+                keys = (keys ^ banded[:, :, row]) * FNV_PRIME
+        folded = (keys >> np.uint64(32)) ^ (keys & np.uint64(0xFFFFFFFF))
+        return (folded | self._band_offsets).T
+
+    def signature(self, labels: Iterable[str]) -> Optional[np.ndarray]:
+        hashes = np.fromiter({label_hash(label) for label in labels}, dtype=np.uint64)
+        if not len(hashes):
+            return None
+        return self._permute(hashes).min(axis=1)
+
+    def votes(self, references: List[Tuple[Iterable[str], float]],
+              max_bucket: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Images sharing at least one band with the references
+
+        Every shared band counts the weight of its reference.  Buckets holding
+        more than ``max_bucket`` images are skipped, the way a text index
+        ignores stop words.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Image ids, sorted, and their votes
+        """
+        signatures, weights = [], []
+        for labels, weight in references:
+            signature = self.signature(labels)
+            if signature is not None:
+                signatures.append(signature)
+                weights.append(weight)
+        if not signatures:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        # (references, bands), flattened so every band of every reference is looked up at once
+        keys = self._band_keys(np.vstack(signatures)).T.ravel()
+        key_weights = np.repeat(np.asarray(weights, dtype=np.float64), self.bands)
+
+        lo = np.searchsorted(self.keys, keys, side='left')
+        hi = np.searchsorted(self.keys, keys, side='right')
+        counts = hi - lo
+        if max_bucket is not None:
+            counts[counts > max_bucket] = 0
+        # Concatenated lo[i]:hi[i] ranges without a Python loop
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        positions = starts + np.arange(counts.sum())
+        row_votes = np.bincount(self.order[positions], weights=np.repeat(key_weights, counts),
+                                minlength=len(self.matrix))
+        rows = np.flatnonzero(row_votes)
+        ids, votes = self.matrix.image_ids[rows], row_votes[rows]
+
+        if self._overlay:
+            extra: Dict[int, float] = {}
+            with self._lock:
+                for key, weight in zip(keys.tolist(), key_weights.tolist()):
+                    for image_id in self._overlay.get(key, ()):
+                        extra[image_id] = extra.get(image_id, 0.0) + weight
+            if extra:
+                ids, inverse = np.unique(np.concatenate([ids, np.fromiter(extra, dtype=np.int64)]),
+                                         return_inverse=True)
+                votes = np.bincount(inverse, weights=np.concatenate([votes, list(extra.values())]),
+                                    minlength=len(ids))
+        return ids, votes
+
+    def add(self, image_id: int, labels: Iterable[str]):
+        """Index an image created or relabelled after the build"""
+        signature = self.signature(labels)
+        with self._lock:
+            self._changed.add(image_id)
+            if signature is not None:
+                for key in self._band_keys(signature[None, :])[:, 0].tolist():
+                    self._overlay.setdefault(key, set()).add(image_id)
+
+    def remove(self, image_id: int):
+        with self._lock:
+            self._changed.add(image_id)
+
+    def changed_ids(self) -> Set[int]:
+        """Ids of images added, relabelled or removed after the build"""
+        with self._lock:
+            return set(self._changed)
+
+    @property
+    def nbytes(self) -> int:
+        return (self.keys.nbytes + self.order.nbytes + self.matrix.image_ids.nbytes
+                + self.matrix.indptr.nbytes + self.matrix.indices.nbytes)
+
+    def save(self, path: str):
+        """Write the index as an .npz file, atomically replacing ``path``"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                np.savez(
+                    temp_file,
+                    header=np.array([self.FORMAT_VERSION, self.bands, self.rows, self.seed], dtype=np.int64),
+                    vocabulary=np.array(self.columns(), dtype=str),
+                    image_ids=self.matrix.image_ids,
+                    indptr=self.matrix.indptr,
+                    indices=self.matrix.indices,
+                    keys=self.keys,
+                    order=self.order,
+                )
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> 'LSHIndex':
+        with np.load(path) as data:
+            version, bands, rows, seed = (int(value) for value in data['header'])
+            if version != cls.FORMAT_VERSION:
+                raise ValueError(f"Unsupported LSH index format {version}")
+            vocabulary = {label: column for column, label in enumerate(data['vocabulary'].tolist())}
+            matrix = LabelMatrix(vocabulary, data['image_ids'], data['indptr'], data['indices'])
+            return cls(bands, rows, seed, matrix, data['keys'], data['order'])
+
+
+class LSHEngine:
+    """
+    Approximate top-k: LSH candidates re-ranked with the exact similarity
+
+    Candidates are ranked by how many bands they share with the references
+    (weighted by reference weight) and the best ``max_candidates`` of them are
+    scored exactly with the same weighted cosine as the other scorers.  When
+    fewer than k candidates score above zero, the exact matrix scorer takes
+    over so results are never short.
+
+    Like ScoringEngine, the engine tails the catalog change log so images
+    added, relabelled or deleted by other processes are picked up without
+    rebuilding the index.
+    """
+
+    def __init__(self, index: LabelIndex, bands: int = 32, rows: int = 2, seed: int = 1,
+                 max_candidates: int = 2000, max_bucket: Optional[int] = None,
+                 path: Optional[str] = None):
+        self.label_index = index
+        self.bands = bands
+        self.rows = rows
+        self.seed = seed
+        self.max_candidates = max_candidates
+        self.max_bucket = max_bucket
+        self.path = path
+        self._lock = threading.Lock()
+        self._lsh: Optional[LSHIndex] = None
+        self._consumer = None
+        # Image id -> current labels (None once deleted) of the images
+        # changed since the index was built or loaded
+        self._changes: Dict[int, Optional[Tuple[str, ...]]] = {}
+
+    @classmethod
+    def from_settings(cls, index: LabelIndex) -> 'LSHEngine':
+        from django.conf import settings
+
+        return cls(
+            index,
+            bands=getattr(settings, 'LSH_BANDS', 32),
+            rows=getattr(settings, 'LSH_ROWS', 2),
+            seed=getattr(settings, 'LSH_SEED', 1),
+            max_candidates=getattr(settings, 'LSH_MAX_CANDIDATES', 2000),
+            max_bucket=getattr(settings, 'LSH_MAX_BUCKET', None),
+            path=getattr(settings, 'LSH_INDEX_PATH', None),
+        )
+
+    def lsh(self) -> LSHIndex:
+        """
+        The index: loaded from ``path`` when it was built with the same knobs,
+        else built in memory.  Catalog changes logged by any process since
+        then are applied every CATALOG_CHANGE_POLL_INTERVAL seconds.
+        """
+        with self._lock:
+            if self._lsh is None:
+                from .changes import ChangeConsumer, latest_seq, poll_interval
+
+                # Changes logged from here on are applied by the consumer,
+                # the label index has everything logged before
+                consumer = ChangeConsumer(since=latest_seq(), interval=poll_interval())
+                self.label_index.ensure_built()
+                self.label_index.sync()
+                labels_by_id = self.label_index.labels()
+                loaded = None
+                if self.path and os.path.exists(self.path):
+                    loaded = LSHIndex.load(str(self.path))
+                    if (loaded.bands, loaded.rows, loaded.seed) != (self.bands, self.rows, self.seed):
+                        loaded = None
+                self._changes = {}
+                if loaded is not None:
+                    self._catch_up(loaded, labels_by_id)
+                    self._lsh = loaded
+                else:
+                    self._lsh = LSHIndex.build(labels_by_id, self.bands, self.rows, self.seed)
+                self._consumer = consumer
+            elif self._consumer is not None and self._consumer.due():
+                self._apply_changes()
+            return self._lsh
+
+    def _catch_up(self, lsh: LSHIndex, labels_by_id: Dict[int, Tuple[str, ...]]):
+        """Apply the catalog changes made since a saved index was written"""
+        for image_id, labels in lsh.matrix.diff(labels_by_id).items():
+            self._update(lsh, image_id, labels)
+
+    def _update(self, lsh: LSHIndex, image_id: int, labels: Optional[Tuple[str, ...]]):
+        """Record the current labels of a changed image, None once deleted; caller holds the lock"""
+        if labels is None:
+            lsh.remove(image_id)
+        else:
+            lsh.add(image_id, labels)
+        self._changes[image_id] = labels
+
+    def _apply_changes(self):
+        """Read the changes logged since the last poll, caller holds the lock"""
+        from .changes import ChangeConsumer, ChangeLogPruned, current_labels, latest_seq
+
+        try:
+            changes = current_labels(self._consumer.poll())
+        except ChangeLogPruned:
+            logger.warning('Catalog change log pruned past the LSH index, comparing it with the catalog')
+            self._consumer = ChangeConsumer(since=latest_seq(), interval=self._consumer.interval)
+            self.label_index.build()
+            self._catch_up(self._lsh, self.label_index.labels())
+            return
+        for image_id, labels in changes.items():
+            self._update(self._lsh, image_id, labels)
+
+    def sync(self):
+        """Apply the changes logged so far now rather than at the next poll"""
+        with self._lock:
+            if self._lsh is not None and self._consumer is not None:
+                self._apply_changes()
+
+    def add(self, image):
+        """Keep a loaded index in sync with an image saved by this process"""
+        with self._lock:
+            if self._lsh is not None:
+                self._update(self._lsh, image.id, tuple(image.get_label_list()))
+
+    def remove(self, image_id: int):
+        with self._lock:
+            if self._lsh is not None:
+                self._update(self._lsh, image_id, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._lsh = None
+            self._consumer = None
+            self._changes = {}
+
+    def changes(self) -> Dict[int, Optional[Tuple[str, ...]]]:
+        """Current labels (None when deleted) of the images changed since the index was built"""
+        with self._lock:
+            return dict(self._changes)
+
+    def candidates(self, references: List[Tuple[List[str], int]],
+                   exclude_ids: Iterable[int] = ()) -> np.ndarray:
+        """Candidate ids, at most max_candidates with the most band collisions"""
+        ids, votes = self.lsh().votes(references, self.max_bucket)
+        keep = ~np.isin(ids, np.fromiter(set(exclude_ids), dtype=np.int64))
+        ids, votes = ids[keep], votes[keep]
+        if len(ids) > self.max_candidates:
+            ids = ids[np.argpartition(-votes, self.max_candidates - 1)[:self.max_candidates]]
+        return ids
+
+    def top_k(self, references: List[Tuple[List[str], int]], k: int,
+              exclude_ids: Iterable[int] = ()) -> List[Tuple[int, float]]:
+        """Same contract as ScoringEngine.top_k"""
+        total_weight = sum(weight for _, weight in references)
+        if k <= 0 or total_weight <= 0:
+            return []
+        exclude_ids = set(exclude_ids)
+
+        lsh = self.lsh()
+        matrix = lsh.matrix
+        candidates = self.candidates(references, exclude_ids)
+        query = matrix.query_vector(references)
+
+        # Candidates unchanged since the build are scored from the index's matrix...
+        rows = np.searchsorted(matrix.image_ids, candidates).clip(0, max(len(matrix) - 1, 0))
+        stored = matrix.image_ids[rows] == candidates if len(matrix) else np.zeros(len(candidates), bool)
+        changes = self.changes()
+        if changes:
+            stored &= ~np.isin(candidates, np.fromiter(changes, dtype=np.int64))
+        image_ids = candidates[stored]
+        scores = matrix.row_scores(query, rows[stored]) / total_weight
+        positive = scores > 0
+        top = TopK(k, positive_only=True)
+        top.extend(select_top_k(image_ids[positive], scores[positive], k))
+
+        # ...the others from their current labels, while they can still enter
+        extra = []
+        for image_id in candidates[~stored].tolist():
+            labels = changes.get(image_id)
+            if labels is not None:
+                extra.append((image_id, labels))
+        push_bounded(top, extra, lambda labels: matrix.score_labels(query, labels) / total_weight,
+                     CosineBound(references))
+
+        if len(top) < k:
+            return scoring_engine.top_k(references, k, exclude_ids)
+        return top.results()
+
+
+lsh_engine = LSHEngine.from_settings(label_index)
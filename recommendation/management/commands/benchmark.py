@@ -0,0 +1,160 @@
+import json
+import random
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from recommendation.benchmark import Stopwatch, benchmark_users, seed_images, summarize
+from recommendation.cache import invalidate_user_recommendations
+from recommendation.models import Image, RecommendationSession
+
+ENDPOINTS = ['generate_recommendations', 'get_similar_image', 'browse_images', 'next_recommendation']
+
+
+class Command(BaseCommand):
+    help = 'Measure latency percentiles and throughput of the main views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Requests timed per endpoint')
+        parser.add_argument('--warmup', type=int, default=5,
+                            help='Untimed requests per endpoint, to build the in-memory indexes')
+        parser.add_argument('--users', type=int, default=20,
+                            help='Number of benchmark users the requests rotate over')
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                            help='Comma-separated endpoints to measure')
+        parser.add_argument('--sizes', default=None,
+                            help='Comma-separated catalog sizes; images are seeded up to each '
+                                 'size before measuring it (default: the current catalog only)')
+        parser.add_argument('--cold', action='store_true',
+                            help='Drop the cached ranking before every recommendations request')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed for the request mix')
+        parser.add_argument('--output', default=None,
+                            help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        endpoints = [name.strip() for name in options['endpoints'].split(',') if name.strip()]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+
+        users = list(benchmark_users().order_by('id')[:options['users']])
+        if not users:
+            raise CommandError('No benchmark users, run seed_benchmark first')
+
+        self.random = random.Random(options['seed'])
+        self.clients = []
+        for user in users:
+            client = Client(HTTP_HOST='localhost')
+            client.force_login(user)
+            self.clients.append((user, client))
+
+        sizes = [int(size) for size in options['sizes'].split(',')] if options['sizes'] else [None]
+        results = []
+        for size in sizes:
+            if size is not None:
+                missing = size - Image.objects.count()
+                if missing > 0:
+                    self.stderr.write(f'Seeding {missing} images')
+                    seed_images(missing)
+            catalog_size = Image.objects.count()
+            # Requests pick among the ids that exist at this size
+            self.image_ids = np.fromiter(Image.objects.values_list('id', flat=True), dtype=np.int64)
+            if 'next_recommendation' in endpoints:
+                self.sessions = self.prepare_sessions()
+
+            for endpoint in endpoints:
+                self.stderr.write(f'{endpoint} on {catalog_size} images')
+                summary = self.measure(endpoint, options)
+                summary.update(endpoint=endpoint, catalog_size=catalog_size)
+                results.append(summary)
+
+        report = json.dumps({
+            'timestamp': timezone.now().isoformat(),
+            'scorer': getattr(settings, 'RECOMMENDATION_SCORER', 'matrix'),
+            'cold': options['cold'],
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+    def measure(self, endpoint, options):
+        for _ in range(options['warmup']):
+            self.request(endpoint, options)
+
+        latencies = []
+        errors = 0
+        elapsed = 0.0
+        for _ in range(options['requests']):
+            # Only the request itself is timed, picking it is not
+            client, url = self.prepare(endpoint, options)
+            if url is None:
+                errors += 1
+                continue
+            with Stopwatch() as timer:
+                ok = self.send(client, url)
+            latencies.append(timer.elapsed)
+            elapsed += timer.elapsed
+            errors += not ok
+        return summarize(latencies, elapsed, errors)
+
+    def prepare_sessions(self):
+        """Latest recommendation session of every user, created if missing"""
+        sessions = {}
+        for user, client in self.clients:
+            session_id = RecommendationSession.objects.filter(user=user).order_by('-id').values_list(
+                'id', flat=True).first()
+            if session_id is None:
+                # Sessions come from the recommendations page
+                client.get(reverse('generate_recommendations'))
+                session_id = RecommendationSession.objects.filter(user=user).order_by('-id').values_list(
+                    'id', flat=True).first()
+            sessions[user.id] = session_id
+        return sessions
+
+    def prepare(self, endpoint, options):
+        """
+        Pick a client and the URL of its next request
+
+        Returns:
+            Tuple[Client, str]: url is None when the request can't be made
+        """
+        user, client = self.random.choice(self.clients)
+
+        if endpoint == 'generate_recommendations':
+            if options['cold']:
+                invalidate_user_recommendations(user.id)
+            return client, reverse('generate_recommendations')
+        if endpoint == 'get_similar_image':
+            if not len(self.image_ids):
+                return client, None
+            return client, reverse('get_similar_image', args=[self.random_image_id()])
+        if endpoint == 'browse_images':
+            return client, reverse('browse_images')
+        session_id = self.sessions.get(user.id)
+        if session_id is None:
+            return client, None
+        return client, reverse('next_recommendation', args=[session_id, self.random.randint(1, 9)])
+
+    def request(self, endpoint, options):
+        client, url = self.prepare(endpoint, options)
+        return url is not None and self.send(client, url)
+
+    def send(self, client, url):
+        response = client.get(url)
+        if response.status_code != 200:
+            return False
+        if response.get('Content-Type', '').startswith('application/json'):
+            return json.loads(response.content).get('success', True)
+        return True
+
+    def random_image_id(self):
+        return int(self.image_ids[self.random.randrange(len(self.image_ids))])
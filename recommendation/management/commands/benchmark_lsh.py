@@ -0,0 +1,124 @@
+import json
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from recommendation.benchmark import Stopwatch, summarize
+from recommendation.index import LabelIndex
+from recommendation.lsh import LSHEngine, LSHIndex
+from recommendation.models import CollectionImage
+from recommendation.scoring import ScoringEngine
+
+
+def parse_configs(value):
+    """'32x2,20x3' -> [(32, 2), (20, 3)]"""
+    configs = []
+    for item in value.split(','):
+        bands, _, rows = item.strip().partition('x')
+        try:
+            configs.append((int(bands), int(rows)))
+        except ValueError:
+            raise CommandError(f'Invalid config {item!r}, expected BANDSxROWS')
+    return configs
+
+
+class Command(BaseCommand):
+    help = 'Compare LSH band/row settings against the exact scorer: recall@K, latency and size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--configs', default='32x2',
+                            help='Comma separated BANDSxROWS settings to measure')
+        parser.add_argument('--queries', type=int, default=200,
+                            help='Reference sets queried per config')
+        parser.add_argument('--k', type=int, default=10,
+                            help='Results per query')
+        parser.add_argument('--max-candidates', type=int, default=2000,
+                            help='Candidates re-ranked exactly per query')
+        parser.add_argument('--seed', type=int, default=1,
+                            help='Random seed of the query sample and the hash functions')
+        parser.add_argument('--output', default=None,
+                            help='Write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        k = options['k']
+        index = LabelIndex()
+        labels_by_id = index.labels()
+        if not labels_by_id:
+            raise CommandError('The catalog is empty')
+        queries = self.sample_queries(index, options['queries'], np.random.default_rng(options['seed']))
+
+        # Ground truth, from the exact scorer
+        exact_engine = ScoringEngine(index)
+        exact_engine.matrix()
+        exact, exact_latencies = [], []
+        for references, exclude_ids in queries:
+            with Stopwatch() as timer:
+                results = exact_engine.top_k(references, k, exclude_ids)
+            exact_latencies.append(timer.elapsed)
+            exact.append({image_id for image_id, score in results if score > 0})
+        report = {
+            'images': len(labels_by_id),
+            'queries': len(queries),
+            'k': k,
+            'exact': summarize(exact_latencies, sum(exact_latencies)),
+            'configs': [],
+        }
+
+        for bands, rows in parse_configs(options['configs']):
+            engine = LSHEngine(index, bands=bands, rows=rows, seed=options['seed'],
+                               max_candidates=options['max_candidates'])
+            with Stopwatch() as build_timer:
+                engine._lsh = LSHIndex.build(labels_by_id, bands, rows, options['seed'])
+
+            recalls, candidates, latencies = [], [], []
+            for (references, exclude_ids), expected in zip(queries, exact):
+                with Stopwatch() as timer:
+                    results = engine.top_k(references, k, exclude_ids)
+                latencies.append(timer.elapsed)
+                candidates.append(len(engine.candidates(references, exclude_ids)))
+                if expected:
+                    found = {image_id for image_id, _ in results}
+                    recalls.append(len(found & expected) / len(expected))
+
+            report['configs'].append({
+                'bands': bands,
+                'rows': rows,
+                f'recall_at_{k}': round(float(np.mean(recalls)), 4) if recalls else None,
+                'mean_candidates': round(float(np.mean(candidates)), 1),
+                'build_seconds': round(build_timer.elapsed, 2),
+                'index_mib': round(engine._lsh.nbytes / 1024 / 1024, 2),
+                'latency': summarize(latencies, sum(latencies)),
+            })
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
+
+    def sample_queries(self, index, count, rng):
+        """
+        Reference sets of random users with liked/starred images, or single
+        random catalog images when there are none
+        """
+        by_user = {}
+        for user_id, image_id, weight in CollectionImage.objects.values_list(
+            'collection__user_id', 'image_id', 'interaction_type'
+        ).iterator():
+            labels = index.labels_for(image_id)
+            if labels:
+                by_user.setdefault(user_id, []).append((image_id, list(labels), weight))
+
+        if by_user:
+            user_ids = sorted(by_user)
+            chosen = rng.choice(len(user_ids), size=min(count, len(user_ids)), replace=False)
+            return [
+                ([(labels, weight) for _, labels, weight in by_user[user_ids[i]]],
+                 {image_id for image_id, _, _ in by_user[user_ids[i]]})
+                for i in chosen
+            ]
+
+        labels_by_id = index.labels()
+        image_ids = [image_id for image_id, labels in labels_by_id.items() if labels]
+        chosen = rng.choice(len(image_ids), size=min(count, len(image_ids)), replace=False)
+        return [([(list(labels_by_id[image_ids[i]]), 1)], {image_ids[i]}) for i in chosen]
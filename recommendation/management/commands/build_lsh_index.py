@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from recommendation.benchmark import Stopwatch
+from recommendation.index import LabelIndex
+from recommendation.lsh import LSHIndex
+
+
+class Command(BaseCommand):
+    help = 'Build the MinHash LSH index of the catalog and save it to disk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None,
+                            help='File to write (default: LSH_INDEX_PATH)')
+        parser.add_argument('--bands', type=int, default=None,
+                            help='Number of bands (default: LSH_BANDS)')
+        parser.add_argument('--rows', type=int, default=None,
+                            help='Hashes per band (default: LSH_ROWS)')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Seed of the hash functions (default: LSH_SEED)')
+
+    def handle(self, *args, **options):
+        output = options['output'] or getattr(settings, 'LSH_INDEX_PATH', None)
+        if not output:
+            raise CommandError('Pass --output or set LSH_INDEX_PATH')
+        bands = options['bands'] or getattr(settings, 'LSH_BANDS', 32)
+        rows = options['rows'] or getattr(settings, 'LSH_ROWS', 2)
+        seed = options['seed'] if options['seed'] is not None else getattr(settings, 'LSH_SEED', 1)
+
+        with Stopwatch() as load_timer:
+            labels_by_id = LabelIndex().labels()
+        with Stopwatch() as build_timer:
+            index = LSHIndex.build(labels_by_id, bands=bands, rows=rows, seed=seed)
+        index.save(str(output))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {len(index.matrix)} images ({bands} bands x {rows} rows, '
+            f'{index.nbytes / 1024 / 1024:.1f} MiB) in {build_timer.elapsed:.1f}s '
+            f'(+{load_timer.elapsed:.1f}s loading labels) to {output}'
+        ))
@@ -0,0 +1,84 @@
+import os
+import tempfile
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recommendation.changes import latest_seq, save_cursor
+from recommendation.index import LabelIndex
+from recommendation.matrix_file import MappedLabelMatrix, write_label_matrix
+from recommendation.models import SimilarImage
+from recommendation.scoring import LabelMatrix
+from recommendation.similarity import SIMILARITY_CURSOR, compute_neighbours, neighbours_per_image
+
+# Per-process state set up by _init_worker
+_matrix = None
+_columns = None
+
+
+def _init_worker(path):
+    global _matrix, _columns
+    # Every worker maps the same file instead of unpickling its own copy
+    _matrix = MappedLabelMatrix(path)
+    _columns = sorted(_matrix.vocabulary, key=_matrix.vocabulary.get)
+
+
+def _neighbours_for_chunk(args):
+    start, stop, n = args
+    results = []
+    for row in range(start, stop):
+        labels = [_columns[column] for column in _matrix.indices[_matrix.indptr[row]:_matrix.indptr[row + 1]]]
+        image_id = int(_matrix.image_ids[row])
+        results.append((image_id, compute_neighbours(_matrix, image_id, labels, n)))
+    return results
+
+
+class Command(BaseCommand):
+    help = 'Precompute the top-N most similar images of every image'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--neighbours', type=int, default=None,
+                            help='Neighbours stored per image (default: SIMILAR_IMAGES_PER_IMAGE)')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Number of worker processes')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Images scored per worker task')
+
+    def handle(self, *args, **options):
+        n = options['neighbours'] or neighbours_per_image()
+        chunk_size = options['chunk_size']
+        started = time.monotonic()
+
+        # Changes logged from here on are applied by refresh_similarity
+        since = latest_seq()
+        matrix = LabelMatrix.from_labels(LabelIndex().snapshot())
+        chunks = [
+            (start, min(start + chunk_size, len(matrix)), n)
+            for start in range(0, len(matrix), chunk_size)
+        ]
+
+        stored = 0
+        with tempfile.TemporaryDirectory() as directory:
+            # Workers only get the exported matrix, they never touch the database
+            path = os.path.join(directory, 'labels.matrix')
+            write_label_matrix(matrix, path)
+            with Pool(options['processes'], initializer=_init_worker, initargs=(path,)) as pool, \
+                    transaction.atomic():
+                SimilarImage.objects.all().delete()
+                # Each chunk is written as it arrives, the table is never held in memory
+                for results in pool.imap(_neighbours_for_chunk, chunks):
+                    rows = [
+                        SimilarImage(image_id=image_id, neighbour_id=neighbour_id, score=score, rank=rank)
+                        for image_id, neighbours in results
+                        for rank, (neighbour_id, score) in enumerate(neighbours, start=1)
+                    ]
+                    SimilarImage.objects.bulk_create(rows, batch_size=5000)
+                    stored += len(rows)
+                save_cursor(SIMILARITY_CURSOR, since)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {stored} neighbours for {len(matrix)} images '
+            f'in {time.monotonic() - started:.1f}s'
+        ))
@@ -0,0 +1,74 @@
+import json
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from recommendation.models import Collection, CollectionImage, Image, Recommendation, RecommendationSession
+from recommendation.pagination import browse_queryset, encode_cursor
+
+
+class Command(BaseCommand):
+    help = 'Show the query plan and latency of the hot query patterns'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', default=None,
+                            help='Username the queries run for (default: the first user)')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Executions timed per query')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+        else:
+            user = User.objects.order_by('id').first()
+        if user is None:
+            raise CommandError('No such user')
+
+        session = RecommendationSession.objects.filter(user=user).order_by('-id').first()
+        image = Image.objects.order_by('-created_at', '-id').first()
+        middle = Image.objects.order_by('-created_at', '-id')[Image.objects.count() // 2:].first()
+
+        queries = {
+            'reference_images': CollectionImage.objects.filter(
+                collection__user=user
+            ).select_related('image'),
+            'starred_collection': Collection.objects.filter(user=user, name='Starred Images'),
+            'next_recommendation': Recommendation.objects.filter(
+                session_id=session.id if session else 0, position=2
+            ),
+            'mark_added': Recommendation.objects.filter(
+                image_id=image.id if image else 0,
+                session__user=user,
+                session__is_active=True
+            ).values('id'),
+            'browse_first_page': browse_queryset(user)[:25],
+            'browse_deep_page': browse_queryset(user, encode_cursor(middle) if middle else None)[:25],
+        }
+
+        results = {}
+        for name, query in queries.items():
+            plan = query.explain()
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                list(query.all())
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = {
+                'plan': plan,
+                'p50_ms': round(statistics.median(timings), 3),
+                'max_ms': round(max(timings), 3),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for name, result in results.items():
+            self.stdout.write(self.style.SUCCESS(
+                f"{name}: p50 {result['p50_ms']}ms, max {result['max_ms']}ms"
+            ))
+            self.stdout.write(result['plan'])
+            self.stdout.write('')
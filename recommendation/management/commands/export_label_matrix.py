@@ -0,0 +1,40 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from recommendation.benchmark import Stopwatch
+from recommendation.changes import latest_seq
+from recommendation.index import LabelIndex
+from recommendation.matrix_file import MappedLabelMatrix, write_label_matrix
+from recommendation.scoring import LabelMatrix
+
+
+class Command(BaseCommand):
+    help = 'Write the catalog label matrix to the file worker processes memory-map'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None,
+                            help='File to write (default: LABEL_MATRIX_PATH)')
+
+    def handle(self, *args, **options):
+        output = options['output'] or getattr(settings, 'LABEL_MATRIX_PATH', None)
+        if not output:
+            raise CommandError('Pass --output or set LABEL_MATRIX_PATH')
+        output = str(output)
+
+        with Stopwatch() as build_timer:
+            # Taken first, changes logged while the catalog is read are applied again by readers
+            change_seq = latest_seq()
+            matrix = LabelMatrix.from_labels(LabelIndex().labels())
+        with Stopwatch() as write_timer:
+            write_label_matrix(matrix, output, change_seq)
+        with Stopwatch() as open_timer:
+            MappedLabelMatrix(output)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Exported {len(matrix)} images, {len(matrix.indices)} labels '
+            f'({len(matrix.vocabulary)} distinct, {os.path.getsize(output) / 1024 / 1024:.1f} MiB) '
+            f'up to change {change_seq} to {output}: built in {build_timer.elapsed:.2f}s, written in {write_timer.elapsed:.2f}s, '
+            f'maps in {open_timer.elapsed * 1000:.1f}ms'
+        ))
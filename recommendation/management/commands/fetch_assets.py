@@ -0,0 +1,63 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, Q
+
+from recommendation.assets import AssetPipeline, pillow_available
+from recommendation.models import Image
+
+
+class Command(BaseCommand):
+    help = 'Fetch catalog images into the local media store and generate their thumbnails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default=None,
+                            help='Comma-separated thumbnail sizes in pixels (default: THUMBNAIL_SIZES)')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Worker processes rendering thumbnails')
+        parser.add_argument('--download-workers', type=int, default=8,
+                            help='Threads downloading originals')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Images processed per batch')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Process at most this many images')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Also retry images whose last fetch failed')
+        parser.add_argument('--all', action='store_true',
+                            help='Reprocess every image, not only new or changed ones')
+
+    def handle(self, *args, **options):
+        if not pillow_available():
+            raise CommandError('Thumbnails need Pillow: pip install Pillow')
+
+        sizes = [int(size) for size in options['sizes'].split(',')] if options['sizes'] else None
+        pipeline = AssetPipeline(
+            sizes=sizes,
+            processes=options['processes'],
+            download_workers=options['download_workers']
+        )
+
+        images = Image.objects.order_by('id')
+        if not options['all']:
+            # No asset yet, or the image URL changed since it was fetched
+            todo = Q(asset__isnull=True) | ~Q(asset__source_url=F('image_url'))
+            if options['retry_failed']:
+                todo |= Q(asset__status='failed')
+            images = images.filter(todo)
+        if options['limit'] is not None:
+            images = images[:options['limit']]
+
+        started = time.monotonic()
+        ready = failed = 0
+        image_ids = list(images.values_list('id', flat=True))
+        for start in range(0, len(image_ids), options['batch_size']):
+            batch = list(Image.objects.filter(id__in=image_ids[start:start + options['batch_size']]))
+            batch_ready, batch_failed = pipeline.process(batch)
+            ready += batch_ready
+            failed += batch_failed
+            self.stdout.write(f'{start + len(batch)}/{len(image_ids)} images processed')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{ready} images ready, {failed} failed in {time.monotonic() - started:.1f}s'
+        ))
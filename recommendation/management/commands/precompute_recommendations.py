@@ -0,0 +1,163 @@
+import json
+import os
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from recommendation.cache import reference_set_key
+from recommendation.index import LabelIndex
+from recommendation.models import CollectionImage, Image
+from recommendation.persistence import RecommendationWriter
+from recommendation.scoring import LabelMatrix, select_top_k
+
+# Per-process state set up by _init_worker
+_matrix = None
+_k = None
+
+
+def _init_worker(matrix, k):
+    global _matrix, _k
+    _matrix = matrix
+    _k = k
+
+
+def _rank_chunk(user_ids):
+    """
+    Rank the catalog for a chunk of users
+
+    The references of the whole chunk are streamed in one query, scoring
+    uses the label matrix shared by the parent.
+
+    Returns:
+        Tuple[list, float]: (user_id, reference_key, ranked) per user, and
+        the seconds spent scoring
+    """
+    references_by_user = {}
+    rows = CollectionImage.objects.filter(
+        collection__user_id__in=user_ids
+    ).order_by('collection__user_id', 'id').values_list(
+        'collection__user_id', 'image_id', 'interaction_type', 'image__labels'
+    )
+    for user_id, image_id, weight, labels in rows.iterator(chunk_size=2000):
+        references_by_user.setdefault(user_id, []).append(
+            (image_id, weight, Image(labels=labels).get_label_list())
+        )
+
+    started = time.perf_counter()
+    results = []
+    for user_id in user_ids:
+        references = references_by_user.get(user_id)
+        if not references:
+            continue
+        weighted = [(labels, weight) for _, weight, labels in references]
+        total_weight = sum(weight for _, weight in weighted)
+        if total_weight <= 0:
+            continue
+        # Same scores and ordering as ScoringEngine.top_k
+        scores = _matrix.scores(_matrix.query_vector(weighted)) / total_weight
+        valid = ~np.isin(_matrix.image_ids, [image_id for image_id, _, _ in references])
+        ranked = select_top_k(_matrix.image_ids[valid], scores[valid], _k)
+        results.append((
+            user_id,
+            reference_set_key([(image_id, weight) for image_id, weight, _ in references]),
+            ranked,
+        ))
+    return results, time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = 'Rank the catalog for every user ahead of time and store the sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Number of worker processes')
+        parser.add_argument('--chunk-size', type=int, default=200,
+                            help='Users ranked per worker task and written per transaction')
+        parser.add_argument('--k', type=int, default=10,
+                            help='Recommendations stored per user')
+        parser.add_argument('--checkpoint', default=None,
+                            help='JSON file recording progress after every written chunk')
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip the users the checkpoint file says are done')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Stop after this many users')
+
+    def handle(self, *args, **options):
+        checkpoint_path = options['checkpoint']
+        if options['resume'] and not checkpoint_path:
+            raise CommandError('--resume needs --checkpoint')
+
+        progress = {'last_user_id': 0, 'users': 0, 'sessions': 0, 'recommendations': 0}
+        if options['resume'] and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                progress.update(json.load(f))
+            self.stdout.write(f"Resuming after user {progress['last_user_id']}")
+
+        # Users with at least one liked or starred image, in id order so the
+        # checkpoint is a single id
+        user_ids = list(
+            CollectionImage.objects.filter(collection__user_id__gt=progress['last_user_id'])
+            .order_by('collection__user_id')
+            .values_list('collection__user_id', flat=True).distinct()
+        )
+        if options['limit'] is not None:
+            user_ids = user_ids[:options['limit']]
+        chunk_size = options['chunk_size']
+        chunks = [user_ids[start:start + chunk_size] for start in range(0, len(user_ids), chunk_size)]
+
+        started = time.perf_counter()
+        matrix = LabelMatrix.from_labels(LabelIndex().labels())
+        load_seconds = time.perf_counter() - started
+
+        writer = RecommendationWriter()
+        scoring_seconds = write_seconds = 0.0
+        users = sessions = recommendations = 0
+        # Workers open their own connections, the parent's must not be shared
+        connections.close_all()
+        with Pool(options['processes'], initializer=_init_worker,
+                  initargs=(matrix, options['k'])) as pool:
+            # imap keeps chunk order, so everything up to the checkpoint is written
+            for chunk, (results, seconds) in zip(chunks, pool.imap(_rank_chunk, chunks)):
+                scoring_seconds += seconds
+                write_started = time.perf_counter()
+                written_sessions, written_recommendations = writer.write_precomputed(results)
+                write_seconds += time.perf_counter() - write_started
+
+                users += len(chunk)
+                sessions += written_sessions
+                recommendations += written_recommendations
+                progress['last_user_id'] = chunk[-1]
+                progress['users'] += len(chunk)
+                progress['sessions'] += written_sessions
+                progress['recommendations'] += written_recommendations
+                if checkpoint_path:
+                    self._save_checkpoint(checkpoint_path, progress)
+
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'{users}/{len(user_ids)} users, {users / elapsed:.0f} users/s')
+
+        elapsed = time.perf_counter() - started
+        report = {
+            'users': users,
+            'sessions': sessions,
+            'recommendations': recommendations,
+            'processes': options['processes'],
+            'elapsed_seconds': round(elapsed, 2),
+            'users_per_second': round(users / elapsed, 1) if elapsed > 0 else None,
+            'catalog_load_seconds': round(load_seconds, 2),
+            'scoring_seconds': round(scoring_seconds, 2),
+            'write_seconds': round(write_seconds, 2),
+        }
+        self.stdout.write(json.dumps(report, indent=2))
+
+    @staticmethod
+    def _save_checkpoint(path, progress):
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(progress, f)
+        os.replace(temp_path, path)
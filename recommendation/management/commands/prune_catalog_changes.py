@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from recommendation.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = 'Delete old entries of the catalog change log'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=7,
+                            help='Keep the changes of the last DAYS days')
+
+    def handle(self, *args, **options):
+        deleted = prune_changes(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} catalog changes'))
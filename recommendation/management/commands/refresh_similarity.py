@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recommendation.changes import ChangeConsumer, ChangeLogPruned, latest_seq, load_cursor, save_cursor
+from recommendation.similarity import SIMILARITY_CURSOR, refresh_neighbours
+
+
+class Command(BaseCommand):
+    help = 'Apply catalog changes to the precomputed similar-image table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Changed images refreshed per batch')
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help='Seconds to sleep when there are no changes')
+        parser.add_argument('--once', action='store_true',
+                            help='Apply the pending changes and exit')
+
+    def handle(self, *args, **options):
+        since = load_cursor(SIMILARITY_CURSOR)
+        if since is None:
+            # build_similarity records the cursor, a table built before that
+            # is taken as current
+            since = latest_seq()
+            save_cursor(SIMILARITY_CURSOR, since)
+            self.stdout.write(f'No similarity cursor, starting at change #{since}')
+        consumer = ChangeConsumer(since=since, batch_size=options['batch_size'])
+
+        while True:
+            started = time.monotonic()
+            try:
+                changes = consumer.poll_batch()
+            except ChangeLogPruned as exc:
+                raise CommandError(f'{exc}, rebuild the table with manage.py build_similarity')
+            if changes:
+                refreshed = refresh_neighbours(changes)
+                save_cursor(SIMILARITY_CURSOR, consumer.position)
+                self.stdout.write(
+                    f'Refreshed {refreshed} neighbour lists for {len(changes)} changed images '
+                    f'in {time.monotonic() - started:.2f}s (change #{consumer.since})'
+                )
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['poll_interval'])
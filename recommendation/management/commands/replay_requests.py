@@ -0,0 +1,50 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recommendation.replay import Replayer, load_entries
+
+
+class Command(BaseCommand):
+    help = 'Replay a JSONL traffic capture and report latency per URL name'
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture', help='JSONL file, see recommendation.replay.load_entries')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Requests in flight at once')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='Requests started per second (default: as fast as possible)')
+        parser.add_argument('--speed', type=float, default=None,
+                            help='Replay at the recorded pace times this factor, overrides --rate')
+        parser.add_argument('--base-url', default=None,
+                            help='Send the requests to a running server (e.g. http://127.0.0.1:8000) '
+                                 'instead of the in-process test client; no query counts then')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Replay only the first N requests')
+        parser.add_argument('--output', default=None,
+                            help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        try:
+            entries, skipped = load_entries(options['capture'])
+        except OSError as e:
+            raise CommandError(str(e))
+        if options['limit'] is not None:
+            entries = entries[:options['limit']]
+        if skipped:
+            self.stderr.write(f'Skipped {skipped} lines without a request path')
+        if not entries:
+            raise CommandError('Nothing to replay')
+
+        replayer = Replayer(
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            speed=options['speed'],
+            base_url=options['base_url']
+        )
+        report = json.dumps(replayer.run(entries), indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
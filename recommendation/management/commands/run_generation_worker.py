@@ -0,0 +1,81 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from recommendation.jobs import claim_jobs, fail_job, reclaim_stale_jobs, run_jobs
+from recommendation.models import GenerationJob
+from recommendation.services import ConcurrentPollinationsAIService
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Process queued AI image generation jobs for recommendation sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help='Number of jobs generated concurrently per batch')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Process a single batch and exit')
+
+    def handle(self, *args, **options):
+        service = ConcurrentPollinationsAIService()
+        stale_after = getattr(settings, 'GENERATION_JOB_STALE_AFTER', 300)
+        next_reclaim = 0.0
+
+        while True:
+            # Jobs of crashed workers, checked on startup and then every
+            # GENERATION_JOB_STALE_AFTER seconds
+            if time.monotonic() >= next_reclaim:
+                self.reclaim()
+                next_reclaim = time.monotonic() + stale_after
+
+            if service.breaker.is_open():
+                # Pollinations.AI is failing, leave the queue alone until a probe is due
+                if options['once']:
+                    self.stdout.write('Circuit breaker open, no jobs claimed')
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+
+            try:
+                jobs = claim_jobs(options['batch_size'])
+            except Exception:
+                logger.exception("Claiming generation jobs failed")
+                jobs = []
+            if jobs:
+                completed = self.run(jobs, service)
+                self.stdout.write(f'Completed {completed}/{len(jobs)} generation jobs')
+            if options['once']:
+                break
+            if not jobs:
+                time.sleep(options['poll_interval'])
+
+    def reclaim(self):
+        try:
+            requeued, failed = reclaim_stale_jobs()
+        except Exception:
+            logger.exception("Reclaiming stale generation jobs failed")
+            return
+        if requeued or failed:
+            self.stdout.write(f'Reclaimed {requeued} stale generation jobs, gave up on {failed}')
+
+    def run(self, jobs, service):
+        """Run a batch, a failure of the batch itself fails the jobs it left running"""
+        try:
+            return run_jobs(jobs, service)
+        except Exception:
+            logger.exception("Generation batch failed")
+            for job in jobs:
+                if job.status != GenerationJob.RUNNING:
+                    continue
+                try:
+                    fail_job(job)
+                except Exception:
+                    # Left running, reclaim_stale_jobs() picks it up later
+                    logger.exception("Failing generation job %s failed", job.pk)
+            return 0
@@ -0,0 +1,61 @@
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from recommendation.benchmark import Stopwatch, clear_benchmark_data, seed_images, seed_users
+
+
+class Command(BaseCommand):
+    help = 'Bulk generate a synthetic catalog and users for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=100000,
+                            help='Number of images to add')
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Number of users to add')
+        parser.add_argument('--vocabulary', type=int, default=5000,
+                            help='Number of distinct labels')
+        parser.add_argument('--labels-per-image', type=int, default=8,
+                            help='Labels drawn per image')
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help='Zipf exponent of the label distribution')
+        parser.add_argument('--likes', type=int, default=20,
+                            help='Images liked per user')
+        parser.add_argument('--stars', type=int, default=5,
+                            help='Images starred per user')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows inserted per transaction')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed, for reproducible catalogs')
+        parser.add_argument('--clear', action='store_true',
+                            help='Delete previously generated data first')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+
+        if options['clear']:
+            clear_benchmark_data()
+            self.stdout.write('Deleted previous benchmark data')
+
+        with Stopwatch() as images_timer:
+            images = seed_images(
+                options['images'],
+                vocabulary=options['vocabulary'],
+                labels_per_image=options['labels_per_image'],
+                exponent=options['zipf'],
+                batch_size=options['batch_size'],
+                rng=rng
+            )
+        with Stopwatch() as users_timer:
+            users = seed_users(
+                options['users'],
+                likes=options['likes'],
+                stars=options['stars'],
+                batch_size=options['batch_size'],
+                rng=rng
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {images} images in {images_timer.elapsed:.1f}s '
+            f'and {users} users in {users_timer.elapsed:.1f}s'
+        ))
+        self.stdout.write('Run build_similarity to refresh the similar-image table')
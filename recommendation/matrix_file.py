@@ -0,0 +1,139 @@
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+from .scoring import LabelMatrix
+
+MAGIC = b'IRSLMTX\0'
+FORMAT_VERSION = 2
+# magic, version, image count, stored labels, vocabulary size, vocabulary
+# bytes, catalog change log position, export time
+HEADER = struct.Struct('<8sIQQQQqd')
+ALIGNMENT = 64
+
+
+class LabelMatrixFileError(Exception):
+    pass
+
+
+def _sections(n: int, nnz: int, vocab_size: int, vocab_bytes: int):
+    """(name, dtype, count, offset) of every array in the file, in file order"""
+    layout = [
+        ('image_ids', np.int64, n),
+        ('indptr', np.int64, n + 1),
+        ('indices', np.int32, nnz),
+        ('rows', np.int32, nnz),
+        ('norms', np.float64, n),
+        ('vocab_offsets', np.int64, vocab_size + 1),
+        ('vocab', np.uint8, vocab_bytes),
+    ]
+    offset = HEADER.size
+    sections = []
+    for name, dtype, count in layout:
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        sections.append((name, np.dtype(dtype), count, offset))
+        offset += np.dtype(dtype).itemsize * count
+    return sections
+
+
+def write_label_matrix(matrix: LabelMatrix, path: str, change_seq: int = 0):
+    """
+    Write a label matrix to ``path``, atomically replacing the previous file
+
+    The file is written next to ``path`` and renamed into place, so processes
+    that have the old file mapped keep reading it until they reopen.
+    ``change_seq`` is the change log position the matrix is current up to,
+    readers apply the changes logged after it.
+    """
+    columns = sorted(matrix.vocabulary, key=matrix.vocabulary.get)
+    encoded = [label.encode('utf-8') for label in columns]
+    vocab_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(label) for label in encoded], out=vocab_offsets[1:])
+
+    arrays = {
+        'image_ids': matrix.image_ids,
+        'indptr': matrix.indptr,
+        'indices': matrix.indices,
+        'rows': matrix.rows,
+        'norms': matrix.norms,
+        'vocab_offsets': vocab_offsets,
+        'vocab': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+    }
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, len(matrix), len(matrix.indices), len(columns),
+        int(vocab_offsets[-1]), change_seq, time.time()
+    )
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(header)
+            for name, dtype, count, offset in _sections(len(matrix), len(matrix.indices),
+                                                        len(columns), int(vocab_offsets[-1])):
+                temp_file.write(b'\0' * (offset - temp_file.tell()))
+                temp_file.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        # Readable by the other worker processes, mkstemp creates it 0600
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class MappedLabelMatrix(LabelMatrix):
+    """
+    Label matrix backed by a read-only memory map of an exported file
+
+    The arrays are views on the map, so opening the file costs a page-table
+    setup and every process shares the page cache copy.  Only the vocabulary
+    dict is built in memory.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < HEADER.size:
+                raise LabelMatrixFileError(f"{path} is not a label matrix file")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        self.file_id = (stat.st_ino, stat.st_mtime_ns)
+
+        magic, version, n, nnz, vocab_size, vocab_bytes, change_seq, exported_at = \
+            HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise LabelMatrixFileError(f"{path} is not a label matrix file")
+        if version != FORMAT_VERSION:
+            raise LabelMatrixFileError(f"Unsupported label matrix format {version}")
+        self.change_seq = change_seq
+        self.exported_at = exported_at
+
+        arrays = {}
+        for name, dtype, count, offset in _sections(n, nnz, vocab_size, vocab_bytes):
+            if offset + dtype.itemsize * count > len(self._mmap):
+                raise LabelMatrixFileError(f"{path} is truncated")
+            arrays[name] = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+
+        blob = arrays['vocab'].tobytes()
+        offsets = arrays['vocab_offsets'].tolist()
+        vocabulary = {
+            blob[offsets[i]:offsets[i + 1]].decode('utf-8'): i for i in range(vocab_size)
+        }
+        super().__init__(vocabulary, arrays['image_ids'], arrays['indptr'], arrays['indices'],
+                         norms=arrays['norms'], rows=arrays['rows'])
+
+    def is_current(self) -> bool:
+        """False once export_label_matrix has replaced the file"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_ino, stat.st_mtime_ns) == self.file_id
+
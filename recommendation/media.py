@@ -0,0 +1,100 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+from typing import Iterable, Optional
+
+from django.conf import settings
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class ContentAddressedStore:
+    """
+    Files stored under MEDIA_ROOT by the sha256 of their content
+
+    A file lives at ``<prefix>/<2 hex chars>/<full hash><ext>``, so the same
+    image downloaded twice is stored once and its URL never changes, which
+    lets the web server serve it with far-future cache headers.
+    """
+
+    def __init__(self, root: Optional[str] = None, base_url: Optional[str] = None,
+                 prefix: str = 'generated', max_bytes: Optional[int] = None):
+        self.root = str(root or settings.MEDIA_ROOT)
+        self.base_url = base_url or settings.MEDIA_URL
+        self.prefix = prefix
+        self.max_bytes = max_bytes or getattr(settings, 'MEDIA_STORE_MAX_BYTES', 20 * 1024 * 1024)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def url(self, name: str) -> str:
+        return self.base_url.rstrip('/') + '/' + name
+
+    def save(self, chunks: Iterable[bytes], content_type: Optional[str] = None) -> str:
+        """
+        Write a stream of bytes to the store
+
+        The data is hashed while it is written to a temporary file, which is
+        then renamed into place, so readers never see a partial file.
+
+        Args:
+            chunks (Iterable[bytes]): File content
+            content_type (str): MIME type, used for the file extension
+
+        Returns:
+            str: Name of the file, relative to the store root
+        """
+        directory = os.path.join(self.root, self.prefix)
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise MediaTooLarge(f"File larger than {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+
+            hex_digest = digest.hexdigest()
+            name = f'{self.prefix}/{hex_digest[:2]}/{hex_digest}{self._extension(content_type)}'
+            final_path = self.path(name)
+            if os.path.exists(final_path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(temp_path, final_path)
+            return name
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def _extension(content_type: Optional[str]) -> str:
+        if not content_type:
+            return ''
+        content_type = content_type.split(';', 1)[0].strip().lower()
+        if content_type == 'image/jpeg':
+            return '.jpg'
+        return mimetypes.guess_extension(content_type) or ''
+
+
+_media_store = None
+_media_store_lock = threading.Lock()
+
+
+def get_media_store() -> ContentAddressedStore:
+    """Return the store generated images are written to"""
+    global _media_store
+    with _media_store_lock:
+        if _media_store is None:
+            _media_store = ContentAddressedStore()
+        return _media_store
@@ -0,0 +1,169 @@
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.urls import Resolver404, resolve
+
+from .profiling import end_profile, metrics, profiling_settings, start_profile
+
+
+class RequestLogMiddleware:
+    """
+    Append application requests to a JSONL traffic capture (REQUEST_LOG_PATH)
+
+    The captures are replayed by ``manage.py replay_requests``, see
+    ``recommendation/replay.py`` for the line format.  Disabled unless the
+    setting is set.  Only the URL names of this app are captured
+    (REQUEST_LOG_URL_NAMES), so admin and login requests never are, and
+    password and CSRF token fields are dropped from the bodies.
+    """
+
+    def __init__(self, get_response):
+        self.path = getattr(settings, 'REQUEST_LOG_PATH', None)
+        if not self.path:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.url_names = set(getattr(settings, 'REQUEST_LOG_URL_NAMES', None) or app_url_names())
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        if not self._captured(request):
+            return self.get_response(request)
+
+        entry = {
+            'timestamp': time.time(),
+            'method': request.method,
+            'path': request.get_full_path(),
+            'user': request.user.get_username() if request.user.is_authenticated else None,
+        }
+        if request.method == 'POST':
+            if request.content_type == 'application/json':
+                try:
+                    entry['json'] = redact(json.loads(request.body))
+                except ValueError:
+                    pass
+            else:
+                entry['data'] = redact(request.POST.dict())
+
+        response = self.get_response(request)
+
+        entry['status'] = response.status_code
+        with self._lock, open(self.path, 'a') as log:
+            log.write(json.dumps(entry) + '\n')
+        return response
+
+    def _captured(self, request) -> bool:
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return False
+        return match.url_name in self.url_names
+
+
+def app_url_names():
+    """Names of the URL patterns of the recommendation app"""
+    from .urls import urlpatterns
+
+    return {pattern.name for pattern in urlpatterns if pattern.name}
+
+
+def redact(body):
+    """Drop password and CSRF token fields from a request body"""
+    if not isinstance(body, dict):
+        return body
+    return {
+        key: value for key, value in body.items()
+        if not (str(key).lower().startswith('password') or key == 'csrfmiddlewaretoken')
+    }
+
+
+class ProfilingMiddleware:
+    """
+    Record request duration, SQL query counts/time and span timings
+
+    Metrics are exposed at /metrics and every response gets a Server-Timing
+    header.  A sampled request (PROFILING['SAMPLE_RATE'], or ``?profile=1``
+    from a staff user) additionally runs under cProfile and its stats are
+    dumped to PROFILING['PROFILE_DIR'].
+    """
+
+    def __init__(self, get_response):
+        config = profiling_settings()
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = config['SAMPLE_RATE']
+        self.profile_dir = config['PROFILE_DIR']
+
+    def __call__(self, request):
+        profile, token = start_profile()
+        profiler = cProfile.Profile() if self._sampled(request) else None
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(profile.query_wrapper):
+                if profiler is None:
+                    response = self.get_response(request)
+                else:
+                    response = profiler.runcall(self.get_response, request)
+        finally:
+            end_profile(token)
+
+        match = request.resolver_match
+        view = (match.url_name or match.route) if match else 'unresolved'
+        # Sent before a streamed body, so it only covers producing the headers
+        response['Server-Timing'] = profile.server_timing()
+        if response.streaming and not response.is_async:
+            # The view's queries run while the body is consumed, record the
+            # request once the stream is closed
+            response.streaming_content = self._stream(
+                response.streaming_content, request, response, view, profile, started
+            )
+        else:
+            self._record(request, response, view, profile, time.perf_counter() - started)
+
+        if profiler is not None:
+            self._dump(profiler, view)
+        return response
+
+    def _stream(self, content, request, response, view, profile, started):
+        chunks = iter(content)
+        try:
+            while True:
+                # Only count what runs while the view's generator does, the
+                # server may run other code between chunks
+                profile, token = start_profile(profile)
+                try:
+                    with connection.execute_wrapper(profile.query_wrapper):
+                        chunk = next(chunks, None)
+                finally:
+                    end_profile(token)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self._record(request, response, view, profile, time.perf_counter() - started)
+
+    def _record(self, request, response, view, profile, duration):
+        metrics.inc('http_requests_total', view=view, method=request.method,
+                    status=response.status_code)
+        metrics.observe('http_request_duration_seconds', duration, view=view)
+        metrics.inc('db_queries_total', profile.queries, view=view)
+        metrics.inc('db_query_duration_seconds_total', profile.query_time, view=view)
+
+    def _sampled(self, request) -> bool:
+        if not self.profile_dir:
+            return False
+        if request.GET.get('profile') == '1' and request.user.is_staff:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _dump(self, profiler: cProfile.Profile, view: str):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        filename = f'{time.strftime("%Y%m%d-%H%M%S")}-{view}-{os.getpid()}-{threading.get_ident()}.prof'
+        profiler.dump_stats(os.path.join(self.profile_dir, filename))
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendation', '0003_prompt_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Label',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImageLabel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='image_labels', to='recommendation.image')),
+                ('label', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='image_labels', to='recommendation.label')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='label_set',
+            field=models.ManyToManyField(related_name='images', through='recommendation.ImageLabel', to='recommendation.label'),
+        ),
+        migrations.AddIndex(
+            model_name='imagelabel',
+            index=models.Index(fields=['label', 'image'], name='recommendat_label_i_c7ccf1_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='imagelabel',
+            unique_together={('image', 'label')},
+        ),
+    ]
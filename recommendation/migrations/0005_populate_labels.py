@@ -0,0 +1,43 @@
+from django.db import migrations
+
+
+def normalize(name):
+    # Same as Label.normalize, models can't be imported in migrations
+    return " ".join(name.split()).lower()
+
+
+def populate_labels(apps, schema_editor):
+    Image = apps.get_model('recommendation', 'Image')
+    Label = apps.get_model('recommendation', 'Label')
+    ImageLabel = apps.get_model('recommendation', 'ImageLabel')
+
+    label_ids = {}
+    batch = []
+    for image in Image.objects.only('id', 'labels').iterator():
+        names = dict.fromkeys(normalize(label) for label in image.labels.split(','))
+        for name in names:
+            if not name:
+                continue
+            if name not in label_ids:
+                label_ids[name] = Label.objects.create(name=name).id
+            batch.append(ImageLabel(image_id=image.id, label_id=label_ids[name]))
+        if len(batch) >= 5000:
+            ImageLabel.objects.bulk_create(batch)
+            batch = []
+    ImageLabel.objects.bulk_create(batch)
+
+
+def clear_labels(apps, schema_editor):
+    apps.get_model('recommendation', 'ImageLabel').objects.all().delete()
+    apps.get_model('recommendation', 'Label').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendation', '0004_label'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_labels, clear_labels),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendation', '0005_populate_labels'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('rank', models.PositiveIntegerField(help_text='1 is the most similar neighbour')),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbours', to='recommendation.image')),
+                ('neighbour', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='recommendation.image')),
+            ],
+            options={
+                'ordering': ['image', 'rank'],
+                'unique_together': {('image', 'rank')},
+            },
+        ),
+    ]
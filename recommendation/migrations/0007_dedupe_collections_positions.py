@@ -0,0 +1,53 @@
+from django.db import migrations
+from django.db.models import Count
+
+
+def dedupe(apps, schema_editor):
+    Collection = apps.get_model('recommendation', 'Collection')
+    CollectionImage = apps.get_model('recommendation', 'CollectionImage')
+    Recommendation = apps.get_model('recommendation', 'Recommendation')
+
+    # Merge collections sharing a name into the oldest one
+    duplicates = (
+        Collection.objects.values('user_id', 'name')
+        .annotate(count=Count('id')).filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        collection_ids = list(
+            Collection.objects.filter(user_id=duplicate['user_id'], name=duplicate['name'])
+            .order_by('id').values_list('id', flat=True)
+        )
+        keeper_id, others = collection_ids[0], collection_ids[1:]
+        kept_image_ids = set(
+            CollectionImage.objects.filter(collection_id=keeper_id).values_list('image_id', flat=True)
+        )
+        for collection_image in CollectionImage.objects.filter(collection_id__in=others).order_by('id'):
+            if collection_image.image_id not in kept_image_ids:
+                kept_image_ids.add(collection_image.image_id)
+                CollectionImage.objects.filter(id=collection_image.id).update(collection_id=keeper_id)
+        Collection.objects.filter(id__in=others).delete()
+
+    # Renumber sessions that ended up with two recommendations at one position
+    session_ids = (
+        Recommendation.objects.values('session_id', 'position')
+        .annotate(count=Count('id')).filter(count__gt=1)
+        .values_list('session_id', flat=True).distinct()
+    )
+    for session_id in list(session_ids):
+        recommendations = list(
+            Recommendation.objects.filter(session_id=session_id).order_by('position', 'id')
+        )
+        for position, recommendation in enumerate(recommendations, start=1):
+            recommendation.position = position
+        Recommendation.objects.bulk_update(recommendations, ['position'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendation', '0006_similarimage'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe, migrations.RunPython.noop),
+    ]
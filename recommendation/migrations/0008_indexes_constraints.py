@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendation', '0007_dedupe_collections_positions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['created_at', 'id'], name='image_created_id_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='collection',
+            constraint=models.UniqueConstraint(fields=('user', 'name'), name='unique_collection_name_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='recommendation',
+            constraint=models.UniqueConstraint(fields=('session', 'position'), name='unique_recommendation_position'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendation', '0008_indexes_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageAsset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_url', models.URLField(help_text='Image URL the asset was fetched from')),
+                ('original', models.CharField(blank=True, help_text='Path of the original in the media store', max_length=255)),
+                ('content_hash', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('thumbnails', models.JSONField(blank=True, default=dict, help_text='Width in pixels -> path in the media store')),
+                ('status', models.CharField(choices=[('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('fetched_at', models.DateTimeField(auto_now=True)),
+                ('image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='asset', to='recommendation.image')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendation', '0010_catalogchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendationsession',
+            name='precomputed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='recommendationsession',
+            name='reference_key',
+            field=models.CharField(blank=True, default='', help_text='Hash of the reference set the session was ranked for', max_length=64),
+        ),
+    ]
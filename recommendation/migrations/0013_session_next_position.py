@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:14
+
+from django.db import migrations, models
+from django.db.models import IntegerField, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def set_next_positions(apps, schema_editor):
+    RecommendationSession = apps.get_model('recommendation', 'RecommendationSession')
+    Recommendation = apps.get_model('recommendation', 'Recommendation')
+
+    last_position = Recommendation.objects.filter(session_id=OuterRef('pk')).values(
+        'session_id'
+    ).annotate(last=Max('position')).values('last')
+    RecommendationSession.objects.update(
+        next_position=Coalesce(Subquery(last_position, output_field=IntegerField()), Value(0)) + 1
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendation', '0012_changecursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendationsession',
+            name='next_position',
+            field=models.PositiveIntegerField(default=1, help_text='First position not taken yet'),
+        ),
+        migrations.RunPython(set_next_positions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:45
+
+from itertools import groupby
+
+from django.db import migrations, models
+
+
+def fill_label_id_cache(apps, schema_editor):
+    Image = apps.get_model('recommendation', 'Image')
+    ImageLabel = apps.get_model('recommendation', 'ImageLabel')
+
+    rows = ImageLabel.objects.order_by('image_id', 'label_id').values_list('image_id', 'label_id').iterator()
+    batch = []
+    for image_id, group in groupby(rows, key=lambda row: row[0]):
+        batch.append(Image(id=image_id, label_id_cache=','.join(str(label_id) for _, label_id in group)))
+        if len(batch) >= 5000:
+            Image.objects.bulk_update(batch, ['label_id_cache'])
+            batch = []
+    Image.objects.bulk_update(batch, ['label_id_cache'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendation', '0013_session_next_position'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='label_id_cache',
+            field=models.TextField(blank=True, default='', editable=False, help_text='Sorted comma-separated Label ids, kept in step with the ImageLabel rows by sync_labels'),
+        ),
+        migrations.RunPython(fill_label_id_cache, migrations.RunPython.noop),
+    ]
@@ -1,18 +1,149 @@
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models, transaction
 from django.contrib.auth.models import User
 
+class Label(models.Model):
+    name = models.CharField(max_length=200, unique=True)
+    
+    def __str__(self):
+        return self.name
+    
+    @staticmethod
+    def normalize(name):
+        """Canonical form of a label: lower case with single spaces"""
+        return " ".join(name.split()).lower()
+
 class Image(models.Model):
     title = models.CharField(max_length=200)
-    image_url = models.URLField()
+    image_url = models.URLField(db_index=True)
     labels = models.TextField(help_text="Comma-separated labels for the image")
+    label_set = models.ManyToManyField(Label, through='ImageLabel', related_name='images')
+    label_id_cache = models.TextField(
+        blank=True, default='', editable=False,
+        help_text="Sorted comma-separated Label ids, kept in step with the ImageLabel rows by sync_labels"
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     
+    class Meta:
+        indexes = [
+            # Newest-first browsing and its (created_at, id) keyset cursor
+            models.Index(fields=['created_at', 'id'], name='image_created_id_idx'),
+        ]
+    
     def __str__(self):
         return self.title
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        image = super().from_db(db, field_names, values)
+        # Labels as loaded, to tell a relabelling from other edits
+        image._loaded_labels = image.__dict__.get('labels')
+        return image
+    
+    def labels_changed(self):
+        """Whether the labels differ from the stored ones, always True for a new image"""
+        return getattr(self, '_loaded_labels', None) != self.labels
+    
+    def thumbnail_url(self, size=None):
+        """
+        URL of the local thumbnail closest to ``size`` pixels (default
+        THUMBNAIL_DEFAULT_SIZE), or the original URL when there is none yet.
+        Select ``asset`` along with the images to avoid a query per image.
+        """
+        try:
+            asset = self.asset
+        except ObjectDoesNotExist:
+            return self.image_url
+        if asset.source_url != self.image_url:
+            # The image was pointed somewhere else since the asset was fetched
+            return self.image_url
+        return asset.thumbnail_url(size) or self.image_url
+    
     def get_label_list(self):
         """Return labels as a list"""
         return [label.strip() for label in self.labels.split(',')]
+    
+    def get_normalized_labels(self):
+        """Return the distinct normalized labels, in order of appearance"""
+        normalized = (Label.normalize(label) for label in self.labels.split(','))
+        return list(dict.fromkeys(label for label in normalized if label))
+    
+    @property
+    def label_ids(self):
+        """Sorted tuple of Label ids, read from label_id_cache without a join"""
+        return tuple(int(label_id) for label_id in self.label_id_cache.split(',') if label_id)
+    
+    @staticmethod
+    def encode_label_ids(label_ids):
+        """label_id_cache value of a set of Label ids"""
+        return ','.join(str(label_id) for label_id in sorted(label_ids))
+    
+    def sync_labels(self):
+        """Rewrite the ImageLabel rows from the comma-separated labels field"""
+        names = self.get_normalized_labels()
+        with transaction.atomic():
+            Label.objects.bulk_create(
+                [Label(name=name) for name in names], ignore_conflicts=True
+            )
+            label_ids = set(Label.objects.filter(name__in=names).values_list('id', flat=True))
+            current_ids = set(self.image_labels.values_list('label_id', flat=True))
+            
+            if current_ids - label_ids:
+                self.image_labels.filter(label_id__in=current_ids - label_ids).delete()
+            ImageLabel.objects.bulk_create([
+                ImageLabel(image=self, label_id=label_id)
+                for label_id in label_ids - current_ids
+            ])
+            cache = self.encode_label_ids(label_ids)
+            if label_ids != current_ids or self.label_id_cache != cache:
+                # update() rather than save(), which would run the signals again
+                Image.objects.filter(pk=self.pk).update(label_id_cache=cache)
+                self.label_id_cache = cache
+
+class ImageAsset(models.Model):
+    """Local copy of an image and its thumbnails (manage.py fetch_assets)"""
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
+    
+    image = models.OneToOneField(Image, on_delete=models.CASCADE, related_name='asset')
+    source_url = models.URLField(help_text="Image URL the asset was fetched from")
+    original = models.CharField(max_length=255, blank=True, help_text="Path of the original in the media store")
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    thumbnails = models.JSONField(default=dict, blank=True, help_text="Width in pixels -> path in the media store")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=READY)
+    error = models.TextField(blank=True)
+    fetched_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.image_id} ({self.status})"
+    
+    def thumbnail_url(self, size=None):
+        """URL of the smallest thumbnail at least ``size`` wide, else the largest one"""
+        if self.status != self.READY or not self.thumbnails:
+            return None
+        size = size or getattr(settings, 'THUMBNAIL_DEFAULT_SIZE', 320)
+        widths = sorted(int(width) for width in self.thumbnails)
+        width = next((width for width in widths if width >= size), widths[-1])
+        return settings.MEDIA_URL.rstrip('/') + '/' + self.thumbnails[str(width)]
+
+class ImageLabel(models.Model):
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='image_labels')
+    label = models.ForeignKey(Label, on_delete=models.CASCADE, related_name='image_labels')
+    
+    class Meta:
+        unique_together = ('image', 'label')
+        indexes = [
+            # Label -> images lookups for candidate filtering
+            models.Index(fields=['label', 'image']),
+        ]
+    
+    def __str__(self):
+        return f"{self.image.title} - {self.label.name}"
 
 class Collection(models.Model):
     name = models.CharField(max_length=200)
@@ -20,6 +151,12 @@ class Collection(models.Model):
     images = models.ManyToManyField(Image, through='CollectionImage')
     created_at = models.DateTimeField(auto_now_add=True)
     
+    class Meta:
+        constraints = [
+            # Makes get_or_create of the Starred/Liked collections race-safe
+            models.UniqueConstraint(fields=['user', 'name'], name='unique_collection_name_per_user'),
+        ]
+    
     def __str__(self):
         return f"{self.name} - {self.user.username}"
 
@@ -42,6 +179,15 @@ class RecommendationSession(models.Model):
     recommended_images = models.ManyToManyField(Image, through='Recommendation', related_name='recommended_in_sessions')
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
+    # Sessions written by manage.py precompute_recommendations stay
+    # precomputed until a request serves them
+    precomputed = models.BooleanField(default=False)
+    reference_key = models.CharField(max_length=64, blank=True, default='',
+                                     help_text="Hash of the reference set the session was ranked for")
+    # Catalog rows are reserved positions 1..n when the session is created,
+    # generated images take theirs from here under a row lock
+    next_position = models.PositiveIntegerField(default=1,
+                                                help_text="First position not taken yet")
     
     def __str__(self):
         return f"Recommendation for {self.user.username} at {self.created_at}"
@@ -56,6 +202,94 @@ class Recommendation(models.Model):
     
     class Meta:
         ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'position'], name='unique_recommendation_position'),
+        ]
+    
+    def __str__(self):
+        return f"Recommendation: {self.image.title} (Score: {self.similarity_score})"
+
+class GenerationJob(models.Model):
+    """AI image generation queued for a recommendation session"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    
+    session = models.ForeignKey(RecommendationSession, on_delete=models.CASCADE, related_name='generation_jobs')
+    prompt = models.TextField()
+    seed = models.IntegerField(null=True, blank=True)
+    labels = models.TextField(help_text="Comma-separated labels for the generated image")
+    title = models.CharField(max_length=200)
+    similarity_score = models.FloatField(default=0.8)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    image = models.ForeignKey(Image, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['created_at', 'id']
+    
+    def __str__(self):
+        return f"{self.title} ({self.status})"
+
+
+class SimilarImage(models.Model):
+    """Precomputed nearest neighbours of an image (manage.py build_similarity)"""
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='neighbours')
+    neighbour = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveIntegerField(help_text="1 is the most similar neighbour")
+    
+    class Meta:
+        ordering = ['image', 'rank']
+        unique_together = ('image', 'rank')
+    
+    def __str__(self):
+        return f"{self.image_id} -> {self.neighbour_id} (Score: {self.score})"
+
+
+class CatalogChange(models.Model):
+    """
+    Append-only log of image inserts, updates and deletes, written by the
+    Image signals.  Derived structures tail it by sequence number, see
+    changes.py.
+    """
+    INSERT = 'insert'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    OP_CHOICES = [
+        (INSERT, 'Insert'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+    ]
+    
+    seq = models.BigAutoField(primary_key=True)
+    # Not a foreign key, deletes are logged after the image is gone
+    image_id = models.BigIntegerField(db_index=True)
+    op = models.CharField(max_length=6, choices=OP_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    class Meta:
+        ordering = ['seq']
+    
+    def __str__(self):
+        return f"#{self.seq} {self.op} image {self.image_id}"
+
+
+class ChangeCursor(models.Model):
+    """Change log position a persistent consumer has applied, see changes.py"""
+    name = models.CharField(max_length=50, primary_key=True)
+    seq = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
-        return f"Recommendation: {self.image.title} (Score: {self.similarity_score})"
\ No newline at end of file
+        return f"{self.name} at #{self.seq}"
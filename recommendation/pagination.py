@@ -0,0 +1,72 @@
+import base64
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .models import CollectionImage, Image
+
+
+def encode_cursor(image: Image) -> str:
+    """Opaque cursor pointing just after an image in browse order"""
+    raw = f"{image.created_at.isoformat()}|{image.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[datetime, int]]:
+    """Return (created_at, id) of a cursor, or None if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, image_id = raw.rsplit('|', 1)
+        created_at = datetime.fromisoformat(created_at)
+        image_id = int(image_id)
+    except (ValueError, UnicodeError):
+        return None
+    if settings.USE_TZ and timezone.is_naive(created_at):
+        # Not one of ours, encode_cursor() always writes the UTC offset
+        return None
+    return created_at, image_id
+
+
+def browse_queryset(user, cursor: Optional[str] = None):
+    """Images after a cursor, newest first, annotated with ``in_collection``"""
+    images = Image.objects.select_related('asset').annotate(
+        in_collection=Exists(CollectionImage.objects.filter(
+            collection__user=user, image=OuterRef('pk')
+        ))
+    ).order_by('-created_at', '-id')
+
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        created_at, image_id = position
+        # The redundant created_at bound turns the OR into a range scan
+        # of the (created_at, id) index
+        images = images.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=image_id),
+            created_at__lte=created_at
+        )
+    return images
+
+
+def browse_page(user, cursor: Optional[str] = None, limit: int = 24) -> Tuple[List[Image], Optional[str]]:
+    """
+    One page of the catalog, newest first, using keyset pagination
+
+    Each image is annotated with ``in_collection`` telling whether the user
+    already has it in one of their collections.
+
+    Args:
+        user (User): User browsing the catalog
+        cursor (str): Cursor returned with the previous page, None for the first
+        limit (int): Page size
+
+    Returns:
+        Tuple[List[Image], Optional[str]]: The images and the cursor of the
+        next page, None on the last page
+    """
+    # Fetch one extra row to know whether there is a next page
+    page = list(browse_queryset(user, cursor)[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
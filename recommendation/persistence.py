@@ -0,0 +1,282 @@
+import atexit
+import logging
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from .models import GenerationJob, Image, Recommendation, RecommendationSession
+from .profiling import span
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationWriter:
+    """Writes recommendation rows in one transaction with bulk inserts"""
+
+    def write_session(self, session: RecommendationSession,
+                      scored_images: List[Tuple[Image, float]]) -> List[Recommendation]:
+        """
+        Save the ranked images of a session
+
+        Args:
+            session (RecommendationSession): Session the rows belong to
+            scored_images (List[Tuple[Image, float]]): Saved images with their
+                scores, in rank order
+
+        Returns:
+            List[Recommendation]: The rows, positions starting at 1
+        """
+        recommendations = [
+            Recommendation(session=session, image=image, similarity_score=score, position=i+1)
+            for i, (image, score) in enumerate(scored_images)
+        ]
+        with transaction.atomic():
+            Recommendation.objects.bulk_create(recommendations)
+        return recommendations
+
+    def write_precomputed(self, rankings: List[Tuple[int, str, List[Tuple[int, float]]]]) -> Tuple[int, int]:
+        """
+        Save precomputed sessions, replacing the unserved ones of the same users
+
+        Args:
+            rankings (List[Tuple[int, str, List[Tuple[int, float]]]]):
+                (user_id, reference_key, [(image_id, score), ...]) per user,
+                images in rank order
+
+        Returns:
+            Tuple[int, int]: Number of sessions and recommendations written
+        """
+        image_ids = {image_id for _, _, ranked in rankings for image_id, _ in ranked}
+        with transaction.atomic():
+            # Images deleted since they were ranked are dropped, like the online path does
+            existing = set(Image.objects.filter(id__in=image_ids).values_list('id', flat=True))
+            RecommendationSession.objects.filter(
+                user_id__in=[user_id for user_id, _, _ in rankings], precomputed=True
+            ).delete()
+            kept = [
+                [(image_id, score) for image_id, score in ranked if image_id in existing]
+                for _, _, ranked in rankings
+            ]
+            sessions = RecommendationSession.objects.bulk_create([
+                RecommendationSession(user_id=user_id, reference_key=reference_key, precomputed=True,
+                                      next_position=len(ranked) + 1)
+                for (user_id, reference_key, _), ranked in zip(rankings, kept)
+            ])
+            recommendations = [
+                Recommendation(session=session, image_id=image_id, similarity_score=score, position=i+1)
+                for session, ranked in zip(sessions, kept)
+                for i, (image_id, score) in enumerate(ranked)
+            ]
+            Recommendation.objects.bulk_create(recommendations, batch_size=5000)
+        return len(sessions), len(recommendations)
+
+    def append_generated(self, completed: List[Tuple[GenerationJob, str]]) -> List[Recommendation]:
+        """
+        Save generated images and append them to their sessions
+
+        Images whose URL is already in the catalog are reused, the rest are
+        inserted in one bulk_create.  Positions are taken from each session's
+        next_position under a row lock, so they never collide with the
+        catalog rows (reserved when the session was created, even while
+        the write-behind writer still holds them) or with other workers.
+        Jobs whose session was deleted meanwhile are dropped.
+
+        Args:
+            completed (List[Tuple[GenerationJob, str]]): Finished jobs and the
+                URL each one produced
+
+        Returns:
+            List[Recommendation]: The appended rows
+        """
+        from .signals import image_saved
+
+        if not completed:
+            return []
+
+        with span('db_write'), transaction.atomic():
+            urls = {image_url for _, image_url in completed}
+            images_by_url = {
+                image.image_url: image
+                for image in Image.objects.filter(image_url__in=urls)
+            }
+            new_images = []
+            for job, image_url in completed:
+                if image_url not in images_by_url:
+                    image = Image(title=job.title, image_url=image_url, labels=job.labels)
+                    images_by_url[image_url] = image
+                    new_images.append(image)
+            Image.objects.bulk_create(new_images)
+            # bulk_create skips post_save, refresh the derived structures here.
+            # A finished generation does not invalidate every user's cached
+            # ranking: the new image is scored from the next ranking on
+            for image in new_images:
+                image_saved(image, created=True, invalidate_rankings=False)
+
+            sessions = RecommendationSession.objects.select_for_update().only(
+                'id', 'next_position'
+            ).in_bulk({job.session_id for job, _ in completed})
+
+            recommendations = []
+            finished_at = timezone.now()
+            for job, image_url in completed:
+                image = images_by_url[image_url]
+                session = sessions.get(job.session_id)
+                if session is not None:
+                    recommendations.append(Recommendation(
+                        session_id=job.session_id,
+                        image=image,
+                        similarity_score=job.similarity_score,
+                        position=session.next_position
+                    ))
+                    session.next_position += 1
+                job.status = GenerationJob.DONE
+                job.image = image
+                job.finished_at = finished_at
+            RecommendationSession.objects.bulk_update(list(sessions.values()), ['next_position'])
+            Recommendation.objects.bulk_create(recommendations)
+            GenerationJob.objects.bulk_update(
+                [job for job, _ in completed if job.session_id in sessions],
+                ['status', 'image', 'finished_at']
+            )
+        return recommendations
+
+
+class WriteBehindRecommendationWriter(RecommendationWriter):
+    """
+    Defers session writes to a background thread that flushes the rows of
+    many requests in one transaction
+
+    The page renders from the unsaved rows straight away.  Until the next
+    flush (at most RECOMMENDATION_WRITE_BEHIND_INTERVAL seconds later) the
+    rows are not visible to other requests such as next_recommendation.
+    A failed flush is retried on the next tick; close() runs at exit.
+    """
+
+    def __init__(self, interval: float = 0.5, max_batch: int = 1000):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending: List[Recommendation] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def write_session(self, session, scored_images):
+        if self._closed:
+            return super().write_session(session, scored_images)
+        recommendations = [
+            Recommendation(session=session, image=image, similarity_score=score, position=i+1)
+            for i, (image, score) in enumerate(scored_images)
+        ]
+        with self._lock:
+            self._pending.extend(recommendations)
+            full = len(self._pending) >= self.max_batch
+            self._ensure_thread()
+        if full:
+            self._wakeup.set()
+        return recommendations
+
+    def flush(self):
+        """
+        Write every pending row now
+
+        When the batch fails its rows are queued again, except the sessions
+        whose rows can never be written (deleted session or image), which
+        are dropped and logged.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            with transaction.atomic():
+                Recommendation.objects.bulk_create(pending)
+        except IntegrityError:
+            # Write session by session so one bad session doesn't block the rest
+            by_session = {}
+            for recommendation in pending:
+                by_session.setdefault(recommendation.session_id, []).append(recommendation)
+            failed = []
+            for session_id, rows in by_session.items():
+                try:
+                    with transaction.atomic():
+                        Recommendation.objects.bulk_create(rows)
+                except IntegrityError:
+                    logger.exception("Dropped %d recommendations of session %s", len(rows), session_id)
+                except Exception:
+                    failed.extend(rows)
+            if failed:
+                self._requeue(failed)
+                raise
+        except Exception:
+            self._requeue(pending)
+            raise
+
+    def _requeue(self, rows: List[Recommendation]):
+        with self._lock:
+            self._pending[:0] = rows
+
+    def close(self, retries: int = 3):
+        """
+        Stop the background thread and write the pending rows
+
+        A failing batch is retried ``retries`` times, ``interval`` seconds
+        apart; rows still unwritten after that are logged and dropped.  Later
+        writes go straight to the database.
+        """
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        for attempt in range(retries + 1):
+            try:
+                self.flush()
+                return
+            except Exception:
+                if attempt == retries:
+                    logger.exception("Dropped %d recommendations at shutdown", len(self._pending))
+                    with self._lock:
+                        self._pending = []
+                    return
+                time.sleep(self.interval)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='recommendation-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._closed:
+                # close() writes what is left
+                return
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error flushing recommendations, retrying in %ss", self.interval)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_recommendation_writer() -> RecommendationWriter:
+    """Return the writer selected by RECOMMENDATION_WRITE_BEHIND"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            if getattr(settings, 'RECOMMENDATION_WRITE_BEHIND', False):
+                _writer = WriteBehindRecommendationWriter(
+                    interval=getattr(settings, 'RECOMMENDATION_WRITE_BEHIND_INTERVAL', 0.5)
+                )
+                atexit.register(_writer.close)
+            else:
+                _writer = RecommendationWriter()
+        return _writer
@@ -0,0 +1,201 @@
+import contextvars
+import threading
+import time
+from contextlib import ContextDecorator
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+# Upper bounds of the duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def profiling_settings() -> dict:
+    config = {'ENABLED': settings.DEBUG, 'SAMPLE_RATE': 0.0, 'PROFILE_DIR': None}
+    config.update(getattr(settings, 'PROFILING', {}))
+    return config
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and histograms, rendered in the Prometheus text
+    exposition format
+
+    Each process keeps its own values; scrape every worker process, or run a
+    single one, to get complete numbers.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        # name -> labels -> [bucket counts..., sum, count]
+        self._histograms: Dict[str, Dict[Labels, List[float]]] = {}
+        # Functions returning counters kept elsewhere, read on every render
+        self._collectors: List[Callable[[], Dict[str, float]]] = []
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def collector(self, function: Callable[[], Dict[str, float]]):
+        """
+        Register a function returning {counter name: value} for counters
+        another object keeps, usable as a decorator
+        """
+        self._collectors.append(function)
+        return function
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            values = series.get(key)
+            if values is None:
+                values = series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def render(self) -> str:
+        """Prometheus text format (version 0.0.4)"""
+        lines = []
+        collected = {}
+        for collect in self._collectors:
+            for name, value in collect().items():
+                collected[name] = {(): value}
+        with self._lock:
+            for name, series in sorted({**self._counters, **collected}.items()):
+                self._header(lines, name, 'counter')
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{name}{_format_labels(labels)} {value:g}')
+            for name, series in sorted(self._histograms.items()):
+                self._header(lines, name, 'histogram')
+                for labels, values in sorted(series.items()):
+                    # Bucket counts are cumulative already, see observe()
+                    for bound, count in zip(self.buckets, values):
+                        le = _format_labels(labels + (('le', f'{bound:g}'),))
+                        lines.append(f'{name}_bucket{le} {count}')
+                    le = _format_labels(labels + (('le', '+Inf'),))
+                    lines.append(f'{name}_bucket{le} {values[-1]}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {values[-2]:g}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines: List[str], name: str, kind: str):
+        kind, help_text = self._help.get(name, (kind, ''))
+        if help_text:
+            lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+metrics = MetricsRegistry()
+metrics.describe('http_requests_total', 'counter', 'Requests handled, by view, method and status')
+metrics.describe('http_request_duration_seconds', 'histogram', 'Request duration by view')
+metrics.describe('db_queries_total', 'counter', 'SQL queries executed, by view')
+metrics.describe('db_query_duration_seconds_total', 'counter', 'Time spent in SQL queries, by view')
+metrics.describe('stage_duration_seconds', 'histogram', 'Duration of instrumented stages (spans)')
+metrics.describe('pollinations_requests_total', 'counter', 'Pollinations.AI requests, by status')
+
+
+class RequestProfile:
+    """Timings collected while one request is handled"""
+
+    def __init__(self):
+        self.spans: List[Tuple[str, float]] = []
+        self.queries = 0
+        self.query_time = 0.0
+
+    def query_wrapper(self, execute, sql, params, many, context):
+        """connection.execute_wrapper hook counting and timing every query"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - started
+
+    def server_timing(self) -> str:
+        """Server-Timing header value, durations in milliseconds"""
+        totals: Dict[str, float] = {}
+        for name, duration in self.spans:
+            totals[name] = totals.get(name, 0.0) + duration
+        entries = [f'{name};dur={duration * 1000:.2f}' for name, duration in totals.items()]
+        entries.append(f'db;desc="{self.queries} queries";dur={self.query_time * 1000:.2f}')
+        return ', '.join(entries)
+
+
+_current_profile: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar(
+    'recommendation_request_profile', default=None
+)
+
+
+def current_profile() -> Optional[RequestProfile]:
+    return _current_profile.get()
+
+
+def start_profile(profile: Optional[RequestProfile] = None) -> Tuple[RequestProfile, contextvars.Token]:
+    """Make a new profile, or resume ``profile``, the current one"""
+    profile = profile or RequestProfile()
+    return profile, _current_profile.set(profile)
+
+
+def end_profile(token: contextvars.Token):
+    _current_profile.reset(token)
+
+
+class span(ContextDecorator):
+    """
+    Time a stage of the request, as a context manager or a decorator
+
+        with span('scoring'):
+            ...
+
+    The duration goes to the stage_duration_seconds histogram and, inside a
+    profiled request, to its Server-Timing header.  Costs two perf_counter
+    calls and a lock, so it can stay on hot paths.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def _recreate_cm(self):
+        # A fresh instance per decorated call, so concurrent calls don't share _started
+        return span(self.name)
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self._started
+        metrics.observe('stage_duration_seconds', duration, stage=self.name)
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.spans.append((self.name, duration))
+        return False
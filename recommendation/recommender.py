@@ -0,0 +1,169 @@
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from .cache import (catalog_version, generation_available, get_cached_recommendations, reference_set_key,
+                    set_cached_recommendations)
+from .jobs import enqueue_generation_jobs
+from .models import CollectionImage, Image, Recommendation, RecommendationSession
+from .persistence import get_recommendation_writer
+from .profiling import span
+from .scoring import rank_images
+
+
+def recommend_for_user(user) -> Tuple[Optional[RecommendationSession], List[Recommendation]]:
+    """
+    Build (or reuse) a recommendation session for a user
+
+    Scores the catalog against the user's starred and liked images, saves
+    the top 10 as a new session and queues AI generated images for it.  When
+    neither the reference set nor the catalog changed since the last call,
+    the previous session is returned as is.
+
+    Returns:
+        Tuple[Optional[RecommendationSession], List[Recommendation]]: The
+        session and its recommendations; (None, []) without reference images
+    """
+    # Get all reference images with their weights
+    with span('references'):
+        collection_images = list(CollectionImage.objects.filter(
+            collection__user=user
+        ).select_related('image'))
+    
+    if not collection_images:
+        # No reference images, return empty recommendations
+        return None, []
+    
+    # Images already in the user's collections are never recommended
+    user_image_ids = {ci.image_id for ci in collection_images}
+    
+    reference_labels = []
+    references = []
+    
+    # Collect all reference labels
+    with span('label_parsing'):
+        for ci in collection_images:
+            reference_labels.extend(ci.image.get_label_list())
+            references.append((ci.image, ci.interaction_type))
+    
+    # Remove duplicates while preserving order
+    reference_labels = list(dict.fromkeys(reference_labels))
+    
+    # Nothing changed since the last visit: serve the last session as is
+    reference_key = reference_set_key([(image.id, weight) for image, weight in references])
+    # Read before ranking: a catalog change made while ranking bumps the
+    # version past this one, and the ranking is then not served again
+    version = catalog_version()
+    cached = get_cached_recommendations(user.id, reference_key, version)
+    if cached:
+        session = RecommendationSession.objects.filter(
+            id=cached['session_id'], user=user, is_active=True
+        ).first()
+        if session:
+            return session, list(session.recommendation_set.select_related('image', 'image__asset'))
+    else:
+        # Ranked ahead of time by manage.py precompute_recommendations.  It is
+        # not cached: the catalog version it was ranked against is unknown
+        session = claim_precomputed_session(user, reference_key)
+        if session:
+            recommendations = list(session.recommendation_set.select_related('image', 'image__asset'))
+            if generation_available():
+                with span('enqueue_generation'):
+                    enqueue_generation_jobs(session, reference_labels, count=10)
+            return session, recommendations
+    
+    if cached:
+        scored_ids = cached['ranked']
+    else:
+        # Score the catalog with the configured scorer and keep the top 10
+        with span('scoring'):
+            scored_ids = rank_images(references, 10, exclude_ids=user_image_ids)
+    
+    images_by_id = Image.objects.select_related('asset').in_bulk(
+        [image_id for image_id, _ in scored_ids]
+    )
+    scored_images = [
+        (images_by_id[image_id], score)
+        for image_id, score in scored_ids
+        if image_id in images_by_id
+    ]
+    
+    # Take top 10 existing images
+    top_existing_images = scored_images[:10]
+    
+    # Create a new recommendation session, its catalog rows take the first
+    # positions and generated images are appended after them
+    session = RecommendationSession.objects.create(
+        user=user, next_position=len(top_existing_images) + 1
+    )
+    
+    # Save recommendations to database in one batch
+    with span('db_write'):
+        recommendations = get_recommendation_writer().write_session(session, top_existing_images)
+    
+    # AI generated images are produced by the generation worker
+    # (manage.py run_generation_worker) and appended to the session as they
+    # finish, so the page never waits on Pollinations.AI
+    # While the Pollinations.AI circuit breaker is open only catalog images
+    # are recommended
+    if generation_available():
+        with span('enqueue_generation'):
+            enqueue_generation_jobs(session, reference_labels, count=10)
+    
+    set_cached_recommendations(user.id, reference_key, scored_ids, session.id, version)
+    
+    return session, recommendations
+
+
+def claim_precomputed_session(user, reference_key: str) -> Optional[RecommendationSession]:
+    """
+    Return the user's precomputed session for this reference set, if one was
+    written in the last PRECOMPUTED_RECOMMENDATIONS_MAX_AGE seconds, and
+    mark it as served so concurrent requests don't both take it
+    """
+    max_age = getattr(settings, 'PRECOMPUTED_RECOMMENDATIONS_MAX_AGE', 3600)
+    session = RecommendationSession.objects.filter(
+        user=user, is_active=True, precomputed=True, reference_key=reference_key,
+        created_at__gte=timezone.now() - timedelta(seconds=max_age)
+    ).order_by('-id').first()
+    if session is None:
+        return None
+    if not RecommendationSession.objects.filter(id=session.id, precomputed=True).update(precomputed=False):
+        return None
+    return session
+
+
+def iter_recommendation_batches(session_id: int, after: int = 0, batch_size: int = 10,
+                                limit: Optional[int] = None):
+    """
+    Yield the recommendations of a session in position order, in batches
+
+    Every batch is a single query with the images joined in.
+
+    Args:
+        session_id (int): Session to read
+        after (int): Only positions greater than this are returned
+        batch_size (int): Rows fetched per query
+        limit (int): Stop after this many rows, None for all of them
+
+    Yields:
+        List[Recommendation]: One batch at a time
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        batch = list(
+            Recommendation.objects.filter(session_id=session_id, position__gt=after)
+            .select_related('image', 'image__asset')
+            .order_by('position')[:size]
+        )
+        if not batch:
+            return
+        yield batch
+        after = batch[-1].position
+        if remaining is not None:
+            remaining -= len(batch)
+        if len(batch) < size:
+            return
@@ -0,0 +1,234 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve
+
+from .benchmark import summarize
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+logger = logging.getLogger(__name__)
+
+
+def load_entries(path: str) -> Tuple[List[dict], int]:
+    """
+    Read a capture file
+
+    Each line is one request::
+
+        {"timestamp": 1760000000.25, "method": "GET", "path": "/similar/5/", "user": "alice"}
+        {"timestamp": 1760000000.75, "method": "POST", "path": "/star-image/", "user": "alice",
+         "json": {"image_id": 5}}
+
+    ``path`` is required and may include a query string.  ``method`` defaults
+    to GET, ``user`` is a username (null for anonymous requests), ``json`` is
+    sent as an application/json body and ``data`` as a form body.
+    ``timestamp`` is only used when replaying at the recorded pace.  Lines
+    without a ``path``, like the entries of the change request backlog, are
+    skipped.  RequestLogMiddleware writes captures in this format.
+
+    Returns:
+        Tuple[List[dict], int]: The replayable entries and the number of
+        lines that were skipped
+    """
+    entries = []
+    skipped = 0
+    with open(path) as capture:
+        for line in capture:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if not isinstance(entry, dict) or not entry.get('path'):
+                skipped += 1
+                continue
+            entries.append(entry)
+    return entries, skipped
+
+
+def url_name(path: str) -> str:
+    """Name of the URL pattern serving a path"""
+    try:
+        match = resolve(path.split('?', 1)[0])
+    except Resolver404:
+        return 'unresolved'
+    return match.url_name or match.route
+
+
+def histogram(latencies: List[float]) -> Dict[str, int]:
+    """Request count per latency bucket, latencies in seconds"""
+    counts = {f'<={bound}ms': 0 for bound in HISTOGRAM_BUCKETS}
+    counts[f'>{HISTOGRAM_BUCKETS[-1]}ms'] = 0
+    for latency in latencies:
+        milliseconds = latency * 1000
+        for bound in HISTOGRAM_BUCKETS:
+            if milliseconds <= bound:
+                counts[f'<={bound}ms'] += 1
+                break
+        else:
+            counts[f'>{HISTOGRAM_BUCKETS[-1]}ms'] += 1
+    return counts
+
+
+class Replayer:
+    """
+    Send captured requests through the Django test client, or to a running
+    server when ``base_url`` is given
+
+    Requests are issued by ``concurrency`` threads.  ``rate`` caps the number
+    of requests started per second, ``speed`` replays at the recorded pace
+    (2.0 is twice as fast); without either the requests go out back to back.
+    Query counts are only available with the test client, since they are
+    captured on this process' database connections.
+    """
+
+    def __init__(self, concurrency: int = 1, rate: Optional[float] = None,
+                 speed: Optional[float] = None, base_url: Optional[str] = None,
+                 timeout: float = 30):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.speed = speed
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._results: Dict[str, dict] = {}
+
+    def run(self, entries: List[dict]) -> dict:
+        """
+        Replay the entries and return the report
+
+        Returns:
+            dict: Per URL name: request count, errors, latency percentiles,
+            histogram and DB queries per request (test client only)
+        """
+        self._results = {}
+        started = time.perf_counter()
+        first_timestamp = entries[0].get('timestamp') if entries else None
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for i, entry in enumerate(entries):
+                due = self._due(i, entry, first_timestamp)
+                if due is not None:
+                    delay = started + due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(self._replay, entry)
+        elapsed = time.perf_counter() - started
+
+        report = {}
+        for name, result in sorted(self._results.items()):
+            summary = summarize(result['latencies'], elapsed, result['errors'])
+            # Throughput over the whole run is only meaningful overall
+            summary.pop('throughput_rps', None)
+            summary['histogram'] = histogram(result['latencies'])
+            if result['queries']:
+                queries = result['queries']
+                summary['queries_mean'] = round(sum(queries) / len(queries), 2)
+                summary['queries_max'] = max(queries)
+            report[name] = summary
+        return {
+            'requests': len(entries),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(len(entries) / elapsed, 2) if elapsed > 0 else None,
+            'concurrency': self.concurrency,
+            'target': self.base_url or 'test client',
+            'urls': report,
+        }
+
+    def _due(self, i: int, entry: dict, first_timestamp: Optional[float]) -> Optional[float]:
+        """Seconds after the start at which an entry should be sent"""
+        if self.speed and first_timestamp is not None and entry.get('timestamp') is not None:
+            return (entry['timestamp'] - first_timestamp) / self.speed
+        if self.rate:
+            return i / self.rate
+        return None
+
+    def _replay(self, entry: dict):
+        name = url_name(entry['path'])
+        queries = None
+        started = time.perf_counter()
+        try:
+            if self.base_url:
+                ok = self._send_http(entry)
+            else:
+                # Log in before counting, force_login queries the database
+                client = self._client(entry.get('user'))
+                with CaptureQueriesContext(connection) as captured:
+                    ok = self._send_client(client, entry)
+                queries = len(captured.captured_queries)
+        except Exception as e:
+            logger.warning("Error replaying %s: %s", entry['path'], e)
+            ok = False
+        latency = time.perf_counter() - started
+
+        with self._lock:
+            result = self._results.setdefault(name, {'latencies': [], 'errors': 0, 'queries': []})
+            result['latencies'].append(latency)
+            result['errors'] += not ok
+            if queries is not None:
+                result['queries'].append(queries)
+
+    def _client(self, username: Optional[str]) -> Client:
+        """Test client of this thread logged in as ``username``"""
+        clients = self._local.__dict__.setdefault('clients', {})
+        if username not in clients:
+            client = Client(HTTP_HOST='localhost')
+            if username:
+                client.force_login(User.objects.get(username=username))
+            clients[username] = client
+        return clients[username]
+
+    def _send_client(self, client: Client, entry: dict) -> bool:
+        method = entry.get('method', 'GET').upper()
+        if 'json' in entry:
+            response = client.generic(method, entry['path'], json.dumps(entry['json']),
+                                      content_type='application/json')
+        elif method == 'POST':
+            response = client.post(entry['path'], entry.get('data', {}))
+        else:
+            response = client.generic(method, entry['path'])
+        # Drain streaming responses so their queries and time are counted
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response.status_code < 400
+
+    def _session(self, username: Optional[str]):
+        """requests.Session of this thread carrying ``username``'s session cookie"""
+        import requests
+
+        sessions = self._local.__dict__.setdefault('sessions', {})
+        if username not in sessions:
+            session = requests.Session()
+            if username:
+                # Log in through the session store shared with the server
+                client = Client()
+                client.force_login(User.objects.get(username=username))
+                for cookie in client.cookies.values():
+                    session.cookies.set(cookie.key, cookie.value)
+            sessions[username] = session
+        return sessions[username]
+
+    def _send_http(self, entry: dict) -> bool:
+        session = self._session(entry.get('user'))
+        method = entry.get('method', 'GET').upper()
+        kwargs = {'timeout': self.timeout}
+        if 'json' in entry:
+            kwargs['json'] = entry['json']
+        elif 'data' in entry:
+            kwargs['data'] = entry['data']
+        response = session.request(method, self.base_url + entry['path'], **kwargs)
+        return response.status_code < 400
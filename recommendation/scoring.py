@@ -0,0 +1,500 @@
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .index import LabelIndex, label_index
+from .topk import SCORE_DECIMALS, CosineBound, TopK, push_bounded
+
+logger = logging.getLogger(__name__)
+
+
+def _file_id(path: str) -> Optional[Tuple[int, int]]:
+    """(inode, mtime) of a file, changes when it is replaced; None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+class LabelMatrix:
+    """
+    Sparse binary image x label matrix in CSR layout.
+
+    Row ``r`` holds the (de-duplicated) labels of ``image_ids[r]``; rows are
+    ordered by ascending image id so that ties resolve the same way as a
+    stable sort over the id-ordered catalog.
+    """
+
+    def __init__(self, vocabulary: Dict[str, int], image_ids: np.ndarray,
+                 indptr: np.ndarray, indices: np.ndarray,
+                 norms: Optional[np.ndarray] = None, rows: Optional[np.ndarray] = None):
+        self.vocabulary = vocabulary
+        self.image_ids = image_ids
+        self.indptr = indptr
+        self.indices = indices
+
+        row_lengths = np.diff(indptr)
+        self.norms = norms if norms is not None else np.sqrt(row_lengths.astype(np.float64))
+        # Row number of every stored entry, used for the CSR mat-vec product
+        self.rows = rows if rows is not None else np.repeat(np.arange(len(image_ids)), row_lengths)
+
+    @classmethod
+    def from_labels(cls, labels_by_id: Dict[int, Iterable[str]]) -> 'LabelMatrix':
+        """Encode an image id -> labels mapping"""
+        vocabulary: Dict[str, int] = {}
+        image_ids = sorted(labels_by_id)
+        indptr = np.zeros(len(image_ids) + 1, dtype=np.int64)
+        indices: List[int] = []
+
+        for row, image_id in enumerate(image_ids):
+            columns = {vocabulary.setdefault(label, len(vocabulary))
+                       for label in labels_by_id[image_id]}
+            indices.extend(sorted(columns))
+            indptr[row + 1] = len(indices)
+
+        return cls(
+            vocabulary,
+            np.asarray(image_ids, dtype=np.int64),
+            indptr,
+            np.asarray(indices, dtype=np.int64),
+        )
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def diff(self, labels_by_id: Dict[int, Iterable[str]]) -> Dict[int, Optional[Tuple[str, ...]]]:
+        """
+        Rows that differ from an image id -> labels mapping
+
+        Returns:
+            Dict[int, Optional[Tuple[str, ...]]]: Image id -> current labels of
+            the images added or relabelled since, None for the removed ones
+        """
+        columns = sorted(self.vocabulary, key=self.vocabulary.get)
+        stored = {image_id: row for row, image_id in enumerate(self.image_ids.tolist())}
+        changes: Dict[int, Optional[Tuple[str, ...]]] = {}
+        for image_id, labels in labels_by_id.items():
+            labels = tuple(labels)
+            row = stored.pop(image_id, None)
+            if row is not None:
+                start, stop = self.indptr[row], self.indptr[row + 1]
+                if {columns[column] for column in self.indices[start:stop].tolist()} == set(labels):
+                    continue
+            changes[image_id] = labels
+        changes.update(dict.fromkeys(stored))
+        return changes
+
+    def query_vector(self, references: List[Tuple[List[str], int]]) -> Dict[str, float]:
+        """
+        Fold the weighted reference set into one label -> weight mapping
+
+        Weighted cosine against every reference is linear in the candidate row,
+        so sum_r w_r * |A_r & B| / sqrt(|A_r| |B|) equals (B . q) / sqrt(|B|)
+        with q[label] = sum over references containing label of w_r / sqrt(|A_r|).
+        """
+        query: Dict[str, float] = {}
+        for labels, weight in references:
+            label_set = set(labels)
+            if not label_set:
+                continue
+            contribution = weight / np.sqrt(len(label_set))
+            for label in label_set:
+                query[label] = query.get(label, 0.0) + contribution
+        return query
+
+    def _dense(self, query: Dict[str, float]) -> np.ndarray:
+        dense = np.zeros(len(self.vocabulary), dtype=np.float64)
+        for label, value in query.items():
+            column = self.vocabulary.get(label)
+            if column is not None:
+                dense[column] = value
+        return dense
+
+    def scores(self, query: Dict[str, float]) -> np.ndarray:
+        """Return the un-normalized weighted cosine score of every row"""
+        dense = self._dense(query)
+        dot = np.bincount(self.rows, weights=dense[self.indices], minlength=len(self))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.norms > 0, dot / self.norms, 0.0)
+
+    def row_scores(self, query: Dict[str, float], rows: np.ndarray) -> np.ndarray:
+        """Same as scores(), for the given rows only"""
+        dense = self._dense(query)
+        counts = self.indptr[rows + 1] - self.indptr[rows]
+        # Entries of the selected rows, in row order
+        starts = np.repeat(self.indptr[rows] - np.cumsum(counts) + counts, counts)
+        entries = starts + np.arange(counts.sum())
+        dot = np.bincount(np.repeat(np.arange(len(rows)), counts),
+                          weights=dense[self.indices[entries]], minlength=len(rows))
+        norms = self.norms[rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(norms > 0, dot / norms, 0.0)
+
+    def score_labels(self, query: Dict[str, float], labels: Iterable[str]) -> float:
+        """Score a single label list exactly like a row of the matrix would be"""
+        label_set = set(labels)
+        if not label_set:
+            return 0.0
+        # Accumulate in column order so identical label sets score identically
+        missing = len(self.vocabulary)
+        ordered = sorted(label_set, key=lambda label: (self.vocabulary.get(label, missing), label))
+        dot = 0.0
+        for label in ordered:
+            dot += query.get(label, 0.0)
+        return float(dot / np.sqrt(len(label_set)))
+
+
+def select_top_k(image_ids: np.ndarray, scores: np.ndarray, k: int) -> List[Tuple[int, float]]:
+    """Top-k by score with ties (to SCORE_DECIMALS) broken on ascending image id"""
+    if len(scores) == 0 or k <= 0:
+        return []
+    k = min(k, len(scores))
+    keys = np.round(scores, SCORE_DECIMALS)
+    top = np.argpartition(-keys, k - 1)[:k]
+    # Widen the pool to every row tied with the k-th score so the
+    # id tie-break is exact, then order the (small) pool fully
+    pool = np.flatnonzero(keys >= keys[top].min())
+    order = pool[np.lexsort((image_ids[pool], -keys[pool]))][:k]
+    return [(int(image_ids[i]), float(scores[i])) for i in order]
+
+
+class ScoringEngine:
+    """
+    Vectorized weighted-cosine scorer over the whole catalog.
+
+    The label matrix is built from a snapshot of the label index.  Images that
+    change afterwards are masked out of the matrix and scored individually,
+    and the matrix is rebuilt once too many rows have drifted.
+
+    With ``path`` set (LABEL_MATRIX_PATH) the matrix is memory-mapped from the
+    file written by ``manage.py export_label_matrix`` instead, so worker
+    processes start without reading the catalog and share one copy of it.
+    Images changed since the export are then tracked here, from the catalog
+    change log and from this process' signals (note_saved()), and the file
+    is reopened once it has been replaced.
+    """
+
+    def __init__(self, index: LabelIndex, rebuild_threshold: float = 0.01,
+                 min_rebuild: int = 1000, path: Optional[str] = None):
+        self.index = index
+        self.rebuild_threshold = rebuild_threshold
+        self.min_rebuild = min_rebuild
+        self.path = path
+        self._lock = threading.Lock()
+        self._matrix: Optional[LabelMatrix] = None
+        self._consumer = None
+        # Mapped mode: image id -> current labels (None once deleted) of the
+        # images changed since the file was exported
+        self._file_changes: Dict[int, Optional[Tuple[str, ...]]] = {}
+        # (inode, mtime) of an exported file _open_file() could not use
+        self._rejected_file: Optional[Tuple[int, int]] = None
+
+    @classmethod
+    def from_settings(cls, index: LabelIndex) -> 'ScoringEngine':
+        from django.conf import settings
+
+        return cls(index, path=getattr(settings, 'LABEL_MATRIX_PATH', None))
+
+    def matrix(self) -> LabelMatrix:
+        with self._lock:
+            if self._mapped():
+                from .matrix_file import MappedLabelMatrix
+
+                if not isinstance(self._matrix, MappedLabelMatrix) or not self._matrix.is_current():
+                    self._open_file()
+                elif self._consumer.due():
+                    self._apply_changes()
+            if not self._mapped() and (self._matrix is None or self._is_stale(self._matrix)):
+                self._matrix = LabelMatrix.from_labels(self.index.snapshot())
+            return self._matrix
+
+    def _open_file(self):
+        """
+        Map the exported file, caller holds the lock
+
+        A file that can't be used (other format version, or exported from a
+        change log that ends before its ``change_seq``, e.g. another
+        database) is ignored until it is replaced, and the matrix is built
+        from the catalog instead.
+        """
+        from .changes import ChangeConsumer, latest_seq, poll_interval
+        from .matrix_file import LabelMatrixFileError, MappedLabelMatrix
+
+        file_id = _file_id(str(self.path))
+        try:
+            matrix = MappedLabelMatrix(str(self.path))
+            newest = latest_seq()
+            if matrix.change_seq > newest:
+                raise LabelMatrixFileError(
+                    f"{self.path} is current up to change #{matrix.change_seq}, the log ends at #{newest}"
+                )
+        except LabelMatrixFileError as exc:
+            logger.warning('%s, building the label matrix from the catalog instead', exc)
+            self._rejected_file = file_id
+            self._matrix = None
+            self._consumer = None
+            self._file_changes = {}
+            return
+        self._consumer = ChangeConsumer(since=matrix.change_seq, interval=poll_interval())
+        self._file_changes = {}
+        self._matrix = matrix
+        self._apply_changes()
+
+    def _mapped(self) -> bool:
+        return bool(self.path) and _file_id(str(self.path)) not in (None, self._rejected_file)
+
+    def _is_stale(self, matrix: LabelMatrix) -> bool:
+        limit = max(self.min_rebuild, int(len(matrix) * self.rebuild_threshold))
+        return len(self.index.changed_ids()) > limit
+
+    def _apply_changes(self):
+        """Read the changes logged since the last poll, caller holds the lock"""
+        from .changes import ChangeConsumer, ChangeLogPruned, current_labels, latest_seq
+
+        try:
+            self._file_changes.update(current_labels(self._consumer.poll()))
+        except ChangeLogPruned:
+            logger.warning('Catalog change log pruned past the label matrix file, comparing it with the catalog')
+            self._consumer = ChangeConsumer(since=latest_seq(), interval=self._consumer.interval)
+            self.index.build()
+            self._file_changes = self._matrix.diff(self.index.labels())
+
+    def note_saved(self, image):
+        """Track an image saved after the mapped matrix was exported"""
+        if self.path:
+            with self._lock:
+                self._file_changes[image.id] = tuple(image.get_label_list())
+
+    def note_deleted(self, image_id: int):
+        if self.path:
+            with self._lock:
+                self._file_changes[image_id] = None
+
+    def invalidate(self):
+        with self._lock:
+            self._matrix = None
+
+    def sync(self):
+        """Apply the changes logged so far now rather than at the next poll"""
+        self.index.ensure_built()
+        self.index.sync()
+        with self._lock:
+            if self._consumer is not None and self._mapped():
+                self._apply_changes()
+
+    def changes(self) -> Dict[int, Optional[Tuple[str, ...]]]:
+        """Current labels (None when deleted) of the images changed since the matrix was built"""
+        if self._mapped():
+            with self._lock:
+                return dict(self._file_changes)
+        self.index.ensure_built()
+        return {image_id: self.index.labels_for(image_id) for image_id in self.index.changed_ids()}
+
+    def top_k(self, references: List[Tuple[List[str], int]], k: int,
+              exclude_ids: Iterable[int] = ()) -> List[Tuple[int, float]]:
+        """
+        Return the k best (image_id, score) pairs for a weighted reference set
+
+        Args:
+            references (List[Tuple[List[str], int]]): (labels, weight) pairs
+            k (int): Number of results wanted
+            exclude_ids (Iterable[int]): Image ids that must not be returned
+
+        Returns:
+            List[Tuple[int, float]]: Sorted by score descending, then id
+            ascending.  Zero-score images are included when fewer than k
+            images overlap the references.
+        """
+        total_weight = sum(weight for _, weight in references)
+        if k <= 0 or total_weight <= 0:
+            return []
+
+        matrix, query, image_ids, scores, changed = self._matrix_scores(references, exclude_ids)
+        top = TopK(k)
+        top.extend(select_top_k(image_ids, scores, k))
+        # Changed rows are scored one by one, only while they can still enter
+        push_bounded(top, changed.items(),
+                     lambda labels: matrix.score_labels(query, labels) / total_weight,
+                     CosineBound(references))
+        return top.results()
+
+    def scores_for(self, references: List[Tuple[List[str], int]],
+                   exclude_ids: Iterable[int] = ()) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Weighted average cosine score of every catalog image
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Image ids and their scores.  Rows
+            that changed since the matrix was built are scored one by one and
+            appended at the end, so ids are not necessarily sorted.
+        """
+        total_weight = sum(weight for _, weight in references)
+        matrix, query, image_ids, scores, changed = self._matrix_scores(references, exclude_ids)
+
+        # Rows that changed since the matrix was built are scored one by one
+        extra_ids, extra_scores = [], []
+        for image_id in sorted(changed):
+            extra_ids.append(image_id)
+            extra_scores.append(matrix.score_labels(query, changed[image_id]) / total_weight)
+        if extra_ids:
+            image_ids = np.concatenate([image_ids, np.asarray(extra_ids, dtype=np.int64)])
+            scores = np.concatenate([scores, np.asarray(extra_scores, dtype=np.float64)])
+        return image_ids, scores
+
+    def _matrix_scores(self, references: List[Tuple[List[str], int]], exclude_ids: Iterable[int]):
+        """
+        Score the matrix rows that are still current
+
+        Returns the matrix, the query vector, the ids and scores of the rows
+        neither excluded nor changed, and the current labels of the changed
+        images that are not excluded or deleted.
+        """
+        total_weight = sum(weight for _, weight in references)
+        matrix = self.matrix()
+        changes = self.changes()
+        exclude_set = set(exclude_ids)
+        excluded = np.fromiter(exclude_set | set(changes), dtype=np.int64)
+
+        query = matrix.query_vector(references)
+        scores = matrix.scores(query) / total_weight
+        valid = ~np.isin(matrix.image_ids, excluded)
+        changed = {
+            image_id: labels for image_id, labels in changes.items()
+            if labels is not None and image_id not in exclude_set
+        }
+        return matrix, query, matrix.image_ids[valid], scores[valid], changed
+
+scoring_engine = ScoringEngine.from_settings(label_index)
+
+
+def sql_top_k(references: List[Tuple[int, int]], k: int,
+              exclude_ids: Iterable[int] = ()) -> List[Tuple[int, float]]:
+    """
+    Score candidates in the database with a single aggregate query
+
+    Joins the candidates to the reference images through the ImageLabel table
+    and computes sum_r w_r * |A_r & B| / sqrt(|A_r| |B|) / sum_r w_r per image,
+    so only images sharing a label with a reference are ever touched.  Works on
+    SQLite and PostgreSQL.  Ties to SCORE_DECIMALS decimals are broken on
+    ascending id, like the in-process scorers.
+
+    Labels are compared in their normalized form (Label.normalize: lower
+    case, single spaces) while the in-process scorers compare them as
+    stored, only stripped.  Catalogs whose labels differ in case or spacing
+    therefore rank differently here.
+
+    Args:
+        references (List[Tuple[int, int]]): (image_id, weight) pairs
+        k (int): Number of results wanted
+        exclude_ids (Iterable[int]): Image ids that must not be returned
+
+    Returns:
+        List[Tuple[int, float]]: Sorted by score descending, then id
+        ascending, padded with zero-score images when fewer than k overlap.
+    """
+    from django.db import connection
+
+    from .models import Image, ImageLabel
+
+    if k <= 0 or not references or sum(weight for _, weight in references) <= 0:
+        return []
+
+    exclude_ids = sorted(set(exclude_ids))
+    image_label = connection.ops.quote_name(ImageLabel._meta.db_table)
+
+    # One row per reference; the same image may appear twice (liked and
+    # starred) and then counts twice, like it does in the Python scorer
+    reference_rows = ", ".join(["(%s, %s, %s)"] * len(references))
+    params: List = []
+    for ref_key, (image_id, weight) in enumerate(references):
+        params.extend([ref_key, image_id, weight])
+
+    exclude_clause = ""
+    if exclude_ids:
+        exclude_clause = "WHERE cand.image_id NOT IN (%s)" % ", ".join(["%s"] * len(exclude_ids))
+        params.extend(exclude_ids)
+    params.append(k)
+
+    query = f"""
+        WITH ref (ref_key, image_id, weight) AS (VALUES {reference_rows}),
+        ref_size AS (
+            SELECT ref.ref_key, ref.weight, COUNT(il.label_id) AS size
+            FROM ref LEFT JOIN {image_label} il ON il.image_id = ref.image_id
+            GROUP BY ref.ref_key, ref.weight
+        ),
+        overlap AS (
+            SELECT cand.image_id, ref.ref_key, COUNT(*) AS shared
+            FROM ref
+            JOIN {image_label} rl ON rl.image_id = ref.image_id
+            JOIN {image_label} cand ON cand.label_id = rl.label_id
+            {exclude_clause}
+            GROUP BY cand.image_id, ref.ref_key
+        ),
+        cand_size AS (
+            SELECT il.image_id, COUNT(*) AS size
+            FROM {image_label} il
+            WHERE il.image_id IN (SELECT DISTINCT image_id FROM overlap)
+            GROUP BY il.image_id
+        ),
+        scored AS (
+            SELECT o.image_id,
+                   SUM(rs.weight * o.shared / SQRT(1.0 * rs.size * cs.size))
+                       / (SELECT SUM(weight) FROM ref) AS score
+            FROM overlap o
+            JOIN ref_size rs ON rs.ref_key = o.ref_key
+            JOIN cand_size cs ON cs.image_id = o.image_id
+            GROUP BY o.image_id
+        )
+        SELECT image_id, score
+        FROM scored
+        ORDER BY ROUND(CAST(score AS NUMERIC), {SCORE_DECIMALS}) DESC, image_id
+        LIMIT %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        results = [(image_id, float(score)) for image_id, score in cursor.fetchall()]
+
+    # Pad with zero-score images in catalog order, same as a full scan would
+    if len(results) < k:
+        padding = Image.objects.exclude(
+            id__in=set(exclude_ids) | {image_id for image_id, _ in results}
+        ).order_by('id').values_list('id', flat=True)[:k - len(results)]
+        results.extend((image_id, 0.0) for image_id in padding)
+    return results
+
+
+def rank_images(references, k: int, exclude_ids: Iterable[int] = ()) -> List[Tuple[int, float]]:
+    """
+    Rank catalog images against weighted reference images
+
+    Dispatches to the scorer selected by the RECOMMENDATION_SCORER setting:
+    'matrix' (in-process sparse matrix, the default), 'sql' (one aggregate
+    query in the database) or 'lsh' (MinHash LSH candidates, re-ranked
+    exactly, see lsh.py).
+
+    Args:
+        references (List[Tuple[Image, int]]): (reference image, weight) pairs
+        k (int): Number of results wanted
+        exclude_ids (Iterable[int]): Image ids that must not be returned
+
+    Returns:
+        List[Tuple[int, float]]: (image_id, score) sorted by score descending
+    """
+    from django.conf import settings
+
+    scorer = getattr(settings, 'RECOMMENDATION_SCORER', 'matrix')
+    if scorer == 'sql':
+        return sql_top_k([(image.id, weight) for image, weight in references], k, exclude_ids)
+    if scorer == 'lsh':
+        from .lsh import lsh_engine
+
+        return lsh_engine.top_k(
+            [(image.get_label_list(), weight) for image, weight in references], k, exclude_ids
+        )
+    return scoring_engine.top_k(
+        [(image.get_label_list(), weight) for image, weight in references], k, exclude_ids
+    )
@@ -1,18 +1,206 @@
-import requests
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import List, Optional
+
+import requests
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .cache import (PromptCache, get_prompt_cache, mark_generation_available,
+                    mark_generation_unavailable)
+from .media import ContentAddressedStore, MediaTooLarge, get_media_store
+from .profiling import metrics, span
+
+logger = logging.getLogger(__name__)
+
+# Process-wide cap on in-flight Pollinations requests, created on first use
+_generation_slots = None
+_generation_slots_lock = threading.Lock()
+
+
+def get_generation_slots() -> threading.BoundedSemaphore:
+    """Return the semaphore limiting concurrent Pollinations requests"""
+    global _generation_slots
+    with _generation_slots_lock:
+        if _generation_slots is None:
+            _generation_slots = threading.BoundedSemaphore(
+                getattr(settings, 'POLLINATIONS_MAX_CONCURRENCY', 8)
+            )
+        return _generation_slots
+
+
+# Keep-alive connection pool shared by every service instance of the process
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """
+    Return the pooled HTTP session used for Pollinations.AI
+
+    Connections are reused across requests (no new TCP/TLS handshake per
+    image), and connection errors and 429/5xx answers are retried up to
+    POLLINATIONS_RETRIES times with exponential backoff.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(
+                total=getattr(settings, 'POLLINATIONS_RETRIES', 2),
+                backoff_factor=getattr(settings, 'POLLINATIONS_RETRY_BACKOFF', 0.5),
+                backoff_max=getattr(settings, 'POLLINATIONS_RETRY_BACKOFF_MAX', 4),
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['GET', 'HEAD']),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            pool_size = getattr(settings, 'POLLINATIONS_MAX_CONCURRENCY', 8)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+
+class CircuitBreaker:
+    """
+    Stops calling Pollinations.AI after repeated failures
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    every request is refused at once.  Once ``reset_timeout`` seconds have
+    passed a single probe request is let through (half-open): success closes
+    the breaker, failure opens it again.  The open state is also published in
+    the default Django cache so web processes stop queueing generations.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout  # seconds
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._reset_elapsed():
+                return self.HALF_OPEN
+            return self._state
+
+    def is_open(self) -> bool:
+        """Whether requests are currently refused (no probe is due yet)"""
+        return self.state == self.OPEN
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and not self._reset_elapsed():
+                return False
+            # Half-open: let one probe through at a time
+            if self._probing:
+                return False
+            self._state = self.HALF_OPEN
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            was_closed = self._state == self.CLOSED
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+        if not was_closed:
+            logger.info("Pollinations.AI circuit breaker closed")
+            mark_generation_available()
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == self.OPEN:
+                return
+            if self._state == self.CLOSED and self._failures < self.failure_threshold:
+                return
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+        logger.warning("Pollinations.AI circuit breaker opened after %d failures", self._failures)
+        metrics.inc('pollinations_breaker_opened_total')
+        mark_generation_unavailable(self.reset_timeout)
+
+    def _reset_elapsed(self) -> bool:
+        return time.monotonic() - self._opened_at >= self.reset_timeout
+
+
+_circuit_breaker = None
+_circuit_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Return the process-wide Pollinations.AI circuit breaker"""
+    global _circuit_breaker
+    with _circuit_breaker_lock:
+        if _circuit_breaker is None:
+            _circuit_breaker = CircuitBreaker(
+                failure_threshold=getattr(settings, 'POLLINATIONS_BREAKER_THRESHOLD', 5),
+                reset_timeout=getattr(settings, 'POLLINATIONS_BREAKER_RESET', 30),
+            )
+        return _circuit_breaker
 
 class PollinationsAIService:
     """
     Service class for interacting with Pollinations.AI API
+
+    ``fetch_mode`` (POLLINATIONS_FETCH_MODE) decides what happens with the
+    generated image:
+
+    - 'stream': GET, but only the headers are read and the browser fetches
+      the image from the final URL; only bodies of up to
+      POLLINATIONS_DRAIN_LIMIT bytes (error pages) are read so their
+      connection goes back to the pool, an image closes its connection unread
+    - 'head': HEAD request following redirects, for upstreams that generate
+      on HEAD as well
+    - 'get': download the whole body and drop it (the original behaviour)
+    - 'store': stream the body once into the local content-addressed media
+      store and return the local URL instead
     """
+    FETCH_MODES = ('stream', 'head', 'get', 'store')
     
-    def __init__(self):
-        self.base_url = "https://image.pollinations.ai/prompt"
-        self.timeout = 30  # seconds
+    def __init__(self, base_url: Optional[str] = None, timeout: Optional[float] = None,
+                 cache: Optional[PromptCache] = None, session: Optional[requests.Session] = None,
+                 breaker: Optional[CircuitBreaker] = None, fetch_mode: Optional[str] = None,
+                 media_store: Optional[ContentAddressedStore] = None):
+        self.base_url = base_url or getattr(
+            settings, 'POLLINATIONS_BASE_URL', "https://image.pollinations.ai/prompt"
+        )
+        self.timeout = timeout or getattr(settings, 'POLLINATIONS_TIMEOUT', 30)  # seconds
+        self.connect_timeout = getattr(settings, 'POLLINATIONS_CONNECT_TIMEOUT', 5)  # seconds
+        self.cache = cache or get_prompt_cache()
+        self.session = session or get_http_session()
+        self.breaker = breaker or get_circuit_breaker()
+        self.fetch_mode = fetch_mode or getattr(settings, 'POLLINATIONS_FETCH_MODE', 'stream')
+        if self.fetch_mode not in self.FETCH_MODES:
+            raise ValueError(f"Unknown POLLINATIONS_FETCH_MODE {self.fetch_mode!r}")
+        self.drain_limit = getattr(settings, 'POLLINATIONS_DRAIN_LIMIT', 4 * 1024)  # bytes
+        self._media_store = media_store
+    
+    @property
+    def media_store(self) -> ContentAddressedStore:
+        if self._media_store is None:
+            self._media_store = get_media_store()
+        return self._media_store
     
     def generate_image(self, prompt: str, width: int = 512, height: int = 512, 
-                      model: str = "flux") -> Optional[str]:
+                      model: str = "flux", seed: Optional[int] = None) -> Optional[str]:
         """
         Generate an image using Pollinations.AI API
         
@@ -21,28 +209,92 @@ class PollinationsAIService:
             width (int): Width of the generated image
             height (int): Height of the generated image
             model (str): Model to use for generation
+            seed (int): Optional seed, different seeds give different images
+                for the same prompt
             
         Returns:
             str: URL of the generated image, or None if failed
         """
+        # Identical requests give identical images, so serve them from the cache
+        cache_key = (prompt, width, height, model, seed)
+        image_url = self.cache.get(cache_key)
+        if image_url:
+            return image_url
+        
+        image_url = self._request_image(prompt, width, height, model, seed)
+        if image_url:
+            self.cache.set(cache_key, image_url)
+        return image_url
+    
+    def _request_image(self, prompt: str, width: int, height: int, model: str,
+                       seed: Optional[int]) -> Optional[str]:
+        # Upstream is failing, don't make callers wait for another timeout
+        if not self.breaker.allow_request():
+            metrics.inc('pollinations_requests_total', status='breaker_open')
+            return None
+        
         try:
             # Construct the URL with parameters
             url = f"{self.base_url}/{prompt}?width={width}&height={height}&model={model}"
+            if seed is not None:
+                url += f"&seed={seed}"
             
-            # Make the request
-            response = requests.get(url, timeout=self.timeout)
+            # Make the request, retries happen inside the session's adapter
+            timeout = (self.connect_timeout, self.timeout)
+            with span('pollinations_http'):
+                if self.fetch_mode == 'head':
+                    response = self.session.head(url, timeout=timeout, allow_redirects=True)
+                else:
+                    # Unless asked to, don't read the body: only the final URL is needed
+                    response = self.session.get(url, timeout=timeout, stream=self.fetch_mode != 'get')
+            metrics.inc('pollinations_requests_total', status=response.status_code)
             
-            if response.status_code == 200:
+            with response:
+                if response.status_code != 200:
+                    self.breaker.record_failure()
+                    logger.warning("Failed to generate image. Status code: %s", response.status_code)
+                    self._drain(response)
+                    return None
+                
+                self.breaker.record_success()
+                if self.fetch_mode == 'store':
+                    with span('media_store'):
+                        name = self.media_store.save(
+                            response.iter_content(chunk_size=64 * 1024),
+                            response.headers.get('Content-Type')
+                        )
+                    return self.media_store.url(name)
                 # Return the image URL
+                self._drain(response)
                 return response.url
-            else:
-                print(f"Failed to generate image. Status code: {response.status_code}")
-                return None
                 
+        except MediaTooLarge as e:
+            logger.warning("Generated image not stored: %s", e)
+            return None
         except Exception as e:
-            print(f"Error generating image: {str(e)}")
+            self.breaker.record_failure()
+            metrics.inc('pollinations_requests_total', status='error')
+            logger.warning("Error generating image: %s", e)
             return None
     
+    def _drain(self, response: requests.Response):
+        """
+        Read the rest of a streamed body that is known to be small (an error
+        page, an empty redirect) so urllib3 returns its connection to the
+        pool.  Anything larger, or of unknown length, is left unread and its
+        connection is closed: downloading the image is what streaming avoids.
+        """
+        if response.raw is None or getattr(response, '_content_consumed', False):
+            return
+        length = response.headers.get('Content-Length')
+        if length is None or not length.isdigit() or int(length) > self.drain_limit:
+            return
+        try:
+            for _ in response.iter_content(chunk_size=self.drain_limit or 1):
+                pass
+        except requests.RequestException as e:
+            logger.debug("Could not drain response body: %s", e)
+    
     def generate_recommendation_prompt(self, labels: List[str]) -> str:
         """
         Generate a prompt for image generation based on labels
@@ -64,6 +316,85 @@ class PollinationsAIService:
         
         return prompt
 
+class ConcurrentPollinationsAIService(PollinationsAIService):
+    """
+    PollinationsAIService variant that runs a batch of generations in a
+    bounded thread pool instead of one after another
+    """
+    
+    def __init__(self, base_url: Optional[str] = None, timeout: Optional[float] = None,
+                 max_workers: Optional[int] = None, deadline: Optional[float] = None):
+        super().__init__(base_url=base_url, timeout=timeout)
+        self.max_workers = max_workers or getattr(settings, 'POLLINATIONS_MAX_WORKERS', 10)
+        self.deadline = deadline or getattr(settings, 'POLLINATIONS_BATCH_DEADLINE', 10)  # seconds
+    
+    def generate_images(self, prompts: List[str], width: int = 512, height: int = 512,
+                        model: str = "flux", seeds: Optional[List[Optional[int]]] = None) -> List[str]:
+        """
+        Generate one image per prompt concurrently
+        
+        Args:
+            prompts (List[str]): Text prompts, one per image
+            width (int): Width of the generated images
+            height (int): Height of the generated images
+            model (str): Model to use for generation
+            seeds (List[Optional[int]]): Optional seed for each prompt
+            
+        Returns:
+            List[str]: URLs of the images that finished before the batch
+            deadline, in prompt order. Failed or late generations are dropped.
+        """
+        image_urls = self.generate_batch(prompts, width, height, model, seeds)
+        return [image_url for image_url in image_urls if image_url]
+    
+    def generate_batch(self, prompts: List[str], width: int = 512, height: int = 512,
+                       model: str = "flux", seeds: Optional[List[Optional[int]]] = None) -> List[Optional[str]]:
+        """
+        Same as generate_images but keeps one entry per prompt
+        
+        Returns:
+            List[Optional[str]]: Image URL for each prompt, or None where the
+            generation failed, raised or missed the batch deadline
+        """
+        if not prompts:
+            return []
+        seeds = seeds or [None] * len(prompts)
+        
+        expires_at = time.monotonic() + self.deadline
+        executor = ThreadPoolExecutor(max_workers=min(len(prompts), self.max_workers))
+        try:
+            futures = [
+                executor.submit(self._generate_in_slot, prompt, width, height, model, seed, expires_at)
+                for prompt, seed in zip(prompts, seeds)
+            ]
+            done, _ = wait(futures, timeout=self.deadline)
+        finally:
+            # Don't wait for stragglers, they finish (or time out) in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        image_urls = []
+        for future in futures:
+            if future not in done:
+                image_urls.append(None)
+            elif future.exception() is not None:
+                # One broken generation must not lose the rest of the batch
+                logger.warning("Error generating image: %s", future.exception())
+                image_urls.append(None)
+            else:
+                image_urls.append(future.result())
+        return image_urls
+    
+    def _generate_in_slot(self, prompt: str, width: int, height: int, model: str,
+                          seed: Optional[int], expires_at: float) -> Optional[str]:
+        slots = get_generation_slots()
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0 or not slots.acquire(timeout=remaining):
+            return None
+        try:
+            return self.generate_image(prompt, width=width, height=height, model=model, seed=seed)
+        finally:
+            slots.release()
+
 def calculate_cosine_similarity(labels1: List[str], labels2: List[str]) -> float:
     """
     Calculate cosine similarity between two sets of labels
@@ -0,0 +1,56 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import bump_catalog_version
+from .changes import record_change
+from .index import label_index
+from .lsh import lsh_engine
+from .models import CatalogChange, Image
+from .scoring import scoring_engine
+
+
+def image_saved(image, created=False, invalidate_rankings=True):
+    """
+    Refresh everything derived from an image's labels
+
+    Called by the post_save handler, and directly for images inserted with
+    bulk_create, which does not send signals.  The neighbour table is
+    refreshed from the change log by ``manage.py refresh_similarity``.
+
+    Cached rankings are invalidated (bump_catalog_version()) when an image
+    is added or relabelled, unless ``invalidate_rankings`` is False; edits
+    that leave the labels alone don't change any score.
+    """
+    relabelled = created or image.labels_changed()
+    image.sync_labels()
+    record_change(image.id, CatalogChange.INSERT if created else CatalogChange.UPDATE)
+    label_index.add(image)
+    scoring_engine.note_saved(image)
+    lsh_engine.add(image)
+    if relabelled and invalidate_rankings:
+        bump_catalog_version()
+    image._loaded_labels = image.labels
+
+
+@receiver(post_save, sender=Image)
+def index_saved_image(sender, instance, created=False, raw=False, **kwargs):
+    """Keep the label index in sync when an image is created or relabelled"""
+    if raw:
+        # Fixture loading, only the in-memory structures and the change log
+        # can be refreshed
+        record_change(instance.id, CatalogChange.INSERT if created else CatalogChange.UPDATE)
+        label_index.add(instance)
+        scoring_engine.note_saved(instance)
+        lsh_engine.add(instance)
+        bump_catalog_version()
+        return
+    image_saved(instance, created=created)
+
+
+@receiver(post_delete, sender=Image)
+def unindex_deleted_image(sender, instance, **kwargs):
+    record_change(instance.id, CatalogChange.DELETE)
+    label_index.remove(instance.id)
+    scoring_engine.note_deleted(instance.id)
+    lsh_engine.remove(instance.id)
+    bump_catalog_version()
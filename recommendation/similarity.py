@@ -0,0 +1,168 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+
+from .models import SimilarImage
+from .scoring import LabelMatrix, scoring_engine, select_top_k
+from .topk import score_key
+
+
+# Name of the change log cursor of the neighbour table
+SIMILARITY_CURSOR = 'similarity'
+
+
+def neighbours_per_image() -> int:
+    return getattr(settings, 'SIMILAR_IMAGES_PER_IMAGE', 20)
+
+
+def compute_neighbours(matrix: LabelMatrix, image_id: int, labels: Iterable[str],
+                       n: int) -> List[Tuple[int, float]]:
+    """Top-n most similar images to one image, the image itself excluded"""
+    scores = matrix.scores(matrix.query_vector([(list(labels), 1)]))
+    return top_neighbours(matrix.image_ids, scores, n, exclude_id=image_id)
+
+
+def top_neighbours(image_ids: np.ndarray, scores: np.ndarray, n: int,
+                   exclude_id: Optional[int] = None) -> List[Tuple[int, float]]:
+    """
+    Top-n images sharing at least one label
+
+    Zero-score images are not stored; when no stored neighbour is usable the
+    endpoint falls back to live scoring, which handles that case exactly.
+    """
+    valid = scores > 0
+    if exclude_id is not None:
+        valid &= image_ids != exclude_id
+    return select_top_k(image_ids[valid], scores[valid], n)
+
+
+def most_similar(image_id: int, exclude_ids: Iterable[int] = ()) -> Optional[SimilarImage]:
+    """Best stored neighbour of an image that is not excluded, if any"""
+    return SimilarImage.objects.filter(image_id=image_id).exclude(
+        neighbour_id__in=list(exclude_ids)
+    ).select_related('neighbour', 'neighbour__asset').order_by('rank').first()
+
+
+def save_neighbour_lists(lists: Dict[int, List[Tuple[int, float]]], batch_size: int = 500):
+    """Replace the stored neighbour lists of many images"""
+    image_ids = list(lists)
+    with transaction.atomic():
+        for start in range(0, len(image_ids), batch_size):
+            SimilarImage.objects.filter(image_id__in=image_ids[start:start + batch_size]).delete()
+        SimilarImage.objects.bulk_create([
+            SimilarImage(image_id=image_id, neighbour_id=neighbour_id, score=score, rank=rank)
+            for image_id, neighbours in lists.items()
+            for rank, (neighbour_id, score) in enumerate(neighbours, start=1)
+        ], batch_size=5000)
+
+
+def refresh_neighbours(image_ids: Iterable[int], batch_size: int = 5000) -> int:
+    """
+    Bring the neighbour table up to date after a batch of images changed
+
+    Run by ``manage.py refresh_similarity`` from the catalog change log, never
+    on the request path.  Every changed image gets a freshly computed list,
+    and every other image whose list it now belongs in (or whose stored score
+    for it went up) has it merged in.  Lists where its score went down are
+    recomputed from scratch.  Lists that lost a deleted neighbour keep the
+    remaining ones until build_similarity runs again.
+
+    Returns:
+        int: Number of neighbour lists rewritten
+    """
+    from .changes import current_labels
+
+    if not SimilarImage.objects.exists():
+        # Table not built yet, build_similarity will cover these images
+        return 0
+
+    n = neighbours_per_image()
+    changed = {
+        image_id: labels for image_id, labels in current_labels(image_ids).items() if labels is not None
+    }
+    changed_ids = list(changed)
+    scoring_engine.sync()
+    matrix = scoring_engine.matrix()
+
+    # Lists each changed image is stored in, with the score it had then
+    listed: Dict[int, List[Tuple[int, float]]] = {}
+    for start in range(0, len(changed_ids), batch_size):
+        for image_id, neighbour_id, score in SimilarImage.objects.filter(
+            neighbour_id__in=changed_ids[start:start + batch_size]
+        ).values_list('image_id', 'neighbour_id', 'score'):
+            listed.setdefault(neighbour_id, []).append((image_id, score))
+
+    lists: Dict[int, List[Tuple[int, float]]] = {}
+    recompute = set()
+    # Image id -> {changed image id: new score}, for the lists to merge into
+    merge: Dict[int, Dict[int, float]] = {}
+    # Changed image id -> ids and scores of the images it overlaps
+    overlaps: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+    for image_id, labels in changed.items():
+        ids, scores = scoring_engine.scores_for([(list(labels), 1)], exclude_ids=[image_id])
+        lists[image_id] = top_neighbours(ids, scores, n)
+        # Cosine is symmetric: scores[i] is also the score of image_id in ids[i]'s list
+        positive = scores > 0
+        overlaps[image_id] = (ids[positive], scores[positive])
+
+        query = matrix.query_vector([(list(labels), 1)])
+        for listing_id, old_score in listed.get(image_id, ()):
+            new_score = matrix.score_labels(query, scoring_engine.index.labels_for(listing_id) or ())
+            if new_score < old_score:
+                # It may have dropped below an image that was never stored
+                recompute.add(listing_id)
+
+    # Worst stored score and list size of every image a changed image overlaps
+    candidates = np.unique(np.concatenate(
+        [ids for ids, _ in overlaps.values()] or [np.zeros(0, dtype=np.int64)]
+    ))
+    worst = np.zeros(len(candidates))
+    size = np.zeros(len(candidates), dtype=np.int64)
+    for start in range(0, len(candidates), batch_size):
+        chunk = candidates[start:start + batch_size].tolist()
+        for image_id, chunk_worst, chunk_size in SimilarImage.objects.filter(
+            image_id__in=chunk
+        ).values('image_id').annotate(
+            worst=Min('score'), size=Count('id')
+        ).values_list('image_id', 'worst', 'size'):
+            row = np.searchsorted(candidates, image_id)
+            worst[row], size[row] = chunk_worst, chunk_size
+
+    for image_id, (ids, scores) in overlaps.items():
+        rows = np.searchsorted(candidates, ids)
+        # Includes every list holding image_id whose score did not go down;
+        # a tie with the worst stored score enters when its id is lower
+        enters = (size[rows] < n) | (scores >= worst[rows])
+        for other_id, score in zip(ids[enters].tolist(), scores[enters].tolist()):
+            # Changed images got a new list above, recomputed ones get one below
+            if other_id not in changed and other_id not in recompute:
+                merge.setdefault(other_id, {})[image_id] = score
+
+    merge_ids = list(merge)
+    current: Dict[int, Dict[int, float]] = {image_id: {} for image_id in merge_ids}
+    for start in range(0, len(merge_ids), batch_size):
+        for image_id, neighbour_id, score in SimilarImage.objects.filter(
+            image_id__in=merge_ids[start:start + batch_size]
+        ).values_list('image_id', 'neighbour_id', 'score'):
+            current[image_id][neighbour_id] = score
+    for image_id in merge_ids:
+        neighbours = current[image_id]
+        scores = merge[image_id]
+        neighbours.update(scores)
+        lists[image_id] = sorted(
+            ((neighbour_id, score) for neighbour_id, score in neighbours.items() if score > 0),
+            key=lambda x: (-score_key(x[1]), x[0])
+        )[:n]
+
+    for image_id in recompute - set(changed):
+        labels = scoring_engine.index.labels_for(image_id)
+        if labels is None:
+            continue
+        ids, scores = scoring_engine.scores_for([(list(labels), 1)], exclude_ids=[image_id])
+        lists[image_id] = top_neighbours(ids, scores, n)
+
+    save_neighbour_lists(lists)
+    return len(lists)
@@ -0,0 +1,1628 @@
+import base64
+import importlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from .benchmark import catalog_changed, seed_images, seed_users
+from .cache import MemoryPromptCache, reference_set_key
+from .changes import (ChangeConsumer, ChangeLogPruned, latest_seq, load_cursor, prune_changes, pruned_seq,
+                      record_changes, save_cursor)
+from .index import LabelIndex
+from .jobs import reclaim_stale_jobs, run_jobs
+from .lsh import LSHEngine
+from .media import ContentAddressedStore
+from .matrix_file import LabelMatrixFileError, MappedLabelMatrix, write_label_matrix
+from .models import (CatalogChange, Collection, CollectionImage, GenerationJob, Image, ImageLabel, Recommendation,
+                     RecommendationSession, SimilarImage)
+from .pagination import browse_page, decode_cursor, encode_cursor
+from .persistence import RecommendationWriter, WriteBehindRecommendationWriter
+from .profiling import profiling_settings
+from .recommender import claim_precomputed_session, iter_recommendation_batches, recommend_for_user
+from .scoring import LabelMatrix, ScoringEngine, rank_images, scoring_engine, select_top_k, sql_top_k
+from .services import (CircuitBreaker, ConcurrentPollinationsAIService, PollinationsAIService,
+                       calculate_cosine_similarity)
+from .similarity import (SIMILARITY_CURSOR, compute_neighbours, neighbours_per_image, refresh_neighbours,
+                         save_neighbour_lists)
+from .topk import CosineBound, TopK, push_bounded, score_key
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None, RECOMMENDATION_SCORER='matrix',
+                   RECOMMENDATION_WRITE_BEHIND=False)
+class QueryCountTests(TestCase):
+    """
+    The hot views run a fixed number of queries whatever the catalog size
+
+    Every test measures the same request on a small catalog and again after
+    the catalog has grown ten times.  The in-memory label index is built
+    before measuring, the counts are those of a warm process.
+    """
+
+    CATALOG_SIZES = [50, 500]
+
+    def setUp(self):
+        cache.clear()
+        self.rng = np.random.default_rng(1)
+        self.user = User.objects.create_user('alice')
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        catalog_changed()
+
+    def catalog_sizes(self):
+        """Grow the catalog to each size in turn, yielding the size"""
+        for size in self.CATALOG_SIZES:
+            seed_images(size - Image.objects.count(), vocabulary=200, rng=self.rng)
+            scoring_engine.matrix()
+            cache.clear()
+            yield size
+
+    def add_references(self):
+        """Like three and star two of the catalog images"""
+        image_ids = list(Image.objects.order_by('id').values_list('id', flat=True)[:5])
+        liked = Collection.objects.create(user=self.user, name='Liked Images')
+        starred = Collection.objects.create(user=self.user, name='Starred Images')
+        CollectionImage.objects.bulk_create(
+            [CollectionImage(collection=liked, image_id=image_id, interaction_type=1)
+             for image_id in image_ids[:3]]
+            + [CollectionImage(collection=starred, image_id=image_id, interaction_type=3)
+               for image_id in image_ids[3:]]
+        )
+        return image_ids
+
+    def test_generate_recommendations(self):
+        for size in self.catalog_sizes():
+            if size == self.CATALOG_SIZES[0]:
+                self.add_references()
+            with self.subTest(catalog=size, cached=False), self.assertNumQueries(11):
+                self.client.get('/recommendations/')
+            with self.subTest(catalog=size, cached=True), self.assertNumQueries(6):
+                self.client.get('/recommendations/')
+
+    def test_next_recommendation(self):
+        for size in self.catalog_sizes():
+            if size == self.CATALOG_SIZES[0]:
+                self.add_references()
+            self.client.get('/recommendations/')
+            session = RecommendationSession.objects.filter(user=self.user).latest('id')
+            with self.subTest(catalog=size), self.assertNumQueries(3):
+                response = self.client.get(f'/next/{session.id}/1/')
+            self.assertTrue(response.json()['success'])
+
+    def test_browse_images(self):
+        for size in self.catalog_sizes():
+            if size == self.CATALOG_SIZES[0]:
+                self.add_references()
+            # The image count is only taken on the first page of a catalog version
+            with self.subTest(catalog=size, cached=False), self.assertNumQueries(5):
+                self.client.get('/browse/')
+            with self.subTest(catalog=size, cached=True), self.assertNumQueries(4):
+                self.client.get('/browse/')
+
+    def test_similar_image(self):
+        for size in self.catalog_sizes():
+            if size == self.CATALOG_SIZES[0]:
+                reference_id = self.add_references()[0]
+
+            # Live scoring, before the neighbour table is filled
+            SimilarImage.objects.all().delete()
+            with self.subTest(catalog=size, table=False), self.assertNumQueries(7):
+                response = self.client.get(f'/similar/{reference_id}/')
+            self.assertTrue(response.json()['success'])
+
+            labels = {image.id: tuple(image.get_label_list()) for image in Image.objects.only('id', 'labels')}
+            neighbours = compute_neighbours(LabelMatrix.from_labels(labels), reference_id,
+                                            labels[reference_id], neighbours_per_image())
+            save_neighbour_lists({reference_id: neighbours})
+            with self.subTest(catalog=size, table=True), self.assertNumQueries(6):
+                response = self.client.get(f'/similar/{reference_id}/')
+            self.assertTrue(response.json()['success'])
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None)
+class ScorerParityTests(TestCase):
+    """
+    The SQL and matrix scorers rank like calculate_cosine_similarity
+
+    A small vocabulary gives many equal scores, which must be broken on
+    ascending image id by every scorer.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(300, vocabulary=20, labels_per_image=3, rng=np.random.default_rng(2))
+        catalog_changed()
+        cls.labels = {image.id: image.get_label_list() for image in Image.objects.only('id', 'labels')}
+
+    def tearDown(self):
+        catalog_changed()
+
+    def expected(self, references, k, exclude_ids=()):
+        """Rank the whole catalog one image at a time"""
+        total_weight = sum(weight for _, weight in references)
+        scored = [
+            (image_id, sum(
+                calculate_cosine_similarity(self.labels[reference_id], labels) * weight
+                for reference_id, weight in references
+            ) / total_weight)
+            for image_id, labels in self.labels.items()
+            if image_id not in exclude_ids
+        ]
+        scored.sort(key=lambda x: (-score_key(x[1]), x[0]))
+        return scored[:k]
+
+    def assertSameRanking(self, actual, expected):
+        self.assertEqual([image_id for image_id, _ in actual], [image_id for image_id, _ in expected])
+        for (_, actual_score), (_, expected_score) in zip(actual, expected):
+            self.assertAlmostEqual(actual_score, expected_score, places=9)
+
+    def test_rankings_match(self):
+        rng = np.random.default_rng(3)
+        image_ids = sorted(self.labels)
+        for _ in range(20):
+            picked = rng.choice(image_ids, size=int(rng.integers(1, 5)), replace=False).tolist()
+            references = [(image_id, int(rng.choice([1, 3]))) for image_id in picked]
+            expected = self.expected(references, 10, exclude_ids=set(picked))
+            with self.subTest(references=references):
+                self.assertSameRanking(sql_top_k(references, 10, exclude_ids=picked), expected)
+                self.assertSameRanking(
+                    scoring_engine.top_k([(self.labels[image_id], weight) for image_id, weight in references],
+                                         10, exclude_ids=picked),
+                    expected
+                )
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None, RECOMMENDATION_WRITE_BEHIND=False)
+class RecommendationCacheTests(TestCase):
+    """
+    A cached ranking is served until the user's references or the scoreable
+    catalog change, and is never newer than the catalog it was ranked against
+    """
+
+    def setUp(self):
+        cache.clear()
+        seed_images(30, vocabulary=20, rng=np.random.default_rng(4))
+        catalog_changed()
+        self.user = User.objects.create_user('bob')
+        liked = Collection.objects.create(user=self.user, name='Liked Images')
+        CollectionImage.objects.create(collection=liked, image=Image.objects.order_by('id').first(),
+                                       interaction_type=1)
+
+    def tearDown(self):
+        catalog_changed()
+
+    def test_ranking_is_reused(self):
+        first, _ = recommend_for_user(self.user)
+        second, _ = recommend_for_user(self.user)
+        self.assertEqual(first.id, second.id)
+
+    def test_catalog_change_while_ranking(self):
+        def rank_then_change(*args, **kwargs):
+            ranked = rank_images(*args, **kwargs)
+            catalog_changed()
+            return ranked
+
+        with mock.patch('recommendation.recommender.rank_images', side_effect=rank_then_change):
+            first, _ = recommend_for_user(self.user)
+        second, _ = recommend_for_user(self.user)
+        self.assertNotEqual(first.id, second.id)
+
+    def assertRankingDropped(self, change):
+        """The ranking cached before ``change`` is not served after it"""
+        first, _ = recommend_for_user(self.user)
+        change()
+        second, _ = recommend_for_user(self.user)
+        self.assertTrue(second is None or second.id != first.id)
+
+    def assertRankingKept(self, change):
+        first, _ = recommend_for_user(self.user)
+        change()
+        second, _ = recommend_for_user(self.user)
+        self.assertEqual(second.id, first.id)
+
+    def post(self, url, data=None):
+        self.client.force_login(self.user)
+        response = self.client.post(url, data or {}, content_type='application/json')
+        self.assertTrue(response.json()['success'])
+
+    def test_star(self):
+        image = Image.objects.order_by('id')[1]
+        self.assertRankingDropped(lambda: self.post('/star-image/', {'image_id': image.id}))
+
+    def test_like(self):
+        image = Image.objects.order_by('id')[1]
+        self.assertRankingDropped(lambda: self.post('/like-image/', {'image_id': image.id}))
+
+    def test_add_to_collection(self):
+        image = Image.objects.order_by('id')[1]
+        collection = Collection.objects.create(user=self.user, name='Favourites')
+        self.assertRankingDropped(lambda: self.post(
+            '/add-to-collection/', {'image_id': image.id, 'collection_id': collection.id}
+        ))
+
+    def test_remove_all_starred_liked(self):
+        self.assertRankingDropped(lambda: self.post('/remove-all-starred-liked/'))
+
+    def test_image_added(self):
+        self.assertRankingDropped(lambda: Image.objects.create(
+            title='New', image_url='https://example.com/new.jpg', labels='tag1, tag2'
+        ))
+
+    def test_image_relabelled(self):
+        image = Image.objects.order_by('id')[2]
+
+        def relabel():
+            image.labels = 'tag1, tag3'
+            image.save()
+        self.assertRankingDropped(relabel)
+
+    def test_image_deleted(self):
+        self.assertRankingDropped(lambda: Image.objects.order_by('id')[2].delete())
+
+    def test_title_edit(self):
+        image = Image.objects.order_by('id')[2]
+
+        def retitle():
+            image.title = 'Renamed'
+            image.save()
+        self.assertRankingKept(retitle)
+
+    def test_generated_image(self):
+        def append_generated():
+            session = RecommendationSession.objects.create(user=User.objects.create_user('dave'))
+            job = GenerationJob.objects.create(session=session, prompt='a prompt', seed=0, labels='tag1',
+                                               title='Generated', status=GenerationJob.RUNNING)
+            RecommendationWriter().append_generated([(job, 'https://example.com/generated.jpg')])
+        self.assertRankingKept(append_generated)
+
+
+class BrokenSeedService(ConcurrentPollinationsAIService):
+    """Generates every image but the one of ``broken_seed``, which raises"""
+
+    broken_seed = 1
+
+    def __init__(self):
+        super().__init__()
+        self.breaker = CircuitBreaker()
+
+    def generate_image(self, prompt, width=512, height=512, model='flux', seed=None):
+        if seed == self.broken_seed:
+            raise RuntimeError('broken generation')
+        return f'https://example.com/generated/{seed}.jpg'
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None, GENERATION_JOB_MAX_ATTEMPTS=3,
+                   GENERATION_JOB_STALE_AFTER=300)
+class GenerationJobTests(TestCase):
+    """Failed and abandoned generation jobs are retried a bounded number of times"""
+
+    def setUp(self):
+        self.session = RecommendationSession.objects.create(user=User.objects.create_user('carol'))
+
+    def tearDown(self):
+        catalog_changed()
+
+    def create_jobs(self, count, **fields):
+        return [
+            GenerationJob.objects.create(session=self.session, prompt='a prompt', seed=seed,
+                                         labels='tag1', title=f'Job {seed}', **fields)
+            for seed in range(count)
+        ]
+
+    def test_reclaim_stale_jobs(self):
+        claimed_at = timezone.now() - timedelta(seconds=600)
+        requeued, failed, running = (
+            self.create_jobs(1, status=GenerationJob.RUNNING, claimed_at=claimed_at)[0],
+            self.create_jobs(1, status=GenerationJob.RUNNING, claimed_at=claimed_at, attempts=2)[0],
+            self.create_jobs(1, status=GenerationJob.RUNNING, claimed_at=timezone.now())[0],
+        )
+
+        self.assertEqual(reclaim_stale_jobs(), (1, 1))
+        for job in (requeued, failed, running):
+            job.refresh_from_db()
+        self.assertEqual((requeued.status, requeued.attempts), (GenerationJob.PENDING, 1))
+        self.assertEqual((failed.status, failed.attempts), (GenerationJob.FAILED, 3))
+        self.assertEqual((running.status, running.attempts), (GenerationJob.RUNNING, 0))
+
+    def test_failed_job_does_not_fail_its_batch(self):
+        jobs = self.create_jobs(3, status=GenerationJob.RUNNING, claimed_at=timezone.now())
+
+        self.assertEqual(run_jobs(jobs, BrokenSeedService()), 2)
+        statuses = dict(GenerationJob.objects.values_list('seed', 'status'))
+        self.assertEqual(statuses, {0: GenerationJob.DONE, 1: GenerationJob.PENDING, 2: GenerationJob.DONE})
+        self.assertEqual(GenerationJob.objects.get(seed=1).attempts, 1)
+        self.assertEqual(Recommendation.objects.filter(session=self.session).count(), 2)
+
+
+class PollinationsStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        seed = parse_qs(urlparse(self.path).query).get('seed', [None])[0]
+        with server.lock:
+            server.requests.append(time.monotonic())
+            status = server.statuses.pop(0) if server.statuses else 200
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+        time.sleep(server.delays.get(seed, server.delay))
+        # Before answering, so no count is left over once the client has its answer
+        with server.lock:
+            server.in_flight -= 1
+
+        body = b'\xff' * server.image_size if status == 200 else b'error'
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/jpeg' if status == 200 else 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        for start in range(0, len(body), 16 * 1024):
+            if start and server.trickle:
+                time.sleep(server.trickle)
+            self.wfile.write(body[start:start + 16 * 1024])
+            with server.lock:
+                server.bytes_sent += len(body[start:start + 16 * 1024])
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PollinationsStub(ThreadingHTTPServer):
+    """Local stand-in for Pollinations.AI whose answers each test scripts"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), PollinationsStubHandler)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.statuses = []  # status of the next answers, 200 once used up
+        self.delay = 0.0  # seconds before answering
+        self.delays = {}  # seed -> seconds, overrides delay
+        self.image_size = 64 * 1024  # bytes, about a 512x512 JPEG
+        self.trickle = 0.0  # seconds between 16 KiB chunks of a body
+        self.requests = []  # time.monotonic() of every request
+        self.bytes_sent = 0
+        self.connections = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def handle_error(self, request, client_address):
+        # Clients abandoning a connection are expected
+        pass
+
+
+class PollinationsStubTestCase(SimpleTestCase):
+    """
+    Runs the Pollinations.AI client against a PollinationsStub
+
+    POLLINATIONS_BASE_URL points at the stub, and the process-wide HTTP
+    session and generation slots are rebuilt from the test's settings.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = PollinationsStub()
+        threading.Thread(target=cls.stub.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.shutdown()
+        cls.stub.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.stub.reset()
+        self.enterContext(self.settings(
+            POLLINATIONS_BASE_URL=f'http://127.0.0.1:{self.stub.server_port}/prompt'
+        ))
+        self.enterContext(mock.patch('recommendation.services._http_session', None))
+        self.enterContext(mock.patch('recommendation.services._generation_slots', None))
+        self.addCleanup(cache.clear)
+
+    def service(self, **kwargs):
+        kwargs.setdefault('breaker', CircuitBreaker())
+        return PollinationsAIService(cache=MemoryPromptCache(), **kwargs)
+
+
+@override_settings(POLLINATIONS_RETRIES=2, POLLINATIONS_RETRY_BACKOFF=0.1, POLLINATIONS_RETRY_BACKOFF_MAX=1)
+class PollinationsClientTests(PollinationsStubTestCase):
+    """Retries, circuit breaker and connection pooling of PollinationsAIService"""
+
+    def test_retries_with_backoff(self):
+        self.stub.statuses = [429, 503]
+        image_url = self.service().generate_image('a prompt', seed=1)
+
+        self.assertTrue(image_url)
+        self.assertEqual(len(self.stub.requests), 3)
+        # The first retry is immediate, the second waits backoff * 2
+        self.assertGreaterEqual(self.stub.requests[2] - self.stub.requests[1], 0.2 * 0.9)
+
+    def test_gives_up_after_retries(self):
+        self.stub.statuses = [503] * 10
+        service = self.service()
+
+        with self.assertLogs('recommendation.services', 'WARNING'):
+            self.assertIsNone(service.generate_image('a prompt', seed=1))
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(service.breaker.state, CircuitBreaker.CLOSED)
+
+    @override_settings(POLLINATIONS_RETRIES=0)
+    def test_circuit_breaker(self):
+        service = self.service(breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+        self.enterContext(self.assertLogs('recommendation.services', 'INFO'))
+
+        self.stub.statuses = [500, 500]
+        for seed in range(2):
+            self.assertIsNone(service.generate_image('a prompt', seed=seed))
+        self.assertEqual(service.breaker.state, CircuitBreaker.OPEN)
+
+        # Refused without calling the upstream
+        self.assertIsNone(service.generate_image('a prompt', seed=2))
+        self.assertEqual(len(self.stub.requests), 2)
+
+        # A failing probe opens it again
+        time.sleep(0.25)
+        self.assertEqual(service.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.stub.statuses = [500]
+        self.assertIsNone(service.generate_image('a prompt', seed=3))
+        self.assertEqual(service.breaker.state, CircuitBreaker.OPEN)
+
+        # A successful probe closes it
+        time.sleep(0.25)
+        self.assertTrue(service.generate_image('a prompt', seed=4))
+        self.assertEqual(service.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(len(self.stub.requests), 4)
+
+    def test_image_body_is_not_read(self):
+        # A typical 512x512 JPEG, reading it takes more than five seconds
+        self.stub.image_size = 192 * 1024
+        self.stub.trickle = 0.5
+        started = time.monotonic()
+        self.assertTrue(self.service().generate_image('a prompt', seed=1))
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertLess(self.stub.bytes_sent, 64 * 1024)
+
+    def test_connections_are_reused(self):
+        # HEAD answers have no body
+        service = self.service(fetch_mode='head')
+        for seed in range(5):
+            self.assertTrue(service.generate_image('a prompt', seed=seed))
+        self.assertEqual(self.stub.connections, 1)
+
+    def test_small_bodies_are_drained(self):
+        # Error pages are read so their connection goes back to the pool
+        self.stub.statuses = [404] * 5
+        service = self.service()
+        with self.assertLogs('recommendation.services', 'WARNING'):
+            for seed in range(5):
+                self.assertIsNone(service.generate_image('a prompt', seed=seed))
+        self.assertEqual(len(self.stub.requests), 5)
+        self.assertEqual(self.stub.connections, 1)
+
+
+@override_settings(POLLINATIONS_RETRIES=0, POLLINATIONS_MAX_CONCURRENCY=4)
+class ConcurrentGenerationTests(PollinationsStubTestCase):
+    """Batches of ConcurrentPollinationsAIService against the stub"""
+
+    def service(self, **kwargs):
+        service = ConcurrentPollinationsAIService(**kwargs)
+        service.cache = MemoryPromptCache()
+        service.breaker = CircuitBreaker()
+        return service
+
+    def test_batch_runs_concurrently(self):
+        self.stub.delay = 0.3
+        started = time.monotonic()
+        image_urls = self.service(max_workers=4, deadline=5).generate_batch(['a prompt'] * 4, seeds=list(range(4)))
+
+        self.assertTrue(all(image_urls))
+        self.assertEqual(self.stub.peak_in_flight, 4)
+        # One after another this takes 1.2 seconds
+        self.assertLess(time.monotonic() - started, 0.9)
+
+    @override_settings(POLLINATIONS_MAX_CONCURRENCY=2)
+    def test_concurrency_limit(self):
+        self.stub.delay = 0.2
+        image_urls = self.service(max_workers=4, deadline=5).generate_batch(['a prompt'] * 4, seeds=list(range(4)))
+
+        self.assertTrue(all(image_urls))
+        self.assertEqual(self.stub.peak_in_flight, 2)
+
+    def test_deadline(self):
+        self.stub.delays = {'3': 2.0}
+        started = time.monotonic()
+        image_urls = self.service(max_workers=4, deadline=0.5).generate_batch(['a prompt'] * 4, seeds=list(range(4)))
+
+        # The late generation is dropped, the others are returned
+        self.assertTrue(all(image_urls[:3]))
+        self.assertIsNone(image_urls[3])
+        self.assertLess(time.monotonic() - started, 1.5)
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None)
+class LSHEngineTests(TestCase):
+    """The LSH scorer against the exact one, and its change log consumer"""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(300, vocabulary=30, labels_per_image=4, rng=np.random.default_rng(5))
+
+    def setUp(self):
+        catalog_changed()
+        self.engine = LSHEngine(LabelIndex(), bands=32, rows=2, max_candidates=10000)
+
+    def tearDown(self):
+        catalog_changed()
+
+    def references(self, count=20):
+        rng = np.random.default_rng(6)
+        image_ids = list(Image.objects.order_by('id').values_list('id', flat=True))
+        labels = dict(Image.objects.values_list('id', 'labels'))
+        for _ in range(count):
+            picked = rng.choice(image_ids, size=int(rng.integers(1, 4)), replace=False).tolist()
+            yield picked, [(Image(labels=labels[image_id]).get_label_list(), int(rng.choice([1, 3])))
+                           for image_id in picked]
+
+    def test_recall_against_exact_scorer(self):
+        found = wanted = 0
+        for picked, references in self.references():
+            exact = scoring_engine.top_k(references, 10, exclude_ids=picked)
+            approximate = self.engine.top_k(references, 10, exclude_ids=picked)
+            exact_scores = dict(zip(*scoring_engine.scores_for(references, exclude_ids=picked)))
+            with self.subTest(references=references):
+                self.assertEqual(len(approximate), 10)
+                # Candidates are re-ranked with the exact score
+                for image_id, score in approximate:
+                    self.assertAlmostEqual(score, exact_scores[image_id], places=9)
+                self.assertEqual(approximate, sorted(approximate, key=lambda x: (-score_key(x[1]), x[0])))
+            wanted += len(exact)
+            found += len({image_id for image_id, _ in exact} & {image_id for image_id, _ in approximate})
+        self.assertGreaterEqual(found / wanted, 0.95)
+
+    def test_changes_of_other_processes(self):
+        """Writes that skip this process' signals reach the engine through the change log"""
+        self.engine.lsh()
+        added = Image.objects.bulk_create([Image(title='Added', image_url='https://example.com/added.jpg',
+                                                 labels='fresh1, fresh2')])[0]
+        record_changes([added.id], CatalogChange.INSERT)
+        relabelled = Image.objects.order_by('id').first()
+        Image.objects.filter(id=relabelled.id).update(labels='fresh3')
+        record_changes([relabelled.id], CatalogChange.UPDATE)
+        deleted = Image.objects.order_by('-id').exclude(id=added.id).first()
+        deleted_labels = deleted.get_label_list()
+        Image.objects.filter(id=deleted.id).delete()
+        record_changes([deleted.id], CatalogChange.DELETE)
+
+        self.assertNotIn(added.id, self.engine.candidates([(['fresh1', 'fresh2'], 1)]))
+        self.engine.sync()
+
+        self.assertIn(added.id, self.engine.candidates([(['fresh1', 'fresh2'], 1)]))
+        self.assertEqual(self.engine.top_k([(['fresh1', 'fresh2'], 1)], 1)[0][0], added.id)
+        image_id, score = self.engine.top_k([(['fresh3'], 1)], 1)[0]
+        self.assertEqual(image_id, relabelled.id)
+        self.assertAlmostEqual(score, 1.0)
+        self.assertNotIn(deleted.id, [image_id for image_id, _ in self.engine.top_k([(deleted_labels, 1)], 10)])
+
+
+class TopKTests(SimpleTestCase):
+    """The bounded heap and the label count bound it prunes with"""
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        vocabulary = [f'tag{i}' for i in range(6)]
+        # A tiny vocabulary: many images share a label set, and a score
+        self.candidates = [
+            (image_id, [vocabulary[i] for i in sorted(set(rng.integers(0, 6, size=int(rng.integers(1, 4)))))])
+            for image_id in rng.permutation(np.arange(1, 301)).tolist()
+        ]
+        self.references = [(['tag0', 'tag1'], 3), (['tag2'], 1)]
+        total_weight = sum(weight for _, weight in self.references)
+        self.score = lambda labels: sum(
+            calculate_cosine_similarity(reference, labels) * weight for reference, weight in self.references
+        ) / total_weight
+
+    def brute_force(self, k):
+        scored = [(image_id, self.score(labels)) for image_id, labels in self.candidates]
+        return sorted(scored, key=lambda x: (-score_key(x[1]), x[0]))[:k]
+
+    def test_topk_breaks_ties_on_id(self):
+        top = TopK(3)
+        top.extend([(5, 0.5), (2, 0.5), (9, 0.9), (1, 0.1), (3, 0.5)])
+        self.assertEqual(top.results(), [(9, 0.9), (2, 0.5), (3, 0.5)])
+        self.assertEqual(top.threshold(), 0.5)
+
+    def test_topk_positive_only(self):
+        top = TopK(3, positive_only=True)
+        top.extend([(1, 0.0), (2, 0.2), (3, -0.1)])
+        self.assertEqual(top.results(), [(2, 0.2)])
+        self.assertIsNone(top.threshold())
+
+    def test_bound_caps_every_score(self):
+        bound = CosineBound(self.references)
+        for _, labels in self.candidates:
+            self.assertLessEqual(self.score(labels), bound(len(set(labels))) + 1e-12)
+
+    def test_pruned_matches_brute_force(self):
+        # Every k from a single result to past the catalog, so the k-th
+        # score falls inside runs of ties
+        for k in [1, 2, 5, 10, 17, 40, 299, 300, 400]:
+            with self.subTest(k=k):
+                top = push_bounded(TopK(k), self.candidates, self.score, CosineBound(self.references))
+                self.assertEqual(top.results(), self.brute_force(k))
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None, RECOMMENDATION_SCORER='matrix')
+class PrunedScoringTests(TestCase):
+    """ScoringEngine.top_k, which prunes the changed rows, against a full ranking"""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(200, vocabulary=6, labels_per_image=2, rng=np.random.default_rng(8))
+
+    def setUp(self):
+        catalog_changed()
+        scoring_engine.matrix()
+        # Relabelled after the matrix was built: scored one by one and pruned
+        rng = np.random.default_rng(9)
+        for image in Image.objects.order_by('?')[:80]:
+            image.labels = ', '.join(f'tag{rank}' for rank in sorted(set(rng.integers(1, 7, size=2).tolist())))
+            image.save()
+
+    def tearDown(self):
+        catalog_changed()
+
+    def test_same_ids_and_scores(self):
+        self.assertGreater(len(scoring_engine.changes()), 50)
+        image_ids = list(Image.objects.order_by('id').values_list('id', flat=True))
+        references_sets = [
+            [(['tag1'], 1)],
+            [(['tag1', 'tag2'], 3), (['tag3'], 1)],
+            [(['tag2', 'tag4'], 1), (['tag1', 'tag5', 'tag6'], 1)],
+        ]
+        for references in references_sets:
+            for k in [1, 3, 10, 25, 60, 199]:
+                exclude_ids = image_ids[:2]
+                expected = select_top_k(*scoring_engine.scores_for(references, exclude_ids), k)
+                with self.subTest(references=references, k=k):
+                    self.assertEqual(scoring_engine.top_k(references, k, exclude_ids), expected)
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None)
+class ChangeLogTests(TestCase):
+    """ChangeConsumer gaps, cursors and pruning"""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(20, vocabulary=6, labels_per_image=2, rng=np.random.default_rng(10))
+
+    def setUp(self):
+        catalog_changed()
+        self.image_ids = list(Image.objects.order_by('id').values_list('id', flat=True))
+
+    def tearDown(self):
+        catalog_changed()
+
+    def log(self, image_id, seq=None):
+        return CatalogChange.objects.create(seq=seq, image_id=image_id, op=CatalogChange.UPDATE).seq
+
+    def age_log(self):
+        CatalogChange.objects.update(created_at=timezone.now() - timedelta(days=30))
+
+    def test_late_commit_with_lower_seq(self):
+        since = latest_seq()
+        consumer = ChangeConsumer(since=since)
+        self.log(self.image_ids[0], seq=since + 2)
+        self.assertEqual(consumer.poll(), {self.image_ids[0]: CatalogChange.UPDATE})
+        self.assertEqual(set(consumer.gaps), {since + 1})
+        self.assertEqual(consumer.position, since)
+
+        # The transaction that took since + 1 commits after since + 2 was read
+        self.log(self.image_ids[1], seq=since + 1)
+        self.assertEqual(consumer.poll(), {self.image_ids[1]: CatalogChange.UPDATE})
+        self.assertEqual(consumer.gaps, {})
+        self.assertEqual(consumer.position, since + 2)
+        self.assertEqual(consumer.poll(), {})
+
+    def test_gaps_are_forgotten_after_timeout(self):
+        since = latest_seq()
+        consumer = ChangeConsumer(since=since, gap_timeout=60)
+        with mock.patch('recommendation.changes.time.monotonic', return_value=1000.0):
+            self.log(self.image_ids[0], seq=since + 3)
+            consumer.poll()
+        self.assertEqual(set(consumer.gaps), {since + 1, since + 2})
+        with mock.patch('recommendation.changes.time.monotonic', return_value=1059.0):
+            consumer.poll()
+        self.assertEqual(len(consumer.gaps), 2)
+        # A rolled back insert never shows up
+        with mock.patch('recommendation.changes.time.monotonic', return_value=1061.0):
+            consumer.poll()
+        self.assertEqual(consumer.gaps, {})
+        self.assertEqual(consumer.position, since + 3)
+
+    def test_cursor_round_trip(self):
+        self.assertIsNone(load_cursor('test'))
+        save_cursor('test', 5)
+        self.assertEqual(load_cursor('test'), 5)
+        save_cursor('test', 7)
+        self.assertEqual(load_cursor('test'), 7)
+
+    def test_prune_keeps_changes_saved_cursors_have_not_read(self):
+        seqs = [self.log(image_id) for image_id in self.image_ids[:5]]
+        self.age_log()
+        save_cursor('test', seqs[2])
+        prune_changes(timezone.now())
+        self.assertEqual(list(CatalogChange.objects.values_list('seq', flat=True)), seqs[3:])
+        self.assertEqual(pruned_seq(), seqs[2])
+
+        # Once the cursor is gone only the newest change is kept
+        save_cursor('test', seqs[-1])
+        self.assertEqual(prune_changes(timezone.now()), 1)
+        self.assertEqual(list(CatalogChange.objects.values_list('seq', flat=True)), seqs[4:])
+        self.assertEqual(pruned_seq(), seqs[3])
+
+    def test_prune_keeps_recent_changes(self):
+        old = self.log(self.image_ids[0])
+        self.age_log()
+        logged = CatalogChange.objects.count()
+        recent = [self.log(image_id) for image_id in self.image_ids[1:3]]
+        self.assertEqual(prune_changes(timezone.now() - timedelta(days=7)), logged)
+        self.assertEqual(list(CatalogChange.objects.values_list('seq', flat=True)), recent)
+        self.assertEqual(pruned_seq(), old)
+
+    def test_lagging_consumer_must_rebuild(self):
+        consumer = ChangeConsumer(since=latest_seq())
+        for image_id in self.image_ids[:3]:
+            self.log(image_id)
+        self.age_log()
+        self.log(self.image_ids[3])
+        prune_changes(timezone.now())
+        with self.assertRaises(ChangeLogPruned):
+            consumer.poll()
+        self.assertEqual(ChangeConsumer(since=latest_seq()).poll(), {})
+
+    def test_structures_rebuild_after_prune(self):
+        index = LabelIndex()
+        index.ensure_built()
+        engine = LSHEngine(index, bands=32, rows=2, max_candidates=10000)
+        engine.lsh()
+        added = Image.objects.bulk_create([Image(title='Added', image_url='https://example.com/added.jpg',
+                                                 labels='fresh1, fresh2')])[0]
+        record_changes([added.id], CatalogChange.INSERT)
+        self.age_log()
+        self.log(self.image_ids[0])
+        prune_changes(timezone.now())
+
+        with self.assertLogs('recommendation', 'WARNING'):
+            engine.sync()
+        self.assertEqual(index.labels_for(added.id), ('fresh1', 'fresh2'))
+        self.assertEqual(engine.changes(), {added.id: ('fresh1', 'fresh2')})
+        [(image_id, score)] = engine.top_k([(['fresh1', 'fresh2'], 1)], 1)
+        self.assertEqual(image_id, added.id)
+        self.assertAlmostEqual(score, 1.0)
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None, SIMILAR_IMAGES_PER_IMAGE=5)
+class SimilarityTableTests(TestCase):
+    """The stored neighbour lists against compute_neighbours on the current catalog"""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(120, vocabulary=8, labels_per_image=2, rng=np.random.default_rng(11))
+
+    def setUp(self):
+        catalog_changed()
+
+    def tearDown(self):
+        catalog_changed()
+
+    def assertTableCurrent(self):
+        labels = {image.id: tuple(image.get_label_list()) for image in Image.objects.only('id', 'labels')}
+        matrix = LabelMatrix.from_labels(labels)
+        stored = {}
+        for image_id, neighbour_id, score in SimilarImage.objects.order_by('image_id', 'rank') \
+                .values_list('image_id', 'neighbour_id', 'score'):
+            stored.setdefault(image_id, []).append((neighbour_id, score))
+        for image_id in labels:
+            expected = compute_neighbours(matrix, image_id, labels[image_id], neighbours_per_image())
+            with self.subTest(image_id=image_id):
+                got = stored.get(image_id, [])
+                self.assertEqual([neighbour_id for neighbour_id, _ in got],
+                                 [neighbour_id for neighbour_id, _ in expected])
+                for (_, score), (_, expected_score) in zip(got, expected):
+                    self.assertAlmostEqual(score, expected_score, places=9)
+
+    def test_build_similarity(self):
+        call_command('build_similarity', processes=2, chunk_size=25, stdout=io.StringIO())
+        self.assertTableCurrent()
+        self.assertEqual(load_cursor(SIMILARITY_CURSOR), latest_seq())
+
+    def test_refresh_after_relabels(self):
+        call_command('build_similarity', processes=1, stdout=io.StringIO())
+        rng = np.random.default_rng(12)
+        changed = []
+        for image in Image.objects.order_by('?')[:10]:
+            image.labels = ', '.join(f'tag{rank}' for rank in sorted(set(rng.integers(1, 9, size=2).tolist())))
+            image.save()
+            changed.append(image.id)
+        refresh_neighbours(changed)
+        self.assertTableCurrent()
+
+
+@override_settings(METRICS_ALLOWED_IPS=['10.0.0.5'])
+class MetricsAccessTests(TestCase):
+    """/metrics is not public"""
+
+    def test_anonymous_client_is_refused(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    def test_non_staff_user_is_refused(self):
+        self.client.force_login(User.objects.create_user('user'))
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    def test_staff_user(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+    def test_allowed_scraper(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.6').status_code, 403)
+
+    @override_settings(DEBUG=False, PROFILING={})
+    def test_profiling_off_outside_debug(self):
+        self.assertFalse(profiling_settings()['ENABLED'])
+        with self.settings(DEBUG=True):
+            self.assertTrue(profiling_settings()['ENABLED'])
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None)
+class SimilarImageViewTests(TestCase):
+    """/similar/<id>/ falling back to live scoring"""
+
+    def setUp(self):
+        catalog_changed()
+        self.client.force_login(User.objects.create_user('user'))
+        self.reference = Image.objects.create(title='Lonely', image_url='https://example.com/lonely.jpg',
+                                              labels='lonely')
+        Image.objects.create(title='Other', image_url='https://example.com/other.jpg', labels='cat, dog')
+
+    def tearDown(self):
+        catalog_changed()
+
+    def test_empty_ranking(self):
+        # The scorers pad with zero-score images, so this takes an index
+        # that does not know the candidate yet (added by another process)
+        with mock.patch('recommendation.views.rank_images', return_value=[]) as rank_images:
+            response = self.client.get(f'/similar/{self.reference.id}/')
+        rank_images.assert_called_once()
+        self.assertEqual(response.json(), {'success': False, 'message': 'No similar images found'})
+
+    def test_zero_score_candidate(self):
+        response = self.client.get(f'/similar/{self.reference.id}/').json()
+        self.assertTrue(response['success'])
+        self.assertEqual(response['similarity_score'], 0.0)
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None)
+class LabelStorageTests(TestCase):
+    """ImageLabel rows and Image.label_id_cache follow the labels field"""
+
+    def setUp(self):
+        catalog_changed()
+
+    def tearDown(self):
+        catalog_changed()
+
+    def assertLabelsStored(self, image, names):
+        rows = ImageLabel.objects.filter(image=image).select_related('label')
+        self.assertEqual({row.label.name for row in rows}, set(names))
+        expected = tuple(sorted(row.label_id for row in rows))
+        self.assertEqual(image.label_ids, expected)
+        fresh = Image.objects.get(id=image.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(fresh.label_ids, expected)
+
+    def test_relabel(self):
+        image = Image.objects.create(title='Pets', image_url='https://example.com/pets.jpg', labels='Cat, dog')
+        self.assertLabelsStored(image, ['cat', 'dog'])
+        image.labels = 'dog,  Big  Bird, dog'
+        image.save()
+        self.assertLabelsStored(image, ['dog', 'big bird'])
+        image.labels = ''
+        image.save()
+        self.assertLabelsStored(image, [])
+
+    def test_seeded_images(self):
+        seed_images(20, vocabulary=6, labels_per_image=3, rng=np.random.default_rng(13))
+        for image in Image.objects.all():
+            with self.subTest(image_id=image.id):
+                self.assertLabelsStored(image, image.get_normalized_labels())
+
+    def test_migration_fills_cache(self):
+        for number, labels in enumerate(['a, b', 'b', 'c, a, b', '']):
+            Image.objects.create(title=str(number), image_url='https://example.com/x.jpg', labels=labels)
+        Image.objects.update(label_id_cache='')
+        migration = importlib.import_module('recommendation.migrations.0014_image_label_id_cache')
+        migration.fill_label_id_cache(apps, None)
+        for image in Image.objects.all():
+            with self.subTest(image_id=image.id):
+                self.assertLabelsStored(image, image.get_normalized_labels())
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None)
+class LabelMatrixFileTests(TestCase):
+    """export_label_matrix files against the in-memory matrix"""
+
+    REFERENCES = [
+        [(['tag1'], 1)],
+        [(['tag1', 'tag2'], 3), (['tag3'], 1)],
+        [(['tag2', 'tag4'], 1), (['tag1', 'tag5', 'tag6'], 1)],
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(150, vocabulary=8, labels_per_image=3, rng=np.random.default_rng(14))
+
+    def setUp(self):
+        catalog_changed()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'labels.matrix')
+
+    def tearDown(self):
+        catalog_changed()
+
+    def export(self):
+        call_command('export_label_matrix', output=self.path, stdout=io.StringIO())
+
+    def assertSameRanking(self, engine):
+        memory = ScoringEngine(LabelIndex())
+        for references in self.REFERENCES:
+            for k in [1, 10, 149]:
+                got = engine.top_k(references, k, exclude_ids=[1])
+                expected = memory.top_k(references, k, exclude_ids=[1])
+                with self.subTest(references=references, k=k):
+                    # Changed rows are scored one by one, the last bit may differ
+                    self.assertEqual([image_id for image_id, _ in got], [image_id for image_id, _ in expected])
+                    np.testing.assert_allclose([score for _, score in got], [score for _, score in expected],
+                                               rtol=1e-12)
+
+    def test_mapped_matrix(self):
+        self.export()
+        matrix = MappedLabelMatrix(self.path)
+        self.assertEqual(matrix.change_seq, latest_seq())
+        memory = LabelMatrix.from_labels(LabelIndex().labels())
+        for name in ['image_ids', 'indptr', 'indices', 'rows', 'norms']:
+            np.testing.assert_array_equal(getattr(matrix, name), getattr(memory, name))
+        self.assertEqual(matrix.vocabulary, memory.vocabulary)
+        engine = ScoringEngine(LabelIndex(), path=self.path)
+        self.assertIsInstance(engine.matrix(), MappedLabelMatrix)
+        self.assertSameRanking(engine)
+
+    def test_changes_after_export(self):
+        self.export()
+        engine = ScoringEngine(LabelIndex(), path=self.path)
+        engine.matrix()
+        # Written by another process: only the change log tells this one
+        relabelled = list(Image.objects.order_by('id').values_list('id', flat=True)[:20])
+        Image.objects.filter(id__in=relabelled).update(labels='tag1, tag3')
+        record_changes(relabelled, CatalogChange.UPDATE)
+        engine.sync()
+        self.assertEqual(set(engine.changes()), set(relabelled))
+        self.assertSameRanking(engine)
+
+    def test_rewrite_is_picked_up(self):
+        self.export()
+        engine = ScoringEngine(LabelIndex(), path=self.path)
+        first = engine.matrix()
+        self.assertTrue(first.is_current())
+        self.assertIs(engine.matrix(), first)
+
+        Image.objects.filter(id__in=Image.objects.order_by('id').values('id')[:10]).update(labels='tag2')
+        self.export()
+        self.assertFalse(first.is_current())
+        second = engine.matrix()
+        self.assertIsNot(second, first)
+        self.assertTrue(second.is_current())
+        self.assertSameRanking(engine)
+
+    def test_other_format_version(self):
+        self.export()
+        with open(self.path, 'r+b') as f:
+            f.seek(8)
+            f.write((99).to_bytes(4, 'little'))
+        with self.assertRaises(LabelMatrixFileError):
+            MappedLabelMatrix(self.path)
+        engine = ScoringEngine(LabelIndex(), path=self.path)
+        with self.assertLogs('recommendation.scoring', 'WARNING'):
+            matrix = engine.matrix()
+        self.assertNotIsInstance(matrix, MappedLabelMatrix)
+        self.assertSameRanking(engine)
+
+        # A fresh export is mapped again
+        self.export()
+        self.assertIsInstance(engine.matrix(), MappedLabelMatrix)
+
+    def test_change_seq_past_the_log(self):
+        write_label_matrix(LabelMatrix.from_labels(LabelIndex().labels()), self.path, latest_seq() + 100)
+        engine = ScoringEngine(LabelIndex(), path=self.path)
+        with self.assertLogs('recommendation.scoring', 'WARNING'):
+            self.assertNotIsInstance(engine.matrix(), MappedLabelMatrix)
+        self.assertSameRanking(engine)
+
+    def test_change_seq_pruned(self):
+        self.export()
+        relabelled = list(Image.objects.order_by('id').values_list('id', flat=True)[:5])
+        Image.objects.filter(id__in=relabelled).update(labels='tag4')
+        record_changes(relabelled, CatalogChange.UPDATE)
+        CatalogChange.objects.update(created_at=timezone.now() - timedelta(days=30))
+        record_changes(relabelled[:1], CatalogChange.UPDATE)
+        prune_changes(timezone.now())
+
+        engine = ScoringEngine(LabelIndex(), path=self.path)
+        with self.assertLogs('recommendation.scoring', 'WARNING'):
+            self.assertIsInstance(engine.matrix(), MappedLabelMatrix)
+        self.assertEqual(set(engine.changes()), set(relabelled))
+        self.assertSameRanking(engine)
+
+
+class InlinePool:
+    """multiprocessing.Pool stand-in running the tasks in this process, inside the test transaction"""
+
+    def __init__(self, processes=None, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def imap(self, func, iterable):
+        return map(func, iterable)
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None, RECOMMENDATION_WRITE_BEHIND=False,
+                   PRECOMPUTED_RECOMMENDATIONS_MAX_AGE=600)
+@mock.patch('recommendation.management.commands.precompute_recommendations.Pool', InlinePool)
+class PrecomputedRecommendationTests(TestCase):
+    """manage.py precompute_recommendations and claiming its sessions"""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(80, vocabulary=8, labels_per_image=2, rng=np.random.default_rng(15))
+        seed_users(5, likes=3, stars=1, rng=np.random.default_rng(16))
+        cls.users = list(User.objects.order_by('id'))
+
+    def setUp(self):
+        catalog_changed()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = os.path.join(directory.name, 'checkpoint.json')
+
+    def tearDown(self):
+        catalog_changed()
+
+    def precompute(self, *args):
+        call_command('precompute_recommendations', '--processes=1', '--chunk-size=2', '--k=5', *args,
+                     stdout=io.StringIO())
+
+    def reference_key(self, user):
+        return reference_set_key(CollectionImage.objects.filter(collection__user=user)
+                                 .values_list('image_id', 'interaction_type'))
+
+    def test_resume_after_a_failed_chunk(self):
+        written = []
+        write_precomputed = RecommendationWriter.write_precomputed
+
+        def fail_on_third_chunk(writer, rankings):
+            if len(written) == 2:
+                raise RuntimeError('database went away')
+            written.append([user_id for user_id, _, _ in rankings])
+            return write_precomputed(writer, rankings)
+
+        with mock.patch.object(RecommendationWriter, 'write_precomputed', fail_on_third_chunk), \
+                self.assertRaises(RuntimeError):
+            self.precompute(f'--checkpoint={self.checkpoint}')
+        with open(self.checkpoint) as f:
+            progress = json.load(f)
+        self.assertEqual(progress['last_user_id'], self.users[3].id)
+        self.assertEqual(progress['users'], 4)
+
+        with mock.patch.object(RecommendationWriter, 'write_precomputed', fail_on_third_chunk):
+            written.clear()
+            self.precompute(f'--checkpoint={self.checkpoint}', '--resume')
+        # Only the users after the checkpoint are ranked again
+        self.assertEqual(written, [[self.users[4].id]])
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['users'], 5)
+        for user in self.users:
+            with self.subTest(user=user.id):
+                session = RecommendationSession.objects.get(user=user, precomputed=True)
+                self.assertEqual(session.reference_key, self.reference_key(user))
+                self.assertEqual(session.recommendation_set.count(), 5)
+
+    def test_resume_needs_checkpoint(self):
+        with self.assertRaises(CommandError):
+            self.precompute('--resume')
+
+    def test_same_ranking_as_online(self):
+        self.precompute()
+        for user in self.users:
+            precomputed = RecommendationSession.objects.get(user=user, precomputed=True)
+            stored = list(precomputed.recommendation_set.order_by('position').values_list('image_id', flat=True))
+            session, recommendations = recommend_for_user(user)
+            with self.subTest(user=user.id):
+                self.assertEqual(session.id, precomputed.id)
+                self.assertEqual([r.image_id for r in recommendations], stored)
+
+    def test_claimed_once(self):
+        self.precompute()
+        user = self.users[0]
+        session = claim_precomputed_session(user, self.reference_key(user))
+        self.assertIsNotNone(session)
+        self.assertIsNone(claim_precomputed_session(user, self.reference_key(user)))
+        self.assertFalse(RecommendationSession.objects.get(id=session.id).precomputed)
+
+    def test_lost_claim_race(self):
+        """A request that finds the session after another one took it gets None"""
+        self.precompute()
+        user = self.users[0]
+        first = QuerySet.first
+
+        def claimed_meanwhile(queryset):
+            session = first(queryset)
+            if session is not None:
+                RecommendationSession.objects.filter(id=session.id).update(precomputed=False)
+            return session
+
+        with mock.patch.object(QuerySet, 'first', claimed_meanwhile):
+            self.assertIsNone(claim_precomputed_session(user, self.reference_key(user)))
+
+    def test_max_age(self):
+        self.precompute()
+        user = self.users[0]
+        RecommendationSession.objects.filter(precomputed=True).update(
+            created_at=timezone.now() - timedelta(seconds=601)
+        )
+        self.assertIsNone(claim_precomputed_session(user, self.reference_key(user)))
+        session, _ = recommend_for_user(user)
+        self.assertFalse(session.precomputed)
+        # The stale session is left unserved
+        self.assertTrue(RecommendationSession.objects.filter(user=user, precomputed=True).exists())
+
+
+class WriteBehindWriterTests(TestCase):
+    """Rows of failed flushes are kept and written by a later one"""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(6, vocabulary=4, labels_per_image=2, rng=np.random.default_rng(17))
+        cls.user = User.objects.create_user('user')
+        cls.images = list(Image.objects.order_by('id'))
+
+    def setUp(self):
+        catalog_changed()
+
+    def tearDown(self):
+        catalog_changed()
+
+    def writer(self, interval=60.0):
+        writer = WriteBehindRecommendationWriter(interval=interval)
+        sessions = [RecommendationSession.objects.create(user=self.user) for _ in range(2)]
+        # The rows stay pending: a background flush would use another connection
+        with mock.patch.object(writer, '_ensure_thread'):
+            for session in sessions:
+                writer.write_session(session, [(image, 0.5) for image in self.images[:3]])
+        return writer, sessions
+
+    def failing_writes(self, failures):
+        """Make the next ``failures`` bulk inserts fail like a locked database"""
+        bulk_create = Recommendation.objects.bulk_create
+        remaining = [failures]
+
+        def flaky_bulk_create(*args, **kwargs):
+            if remaining[0] > 0:
+                remaining[0] -= 1
+                raise OperationalError('database is locked')
+            return bulk_create(*args, **kwargs)
+
+        return mock.patch.object(Recommendation.objects, 'bulk_create', side_effect=flaky_bulk_create)
+
+    def assertWritten(self, sessions):
+        for session in sessions:
+            self.assertEqual(
+                list(session.recommendation_set.order_by('position').values_list('image_id', 'position')),
+                [(image.id, position) for position, image in enumerate(self.images[:3], start=1)]
+            )
+
+    def test_failed_flush_is_retried(self):
+        writer, sessions = self.writer()
+        with self.failing_writes(1):
+            with self.assertRaises(OperationalError):
+                writer.flush()
+            self.assertFalse(Recommendation.objects.exists())
+            self.assertEqual(len(writer._pending), 6)
+            writer.flush()
+        self.assertWritten(sessions)
+        self.assertEqual(writer._pending, [])
+
+    def test_background_thread_retries_on_next_tick(self):
+        writer, sessions = self.writer(interval=0.01)
+        flush = writer.flush
+        flushes = []
+
+        def flush_until_written():
+            flushes.append(len(writer._pending))
+            try:
+                flush()
+            finally:
+                writer._closed = not writer._pending
+
+        with self.failing_writes(1), \
+                mock.patch('recommendation.persistence.close_old_connections'), \
+                mock.patch.object(writer, 'flush', side_effect=flush_until_written), \
+                self.assertLogs('recommendation.persistence', 'ERROR'):
+            writer._run()
+        self.assertEqual(flushes, [6, 6])
+        self.assertWritten(sessions)
+
+    def test_close_retries(self):
+        writer, sessions = self.writer(interval=0)
+        with self.failing_writes(2):
+            writer.close(retries=3)
+        self.assertWritten(sessions)
+
+        # Closed: written straight away
+        session = RecommendationSession.objects.create(user=self.user)
+        writer.write_session(session, [(self.images[0], 0.5)])
+        self.assertEqual(session.recommendation_set.count(), 1)
+
+    def test_close_gives_up(self):
+        writer, _ = self.writer(interval=0)
+        with self.failing_writes(10), self.assertLogs('recommendation.persistence', 'ERROR') as logs:
+            writer.close(retries=2)
+        self.assertIn('Dropped 6 recommendations at shutdown', logs.output[-1])
+        self.assertEqual(writer._pending, [])
+
+    def test_close_stops_the_thread(self):
+        writer = WriteBehindRecommendationWriter(interval=60.0)
+        writer._ensure_thread()
+        thread = writer._thread
+        started = time.monotonic()
+        writer.close()
+        self.assertFalse(thread.is_alive())
+        self.assertLess(time.monotonic() - started, 5)
+
+
+class BrowsePaginationTests(TestCase):
+    """Keyset pagination of the catalog, newest first"""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(10, vocabulary=4, labels_per_image=2, rng=np.random.default_rng(18))
+        cls.user = User.objects.create_user('user')
+        # Bulk imports share a timestamp: the id breaks the ties
+        now = timezone.now()
+        image_ids = list(Image.objects.order_by('id').values_list('id', flat=True))
+        Image.objects.filter(id__in=image_ids[:7]).update(created_at=now - timedelta(hours=1))
+        Image.objects.filter(id__in=image_ids[7:]).update(created_at=now)
+        cls.expected = image_ids[7:][::-1] + image_ids[:7][::-1]
+
+    def setUp(self):
+        catalog_changed()
+
+    def tearDown(self):
+        catalog_changed()
+
+    def walk(self, limit):
+        pages = []
+        cursor = None
+        while True:
+            images, cursor = browse_page(self.user, cursor, limit)
+            pages.append([image.id for image in images])
+            if cursor is None:
+                return pages
+
+    def test_equal_created_at(self):
+        for limit in [1, 2, 3, 4, 7]:
+            with self.subTest(limit=limit):
+                pages = self.walk(limit)
+                self.assertEqual([image_id for page in pages for image_id in page], self.expected)
+                self.assertTrue(all(len(page) == limit for page in pages[:-1]))
+
+    def test_last_page(self):
+        # Exactly full: no empty page after it
+        for limit in [5, 10]:
+            with self.subTest(limit=limit):
+                pages = self.walk(limit)
+                self.assertEqual([len(page) for page in pages], [limit] * (10 // limit))
+        images, cursor = browse_page(self.user, None, 11)
+        self.assertEqual(len(images), 10)
+        self.assertIsNone(cursor)
+
+        last = Image.objects.get(id=self.expected[-1])
+        self.assertEqual(browse_page(self.user, encode_cursor(last), 5), ([], None))
+
+    def test_garbage_cursor(self):
+        first_page = [image.id for image in browse_page(self.user, None, 3)[0]]
+        naive = base64.urlsafe_b64encode(b'2026-01-01T00:00:00|5').decode('ascii')
+        for cursor in ['garbage', '!!!', '\u00e9t\u00e9', base64.urlsafe_b64encode(b'no separator').decode('ascii'),
+                       base64.urlsafe_b64encode(b'2026-01-01T00:00:00+00:00|x').decode('ascii'),
+                       base64.urlsafe_b64encode(b'yesterday|5').decode('ascii'),
+                       base64.urlsafe_b64encode(b'\xff\xfe|5').decode('ascii'), naive]:
+            with self.subTest(cursor=cursor):
+                self.assertIsNone(decode_cursor(cursor))
+                self.assertEqual([image.id for image in browse_page(self.user, cursor, 3)[0]], first_page)
+
+    def test_tampered_cursor(self):
+        """A well-formed cursor for any position just starts there"""
+        middle = Image.objects.get(id=self.expected[3])
+        cursor = base64.urlsafe_b64encode(
+            f'{middle.created_at.isoformat()}|{middle.id}'.encode('utf-8')
+        ).decode('ascii')
+        self.assertEqual(decode_cursor(cursor), (middle.created_at, middle.id))
+        images, _ = browse_page(self.user, cursor, 3)
+        self.assertEqual([image.id for image in images], self.expected[4:7])
+
+    def test_api(self):
+        self.client.force_login(self.user)
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get('/api/images/', {'cursor': cursor, 'limit': 4}).json()
+            seen.extend(image['image_id'] for image in response['images'])
+            cursor = response['next_cursor']
+        self.assertEqual(seen, self.expected)
+        response = self.client.get('/api/images/', {'cursor': 'garbage', 'limit': 'x'}).json()
+        self.assertTrue(response['success'])
+        self.assertEqual([image['image_id'] for image in response['images']], self.expected)
+
+
+@override_settings(CATALOG_CHANGE_POLL_INTERVAL=None, RECOMMENDATION_WRITE_BEHIND=False)
+class RecommendationStreamTests(TestCase):
+    """iter_recommendation_batches and the NDJSON endpoint built on it"""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_images(40, vocabulary=6, labels_per_image=2, rng=np.random.default_rng(19))
+        cls.user = User.objects.create_user('user')
+        images = list(Image.objects.order_by('id'))
+        cls.session = RecommendationSession.objects.create(user=cls.user, next_position=26)
+        Recommendation.objects.bulk_create([
+            Recommendation(session=cls.session, image=image, similarity_score=1 - position / 100, position=position)
+            for position, image in enumerate(images[:25], start=1)
+        ])
+
+    def setUp(self):
+        catalog_changed()
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        catalog_changed()
+
+    def batches(self, *args, **kwargs):
+        return [[recommendation.position for recommendation in batch]
+                for batch in iter_recommendation_batches(self.session.id, *args, **kwargs)]
+
+    def stream(self, path, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+
+    def test_batches(self):
+        with self.assertNumQueries(3):
+            self.assertEqual([len(batch) for batch in self.batches(batch_size=10)], [10, 10, 5])
+        # A full last batch takes one more query to find the end
+        with self.assertNumQueries(6):
+            self.assertEqual([len(batch) for batch in self.batches(batch_size=5)], [5] * 5)
+
+    def test_limit_below_batch_size(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.batches(batch_size=10, limit=3), [[1, 2, 3]])
+        self.assertEqual(self.batches(batch_size=10, limit=0), [])
+
+    def test_resume_from_position(self):
+        self.assertEqual(self.batches(after=12, batch_size=2, limit=5), [[13, 14], [15, 16], [17]])
+        self.assertEqual(self.batches(after=20, batch_size=10), [[21, 22, 23, 24, 25]])
+        self.assertEqual(self.batches(after=25), [])
+
+    def test_stream_resumes(self):
+        path = f'/api/recommendations/{self.session.id}/'
+        first = self.stream(path, limit=4, batch_size=10)
+        self.assertEqual(first[0], {'session_id': self.session.id})
+        self.assertEqual([line['position'] for line in first[1:-1]], [1, 2, 3, 4])
+        self.assertEqual(first[-1], {'done': True, 'last_position': 4, 'pending': False})
+
+        rest = self.stream(path, after=first[-1]['last_position'], batch_size=3)
+        self.assertEqual([line['position'] for line in rest[1:-1]], list(range(5, 26)))
+        self.assertEqual(rest[-1]['last_position'], 25)
+        image_ids = list(self.session.recommendation_set.order_by('position').values_list('image_id', flat=True))
+        self.assertEqual([line['image_id'] for line in first[1:-1] + rest[1:-1]], image_ids)
+
+        done = self.stream(path, after=25)
+        self.assertEqual(done[1:], [{'done': True, 'last_position': 25, 'pending': False}])
+
+    def test_stream_new_session(self):
+        image = Image.objects.order_by('id').last()
+        collection = Collection.objects.create(user=self.user, name='Liked Images')
+        CollectionImage.objects.create(collection=collection, image=image, interaction_type=1)
+        with mock.patch('recommendation.recommender.generation_available', return_value=False):
+            lines = self.stream('/api/recommendations/', limit=3)
+            session_id = lines[0]['session_id']
+            self.assertNotEqual(session_id, self.session.id)
+            self.assertEqual([line['position'] for line in lines[1:-1]], [1, 2, 3])
+            rest = self.stream(f'/api/recommendations/{session_id}/', after=3)
+        self.assertEqual([line['position'] for line in rest[1:-1]], list(range(4, 11)))
+
+    def test_bad_requests(self):
+        for params in [{'after': 'x'}, {'limit': 'all'}, {'batch_size': '1.5'}]:
+            with self.subTest(params=params):
+                response = self.client.get(f'/api/recommendations/{self.session.id}/', params)
+                self.assertEqual(response.json(), {'success': False, 'message': 'Invalid parameters'})
+        other = RecommendationSession.objects.create(user=User.objects.create_user('other'))
+        response = self.client.get(f'/api/recommendations/{other.id}/')
+        self.assertEqual(response.json(), {'success': False, 'message': 'Session not found'})
+
+
+class MemoryPromptCacheTests(SimpleTestCase):
+    """LRU order, TTL expiry and the hit/miss counters of the per-process prompt cache"""
+
+    def setUp(self):
+        patcher = mock.patch('recommendation.cache.time.monotonic', return_value=1000.0)
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def key(self, prompt):
+        return (prompt, 512, 512, 'flux', None)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = MemoryPromptCache(max_entries=2)
+        cache.set(self.key('a'), 'https://example.com/a.jpg')
+        cache.set(self.key('b'), 'https://example.com/b.jpg')
+        self.assertEqual(cache.get(self.key('a')), 'https://example.com/a.jpg')
+        cache.set(self.key('c'), 'https://example.com/c.jpg')
+        self.assertIsNone(cache.get(self.key('b')))
+        self.assertEqual(cache.get(self.key('a')), 'https://example.com/a.jpg')
+        self.assertEqual(cache.get(self.key('c')), 'https://example.com/c.jpg')
+
+    def test_overwrite_refreshes_without_growing(self):
+        cache = MemoryPromptCache(max_entries=2)
+        cache.set(self.key('a'), 'https://example.com/a.jpg')
+        cache.set(self.key('b'), 'https://example.com/b.jpg')
+        cache.set(self.key('a'), 'https://example.com/a2.jpg')
+        cache.set(self.key('c'), 'https://example.com/c.jpg')
+        self.assertEqual(len(cache._entries), 2)
+        self.assertEqual(cache.get(self.key('a')), 'https://example.com/a2.jpg')
+        self.assertIsNone(cache.get(self.key('b')))
+
+    def test_entries_expire(self):
+        cache = MemoryPromptCache(timeout=60)
+        cache.set(self.key('a'), 'https://example.com/a.jpg')
+        self.clock.return_value = 1060.0
+        self.assertEqual(cache.get(self.key('a')), 'https://example.com/a.jpg')
+        self.clock.return_value = 1060.5
+        self.assertIsNone(cache.get(self.key('a')))
+        self.assertEqual(len(cache._entries), 0)
+
+        # Setting again starts a new lifetime
+        cache.set(self.key('a'), 'https://example.com/a.jpg')
+        self.clock.return_value = 1100.0
+        self.assertEqual(cache.get(self.key('a')), 'https://example.com/a.jpg')
+
+    def test_counters(self):
+        cache = MemoryPromptCache(timeout=60, max_entries=1)
+        self.assertIsNone(cache.get(self.key('a')))
+        cache.set(self.key('a'), 'https://example.com/a.jpg')
+        cache.get(self.key('a'))
+        cache.get(self.key('a'))
+        cache.set(self.key('b'), 'https://example.com/b.jpg')
+        # Evicted and expired entries count as misses
+        cache.get(self.key('a'))
+        self.clock.return_value = 2000.0
+        cache.get(self.key('b'))
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 3})
+
+    def test_keys_cover_every_parameter(self):
+        cache = MemoryPromptCache()
+        cache.set(('cat', 512, 512, 'flux', 1), 'https://example.com/cat.jpg')
+        for key in [('cat', 512, 512, 'flux', 2), ('cat', 256, 512, 'flux', 1), ('cat', 512, 512, 'turbo', 1),
+                    ('Cat', 512, 512, 'flux', 1), ('cat', 512, 512, 'flux', None)]:
+            with self.subTest(key=key):
+                self.assertIsNone(cache.get(key))
+
+
+class MediaServingTests(TestCase):
+    """serve_media: conditional requests and names outside the store"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = os.path.join(directory.name, 'media')
+        store = ContentAddressedStore(root=self.root, base_url='/media/')
+        patcher = mock.patch('recommendation.views.get_media_store', return_value=store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.name = store.save([b'\xff\xd8 image bytes'], 'image/jpeg')
+        self.etag = '"%s"' % os.path.splitext(os.path.basename(self.name))[0]
+        # Outside the store root
+        with open(os.path.join(directory.name, 'secret.txt'), 'w') as f:
+            f.write('secret')
+
+    def test_serves_file(self):
+        response = self.client.get(f'/media/{self.name}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'\xff\xd8 image bytes')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_not_modified(self):
+        for if_none_match in [self.etag, f'W/{self.etag}', f'"other", {self.etag}', f'"other",{self.etag} ', '*']:
+            with self.subTest(if_none_match=if_none_match):
+                response = self.client.get(f'/media/{self.name}', HTTP_IF_NONE_MATCH=if_none_match)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], self.etag)
+
+    def test_modified(self):
+        # Tags that only resemble this one
+        partial = self.etag.strip('"')
+        for if_none_match in ['"other"', f'"{partial}0"', f'"x{partial}"', partial, f'"{partial[:10]}"', '']:
+            with self.subTest(if_none_match=if_none_match):
+                response = self.client.get(f'/media/{self.name}', HTTP_IF_NONE_MATCH=if_none_match)
+                self.assertEqual(response.status_code, 200)
+
+    def test_path_traversal(self):
+        for name in ['../secret.txt', 'generated/../../secret.txt', '..%2Fsecret.txt', '%2e%2e/secret.txt',
+                     f'{self.root}/../secret.txt', '/etc/passwd',
+                     'generated/./' + self.name.split('/', 1)[1], 'generated//' + self.name.split('/', 1)[1]]:
+            with self.subTest(name=name):
+                response = self.client.get(f'/media/{name}')
+                self.assertEqual(response.status_code, 404)
+                self.assertNotIn(b'secret', b''.join(getattr(response, 'streaming_content', [response.content])))
+
+    def test_missing_and_partial_files(self):
+        os.makedirs(os.path.join(self.root, 'generated'), exist_ok=True)
+        with open(os.path.join(self.root, 'generated', 'tmp1234.part'), 'wb') as f:
+            f.write(b'half an image')
+        for name in ['generated/tmp1234.part', 'generated/missing.jpg', 'generated', 'generated/']:
+            with self.subTest(name=name):
+                self.assertEqual(self.client.get(f'/media/{name}').status_code, 404)
+
+    @override_settings(MEDIA_SENDFILE_HEADER='X-Accel-Redirect', MEDIA_SENDFILE_PREFIX='/protected-media/')
+    def test_sendfile(self):
+        response = self.client.get(f'/media/{self.name}')
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.name}')
+        self.assertEqual(response.content, b'')
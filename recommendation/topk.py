@@ -0,0 +1,130 @@
+import heapq
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Slack for float rounding between a bound and the exact score it caps
+BOUND_TOLERANCE = 1e-9
+# Scores equal to this many decimals are ties, broken on ascending image id.
+# The scorers add up the same terms in different orders, so equal scores may
+# differ in their last bits.
+SCORE_DECIMALS = 12
+
+
+def score_key(score: float) -> float:
+    """Score as compared when ranking, see SCORE_DECIMALS"""
+    return float(np.round(score, SCORE_DECIMALS))
+
+
+class TopK:
+    """
+    Bounded min-heap keeping the k best (image_id, score) pairs seen so far
+
+    Ordering matches select_top_k(): score descending, ties broken on
+    ascending image id, so the heap root is the entry the next better
+    candidate replaces.
+    """
+
+    def __init__(self, k: int, positive_only: bool = False):
+        self.k = k
+        self.positive_only = positive_only
+        # (score_key, -image_id, score): the root is the lowest score, highest id
+        self._heap: List[Tuple[float, int, float]] = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def threshold(self) -> Optional[float]:
+        """Score a candidate has to reach to enter, None while not full"""
+        if len(self._heap) < self.k:
+            return None
+        return self._heap[0][0]
+
+    def admits(self, bound: float) -> bool:
+        """False when no candidate scoring at most ``bound`` can enter"""
+        threshold = self.threshold()
+        return threshold is None or bound + BOUND_TOLERANCE >= threshold
+
+    def push(self, image_id: int, score: float):
+        if self.k <= 0 or (self.positive_only and score <= 0):
+            return
+        entry = (score_key(score), -image_id, score)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+
+    def extend(self, pairs: Iterable[Tuple[int, float]]):
+        for image_id, score in pairs:
+            self.push(image_id, score)
+
+    def results(self) -> List[Tuple[int, float]]:
+        """The kept pairs sorted by score descending, then id ascending"""
+        return [(-negative_id, score) for _, negative_id, score in sorted(self._heap, reverse=True)]
+
+
+class CosineBound:
+    """
+    Upper bound of the weighted average cosine score of an image
+
+    An image with ``b`` distinct labels shares at most min(a, b) labels with a
+    reference of ``a`` labels, so its cosine with it is at most
+    min(a, b) / sqrt(a * b).  Summed over the references this is tightened by
+    folding them first: the weighted score is (B . q) / sqrt(b) with
+    q[label] = sum_r w_r / sqrt(a_r) (LabelMatrix.query_vector()), which is at
+    most the sum of the b largest weights of q over sqrt(b).  For a single
+    reference both bounds are equal.  The bound only depends on ``b``.
+    """
+
+    def __init__(self, references: List[Tuple[Sequence[str], int]]):
+        self.total_weight = sum(weight for _, weight in references)
+        query: Dict[str, float] = {}
+        for labels, weight in references:
+            label_set = set(labels)
+            if not label_set:
+                continue
+            contribution = weight / len(label_set) ** 0.5
+            for label in label_set:
+                query[label] = query.get(label, 0.0) + contribution
+        # prefix[i]: sum of the i largest weights
+        self.prefix = [0.0]
+        for value in sorted(query.values(), reverse=True):
+            self.prefix.append(self.prefix[-1] + value)
+
+    def __call__(self, size: int) -> float:
+        if size <= 0 or self.total_weight <= 0:
+            return 0.0
+        return self.prefix[min(size, len(self.prefix) - 1)] / size ** 0.5 / self.total_weight
+
+
+def push_bounded(top: TopK, candidates: Iterable[Tuple[int, Sequence[str]]],
+                 score: Callable[[Sequence[str]], float], bound: CosineBound) -> TopK:
+    """
+    Score candidates into ``top``, skipping those that cannot enter it
+
+    Candidates are grouped by label count and the groups visited from the
+    highest bound down, so scoring stops at the first group whose bound is
+    below the current k-th score.
+
+    Args:
+        top (TopK): Selector, possibly already holding results
+        candidates (Iterable[Tuple[int, Sequence[str]]]): (image_id, labels) pairs
+        score (Callable[[Sequence[str]], float]): Exact score of a label list
+        bound (CosineBound): Upper bound of ``score`` by label count
+
+    Returns:
+        TopK: ``top``
+    """
+    groups = defaultdict(list)
+    for image_id, labels in candidates:
+        groups[len(set(labels))].append((image_id, labels))
+
+    for size in sorted(groups, key=lambda size: (-bound(size), size)):
+        size_bound = bound(size)
+        for image_id, labels in groups[size]:
+            # The k-th score only goes up, nothing after this can enter either
+            if not top.admits(size_bound):
+                return top
+            top.push(image_id, score(labels))
+    return top
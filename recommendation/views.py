@@ -1,13 +1,29 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import (FileResponse, Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified,
+                         JsonResponse, StreamingHttpResponse)
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+from django.utils.http import parse_etags
 from .models import Image, Collection, CollectionImage, RecommendationSession, Recommendation
 import json
+import mimetypes
+import os
 
 # Import our new services
-from .services import PollinationsAIService, calculate_cosine_similarity
+from .jobs import has_pending_jobs
+from .pagination import browse_page
+from .recommender import iter_recommendation_batches, recommend_for_user
+from .scoring import rank_images
+from .similarity import most_similar
+from .cache import catalog_image_count, invalidate_user_recommendations
+from .media import get_media_store
+from .profiling import metrics as metrics_registry
 
 def dashboard(request):
     """Main dashboard view"""
@@ -15,14 +31,16 @@ def dashboard(request):
     if not request.user.is_authenticated:
         return redirect('/admin/login/?next=/')
     
-    # Get user's collections
-    collections = Collection.objects.filter(user=request.user)
+    # Get user's collections, with their image counts in the same query
+    collections = Collection.objects.filter(user=request.user).annotate(
+        image_count=Count('collectionimage')
+    )
     
     # Get reference images (starred and liked)
     reference_images = []
     collection_images = CollectionImage.objects.filter(
         collection__user=request.user
-    ).select_related('image')
+    ).select_related('image', 'image__asset')
     
     for ci in collection_images:
         reference_images.append({
@@ -42,24 +60,52 @@ def browse_images(request):
     if not request.user.is_authenticated:
         return redirect('/admin/login/?next=/browse/')
     
-    # Get all images
-    images = Image.objects.all().order_by('-created_at')
+    # Get one page of images, newest first; the rest is loaded on scroll
+    images, next_cursor = browse_page(
+        request.user,
+        cursor=request.GET.get('cursor'),
+        limit=getattr(settings, 'BROWSE_PAGE_SIZE', 24)
+    )
     
     # Get user's collections for the add to collection dropdown
     collections = Collection.objects.filter(user=request.user)
     
-    # Check which images the user has already interacted with
-    user_collection_images = CollectionImage.objects.filter(
-        collection__user=request.user
-    ).values_list('image_id', flat=True)
-    
     context = {
         'images': images,
+        'image_count': catalog_image_count(),
+        'next_cursor': next_cursor,
         'collections': collections,
-        'user_collection_images': list(user_collection_images)
+        'collections_json': [{'id': c.id, 'name': c.name} for c in collections]
     }
     return render(request, 'recommendation/browse.html', context)
 
+@login_required
+def browse_images_api(request):
+    """JSON page of the catalog for infinite scrolling"""
+    try:
+        limit = int(request.GET.get('limit', getattr(settings, 'BROWSE_PAGE_SIZE', 24)))
+    except ValueError:
+        limit = getattr(settings, 'BROWSE_PAGE_SIZE', 24)
+    limit = max(1, min(limit, getattr(settings, 'BROWSE_MAX_PAGE_SIZE', 100)))
+    
+    images, next_cursor = browse_page(request.user, cursor=request.GET.get('cursor'), limit=limit)
+    
+    return JsonResponse({
+        'success': True,
+        'images': [
+            {
+                'image_id': image.id,
+                'image_title': image.title,
+                'image_url': image.image_url,
+                'thumbnail_url': image.thumbnail_url(),
+                'labels': image.get_label_list(),
+                'in_collection': image.in_collection
+            }
+            for image in images
+        ],
+        'next_cursor': next_cursor
+    })
+
 @csrf_exempt
 @login_required
 def star_image(request):
@@ -85,6 +131,9 @@ def star_image(request):
                 defaults={'interaction_type': 3}
             )
             
+            # The reference set changed, drop the cached ranking
+            invalidate_user_recommendations(request.user.id)
+            
             return JsonResponse({
                 'success': True,
                 'message': 'Image starred successfully'
@@ -130,6 +179,9 @@ def like_image(request):
                 defaults={'interaction_type': 1}
             )
             
+            # The reference set changed, drop the cached ranking
+            invalidate_user_recommendations(request.user.id)
+            
             return JsonResponse({
                 'success': True,
                 'message': 'Image liked successfully'
@@ -153,126 +205,92 @@ def like_image(request):
 @login_required
 def generate_recommendations(request):
     """Generate recommendations based on reference images"""
-    # Get all reference images with their weights
-    collection_images = CollectionImage.objects.filter(
-        collection__user=request.user
-    ).select_related('image')
-    
-    if not collection_images:
-        # No reference images, return empty recommendations
-        return render(request, 'recommendation/recommendations.html', {
-            'recommendations': [],
-            'session_id': None
-        })
-    
-    # Create a new recommendation session
-    session = RecommendationSession.objects.create(user=request.user)
-    
-    # Get all images that are not in the user's collections
-    user_image_ids = CollectionImage.objects.filter(
-        collection__user=request.user
-    ).values_list('image_id', flat=True)
-    
-    # Get candidate images (not in user's collections)
-    candidate_images = Image.objects.exclude(id__in=user_image_ids)
+    session, recommendations = recommend_for_user(request.user)
     
-    # Calculate similarity scores for each candidate
-    scored_images = []
-    reference_labels = []
+    return render(request, 'recommendation/recommendations.html', {
+        'recommendations': recommendations,
+        'session_id': session.id if session else None,
+        'collections': Collection.objects.filter(user=request.user)
+    })
+
+def _recommendation_line(recommendation):
+    return json.dumps({
+        'image_id': recommendation.image.id,
+        'image_title': recommendation.image.title,
+        'image_url': recommendation.image.image_url,
+        'thumbnail_url': recommendation.image.thumbnail_url(),
+        'position': recommendation.position,
+        'similarity_score': recommendation.similarity_score
+    }) + '\n'
+
+@login_required
+def stream_recommendations(request, session_id=None):
+    """
+    Stream ranked recommendations as newline-delimited JSON
     
-    # Collect all reference labels
-    for ci in collection_images:
-        reference_labels.extend(ci.image.get_label_list())
+    Without a session id a session is generated (or reused) first. The first
+    line names the session, then one line per recommendation follows and a
+    final line tells whether AI generated images are still on their way.
+    Query parameters: ``after`` (position to resume from), ``limit`` (number
+    of items to send) and ``batch_size`` (rows read per query).
+    """
+    try:
+        after = max(0, int(request.GET.get('after', 0)))
+        limit = int(request.GET['limit']) if 'limit' in request.GET else None
+        batch_size = max(1, min(int(request.GET.get('batch_size', 10)), 100))
+    except ValueError:
+        return JsonResponse({
+            'success': False,
+            'message': 'Invalid parameters'
+        })
     
-    # Remove duplicates while preserving order
-    reference_labels = list(dict.fromkeys(reference_labels))
+    fresh = []
+    if session_id is None:
+        session, fresh = recommend_for_user(request.user)
+        if session is None:
+            return JsonResponse({
+                'success': False,
+                'message': 'No reference images'
+            })
+    else:
+        session = RecommendationSession.objects.filter(id=session_id, user=request.user).first()
+        if session is None:
+            return JsonResponse({
+                'success': False,
+                'message': 'Session not found'
+            })
     
-    for image in candidate_images:
-        total_score = 0
-        total_weight = 0
+    def lines():
+        nonlocal after, limit
+        yield json.dumps({'session_id': session.id}) + '\n'
         
-        # Compare with each reference image
-        for ci in collection_images:
-            similarity = calculate_cosine_similarity(
-                ci.image.get_label_list(),
-                image.get_label_list()
-            )
-            total_score += similarity * ci.interaction_type
-            total_weight += ci.interaction_type
+        # Rows of a session built by this request may not be written yet
+        # (write-behind mode), send them from memory
+        for recommendation in fresh:
+            if recommendation.position > after and (limit is None or limit > 0):
+                yield _recommendation_line(recommendation)
+                after = recommendation.position
+                if limit is not None:
+                    limit -= 1
         
-        if total_weight > 0:
-            avg_score = total_score / total_weight
-            scored_images.append((image, avg_score))
-    
-    # Sort by similarity score (descending)
-    scored_images.sort(key=lambda x: x[1], reverse=True)
-    
-    # Take top 10 existing images
-    top_existing_images = scored_images[:10]
-    
-    # Generate new images using Pollinations.AI
-    pollinations_service = PollinationsAIService()
-    generated_images = []
-    
-    # Generate 10 new images based on reference labels
-    for i in range(10):
-        # Create a prompt based on reference labels
-        prompt = pollinations_service.generate_recommendation_prompt(reference_labels)
-        
-        # Generate image
-        image_url = pollinations_service.generate_image(prompt)
+        for batch in iter_recommendation_batches(session.id, after, batch_size, limit):
+            for recommendation in batch:
+                yield _recommendation_line(recommendation)
+                after = recommendation.position
         
-        if image_url:
-            # Create a temporary image object for the recommendation
-            temp_image = Image(
-                title=f"AI Generated Recommendation #{i+1}",
-                image_url=image_url,
-                labels=", ".join(reference_labels[:5])  # Use top 5 labels
-            )
-            generated_images.append((temp_image, 0.8))  # High similarity score for generated images
-    
-    # Combine existing and generated images
-    all_recommendations = top_existing_images + generated_images
-    
-    # Sort all recommendations by similarity score
-    all_recommendations.sort(key=lambda x: x[1], reverse=True)
-    
-    # Take top 20
-    top_recommendations = all_recommendations[:20]
-    
-    # Save recommendations to database
-    recommendations = []
-    for i, (image, score) in enumerate(top_recommendations):
-        # For generated images, we need to save them to the database first
-        if hasattr(image, 'id') and image.id:
-            # Existing image
-            rec = Recommendation.objects.create(
-                session=session,
-                image=image,
-                similarity_score=score,
-                position=i+1
-            )
-        else:
-            # Generated image - save it first
-            image.save()
-            rec = Recommendation.objects.create(
-                session=session,
-                image=image,
-                similarity_score=score,
-                position=i+1
-            )
-        recommendations.append(rec)
+        yield json.dumps({
+            'done': True,
+            'last_position': after,
+            'pending': has_pending_jobs(session.id)
+        }) + '\n'
     
-    return render(request, 'recommendation/recommendations.html', {
-        'recommendations': recommendations,
-        'session_id': session.id
-    })
+    return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
 
 @login_required
 def next_recommendation(request, session_id, current_position):
     """Get the next recommendation in the sequence"""
     try:
-        recommendation = Recommendation.objects.get(
+        recommendation = Recommendation.objects.select_related('image', 'image__asset').get(
             session_id=session_id,
             position=current_position + 1
         )
@@ -281,10 +299,18 @@ def next_recommendation(request, session_id, current_position):
             'image_id': recommendation.image.id,
             'image_title': recommendation.image.title,
             'image_url': recommendation.image.image_url,
+            'thumbnail_url': recommendation.image.thumbnail_url(),
             'position': recommendation.position,
             'similarity_score': recommendation.similarity_score
         })
     except Recommendation.DoesNotExist:
+        if has_pending_jobs(session_id):
+            # AI generated images for this session are still on their way
+            return JsonResponse({
+                'success': False,
+                'pending': True,
+                'message': 'More recommendations are being generated'
+            })
         return JsonResponse({
             'success': False,
             'message': 'No more recommendations'
@@ -311,34 +337,31 @@ def get_similar_image(request, image_id):
                 'message': 'No similar images found'
             })
         
-        # Calculate similarity scores for each candidate
-        scored_images = []
-        reference_labels = reference_image.get_label_list()
-        
-        for image in candidate_images:
-            similarity = calculate_cosine_similarity(
-                reference_labels,
-                image.get_label_list()
+        # Use the precomputed neighbour table, falling back to scoring the
+        # catalog when every stored neighbour is already in a collection
+        neighbour = most_similar(image_id, exclude_ids=user_image_ids)
+        if neighbour:
+            most_similar_image, similarity_score = neighbour.neighbour, neighbour.score
+        else:
+            # Empty when this process' index does not know the candidates yet
+            ranked = rank_images(
+                [(reference_image, 1)], 1,
+                exclude_ids=set(user_image_ids) | {image_id}
             )
-            scored_images.append((image, similarity))
-        
-        # Sort by similarity score (descending) and get the most similar
-        scored_images.sort(key=lambda x: x[1], reverse=True)
-        
-        if not scored_images:
-            return JsonResponse({
-                'success': False,
-                'message': 'No similar images found'
-            })
-        
-        # Get the most similar image
-        most_similar_image, similarity_score = scored_images[0]
+            if not ranked:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'No similar images found'
+                })
+            most_similar_id, similarity_score = ranked[0]
+            most_similar_image = Image.objects.select_related('asset').get(id=most_similar_id)
         
         return JsonResponse({
             'success': True,
             'image_id': most_similar_image.id,
             'image_title': most_similar_image.title,
             'image_url': most_similar_image.image_url,
+            'thumbnail_url': most_similar_image.thumbnail_url(),
             'similarity_score': similarity_score
         })
     except Image.DoesNotExist:
@@ -372,6 +395,9 @@ def add_to_collection(request):
                 defaults={'interaction_type': 1}  # Default to liked
             )
             
+            # The reference set changed, drop the cached ranking
+            invalidate_user_recommendations(request.user.id)
+            
             # Mark as added in recommendation
             Recommendation.objects.filter(
                 image=image,
@@ -412,6 +438,9 @@ def remove_all_starred_liked(request):
                 name='Liked Images'
             ).delete()
             
+            # The reference set changed, drop the cached ranking
+            invalidate_user_recommendations(request.user.id)
+            
             return JsonResponse({
                 'success': True,
                 'message': 'All starred and liked images removed successfully'
@@ -433,10 +462,17 @@ def create_collection(request):
     if request.method == 'POST':
         name = request.POST.get('name')
         if name:
-            collection = Collection.objects.create(
-                name=name,
-                user=request.user
-            )
+            try:
+                with transaction.atomic():
+                    collection = Collection.objects.create(
+                        name=name,
+                        user=request.user
+                    )
+            except IntegrityError:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'A collection with this name already exists'
+                })
             return JsonResponse({
                 'success': True,
                 'collection_id': collection.id,
@@ -445,4 +481,52 @@ def create_collection(request):
     return JsonResponse({
         'success': False,
         'message': 'Invalid request'
-    })
\ No newline at end of file
+    })
+
+def metrics(request):
+    """Prometheus metrics of this process, for staff users and the METRICS_ALLOWED_IPS scrapers"""
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', ())
+    if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in allowed_ips):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def _etag_matches(etag, if_none_match):
+    """Weak comparison of an ETag with the list of an If-None-Match header"""
+    tags = parse_etags(if_none_match)
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+def serve_media(request, name):
+    """
+    Serve a file of the local media store
+
+    Files are content-addressed, so they are cached forever and the file
+    name doubles as the ETag.  With MEDIA_SENDFILE_HEADER set (X-Accel-Redirect
+    for nginx, X-Sendfile for Apache) the web server sends the file itself;
+    otherwise FileResponse lets the WSGI server use sendfile where it can.
+    """
+    store = get_media_store()
+    if os.path.normpath(name) != name or name.endswith('.part'):
+        # Stored names have no '.' or '..' segments, and the MEDIA_SENDFILE_HEADER
+        # value must not have them either; .part files are still being written
+        raise Http404
+    try:
+        path = safe_join(store.root, name)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(path):
+        raise Http404
+    
+    etag = '"%s"' % os.path.splitext(os.path.basename(name))[0]
+    if _etag_matches(etag, request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        sendfile_header = getattr(settings, 'MEDIA_SENDFILE_HEADER', None)
+        if sendfile_header:
+            response = HttpResponse(content_type=content_type)
+            response[sendfile_header] = getattr(settings, 'MEDIA_SENDFILE_PREFIX', '/protected-media/') + name
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
\ No newline at end of file